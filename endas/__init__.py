@@ -95,6 +95,18 @@ class ObservationOperator(metaclass=ABCMeta):
         raise NotImplementedError()
 
 
+    @property
+    def selected_states(self):
+        """
+        Returns the array of state vector indexes observed by this operator if it is a row-selection operator, i.e.
+        each observation is a direct observation of a single state variable. Returns ``None`` otherwise.
+
+        Algorithms may use this to replace products with the operator by selecting rows or columns. The default
+        implementation returns ``None``.
+        """
+        return None
+
+
 
 class CovarianceOperator(metaclass=ABCMeta):
     """
@@ -223,6 +235,8 @@ class CovarianceOperator(metaclass=ABCMeta):
 
         Args:
             selected : Array of indexes of observations to select
+            taper    : Array of tapering weights of the selected observations. The array may be a buffer that is
+                       reused by the caller and must be copied if it is kept by the returned operator.
 
         Returns:
             An instance of ``ObservationOperator`` of shape (s, n), where ``s = len(selected)``.
@@ -0,0 +1,169 @@
+"""
+Compiled kernels for performance-critical loops.
+
+The kernels are compiled with Numba if it is available. Numba is an optional dependency, if it is not installed the
+functions in this module fall back to equivalent NumPy implementations.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+
+def apply_local_transforms(A, limits, X5, haveX5):
+    """
+    Applies local ensemble transforms to a partitioned ensemble in-place.
+
+    Args:
+        A      : Array of shape (S, N) holding the local ensembles of all domains stacked on top of each other.
+        limits : Array of shape (D, 2) with the first row and the number of rows of each local ensemble in ``A``.
+        X5     : Array of shape (D, N, N) of local transforms.
+        haveX5 : Boolean array of length D, only local ensembles for which this is ``True`` are transformed.
+
+    Returns:
+        The array ``A``.
+
+    With Numba the loop over local ensembles is compiled.
+    """
+    if HAVE_NUMBA and A.dtype == np.double and X5.dtype == np.double and A.flags.c_contiguous:
+        _apply_local_transforms_nb(A, limits, X5, haveX5)
+        return A
+
+    for di in np.flatnonzero(haveX5):
+        start, n = limits[di]
+        A[start:start + n, :] = A[start:start + n, :].dot(X5[di])
+    return A
+
+
+def perturbed_innovations(D, z, HA):
+    """
+    Computes the perturbed innovations ``D - mean(D) + z - HA`` in-place.
+
+    Args:
+        D  : Array of shape (m, N) of observation perturbations, the ensemble mean is removed from each row.
+        z  : Array of length m of observations.
+        HA : Array of shape (m, N), the ensemble mapped to the observation space.
+
+    Returns:
+        The array ``D``.
+
+    With Numba this is done in a single pass over ``D``, otherwise three passes are needed.
+    """
+    if HAVE_NUMBA and type(D) is np.ndarray and type(HA) is np.ndarray and \
+            D.dtype == np.double and HA.dtype == np.double:
+        _perturbed_innovations_nb(D, np.asarray(z, dtype=np.double), HA)
+        return D
+
+    u = np.mean(D, axis=1)
+    np.subtract(z, u, out=u)
+    np.add(D, u.reshape(-1, 1), out=D)
+    return np.subtract(D, HA, out=D)
+
+
+def _use_row_kernel(E, out):
+    # Compiled row kernels are used for C-ordered double precision arrays only
+    return HAVE_NUMBA and type(E) is np.ndarray and E.ndim == 2 and E.dtype == np.double and \
+        E.flags.c_contiguous and (out is None or (type(out) is np.ndarray and out.dtype == np.double and
+                                                  out.flags.c_contiguous and out.shape == E.shape))
+
+
+def center_rows(E, out=None):
+    """
+    Subtracts the mean of each row of ``E`` from the row.
+
+    Args:
+        E   : Array of shape (n, N).
+        out : Array of the same shape as ``E`` where the result is stored, can be ``E`` itself. If ``None``, new
+              array is allocated.
+
+    Returns:
+        The centered array.
+
+    With Numba the mean is computed and subtracted while the row is in cache, i.e. in a single pass over ``E``.
+    """
+    if _use_row_kernel(E, out):
+        if out is None: out = np.empty_like(E)
+        _center_rows_nb(E, out)
+        return out
+
+    u = np.mean(E, axis=1).reshape(-1, 1)
+    return np.subtract(E, u, out=out)
+
+
+def standardize_rows(E, out=None):
+    """
+    Adjusts each row of ``E`` to zero mean and standard deviation of 1.
+
+    Args:
+        E   : Array of shape (n, N).
+        out : Array of the same shape as ``E`` where the result is stored, can be ``E`` itself. If ``None``, new
+              array is allocated.
+
+    Returns:
+        The standardized array.
+
+    With Numba the mean, standard deviation and the update are all computed in a single pass over ``E``.
+    """
+    if _use_row_kernel(E, out):
+        if out is None: out = np.empty_like(E)
+        _standardize_rows_nb(E, out)
+        return out
+
+    u = np.mean(E, axis=1).reshape(-1, 1)
+    E = np.subtract(E, u, out=out)
+    sd = np.std(E, axis=1).reshape(-1, 1)
+    return np.divide(E, sd, out=E)
+
+
+if HAVE_NUMBA:
+    # The row kernels are memory-bound and are not compiled with parallel=True. Starting Numba's threading layer
+    # in the parent process would break process pools that use the fork start method (see EnsembleKalmanFilter)
+    @njit(cache=True)
+    def _center_rows_nb(E, out):
+        n, N = E.shape
+        for i in range(n):
+            u = 0.0
+            for j in range(N): u += E[i, j]
+            u /= N
+            for j in range(N): out[i, j] = E[i, j] - u
+
+
+    @njit(cache=True, error_model='numpy')
+    def _standardize_rows_nb(E, out):
+        n, N = E.shape
+        for i in range(n):
+            u = 0.0
+            for j in range(N): u += E[i, j]
+            u /= N
+            v = 0.0
+            for j in range(N):
+                d = E[i, j] - u
+                out[i, j] = d
+                v += d * d
+            sd = np.sqrt(v / N)
+            for j in range(N): out[i, j] /= sd
+
+
+    @njit(cache=True)
+    def _perturbed_innovations_nb(D, z, HA):
+        m, N = D.shape
+        for i in range(m):
+            u = 0.0
+            for j in range(N): u += D[i, j]
+            c = z[i] - u / N
+            for j in range(N): D[i, j] += c - HA[i, j]
+
+
+    # Not compiled with parallel=True for the same reason as the row kernels, the products are done by BLAS anyway
+    @njit(cache=True)
+    def _apply_local_transforms_nb(A, limits, X5, haveX5):
+        for di in range(limits.shape[0]):
+            if haveX5[di]:
+                start = limits[di, 0]
+                stop = start + limits[di, 1]
+                A[start:stop] = A[start:stop] @ X5[di]
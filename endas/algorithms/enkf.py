@@ -15,17 +15,23 @@ executed and in particular how localization is done.
 __all__ = [ 'EnsembleKalmanFilter', 'EnKFVariant', 'EnKF' ]
 
 import math
+from concurrent.futures import as_completed
 import numpy as np
 from scipy import linalg
 
 from endas import ensemble, CovarianceOperator
-from endas import arraycache
+from endas import _kernels
 from endas.localization import DomainLocalization
 
 
 from abc import ABCMeta, abstractmethod
 
 
+# Local state vectors are padded to equal size (see EnsembleKalmanFilter.localize()) only if this does not increase
+# the size of the partitioned ensemble by more than this factor
+_MAX_PADDING_RATIO = 1.5
+
+
 class EnsembleKalmanFilter:
     """
     Ensemble Kalman Filter.
@@ -43,14 +49,18 @@ class EnsembleKalmanFilter:
                         meaning no covariance inflation is applied.
         lag : The lag length of the fixed-lag Kalman Smoother as a number of time steps. Zero Lag disables smoothing
         forgetting_factor: Forgetting factor applied by the smoother, the value must be less or equal to 1.0.
-        cache : Large array cache instance or ``None``. If ``None`` is given, an internal memory cache will be used.
+        cache : Large array cache instance or ``None``. If ``None`` is given, the ensembles needed by the smoother are
+                kept in memory in a preallocated buffer of ``lag+1`` ensembles.
+        transform_dtype : Data type used to store the local ensemble transforms between the analysis and the smoother
+                          update. Passing ``np.float32`` halves the memory needed for the transforms, which is
+                          ``num_domains * N * N`` elements, at the expense of precision of the smoother solution.
 
     See the :ref:`da-algorithms` page for information about implemented EnKF variants.
     """
 
     def __init__(self, variant, ensemble_size, loc_strategy=None,
                  cov_inflation=1.0, lag=0, forgetting_factor=1.0,
-                 cache=None):
+                 cache=None, transform_dtype=np.double):
 
         self.localization_strategy = loc_strategy  # Localization strategy
         self.cov_inflation = cov_inflation  # Covariance inflation factor
@@ -61,9 +71,14 @@ class EnsembleKalmanFilter:
 
         self._ensemblesize = ensemble_size
         self._lag = lag
-        self._cache = arraycache.ArrayCache() if cache is None else cache
+        self._cache = cache
         self._smoother_data = []
+        self._A_ring = None
         self._variant_initialized = False
+        self._eyeN = None
+        self._transform_dtype = np.dtype(transform_dtype)
+        self._X5_buf = None
+        self._haveX5_buf = None
 
         self.localize(loc_strategy)
 
@@ -86,6 +101,10 @@ class EnsembleKalmanFilter:
         self._loc_strategy = loc_strategy
         self._loc_statesize_sum = 0
         self._loc_statesize_limits = None
+        self._gather_idx = None
+        self._scatter_idx = None
+        self._loc_stride = None
+        self._loc_rows = None
 
         if loc_strategy is None: return
 
@@ -101,17 +120,70 @@ class EnsembleKalmanFilter:
         # multiple arrays if one becomes too large. Note: We do not rely on the sum of local state vector
         # lengths to equal the global state since there may be some padding applied to the local domains.
 
-        self._loc_statesize_limits = np.empty((self._num_domains, 2), dtype=np.uint32)
+        #
+        # If the local state vectors are of similar size, each one is padded to the size of the largest one. The local
+        # ensembles can then be viewed as a single (num_domains, stride, N) array and the smoother updates for all
+        # domains computed by a single batched matrix product. The padding rows are zero and are never copied back
+        # to the global state.
+        #
+        # If the state space partitioning can tell us which global state vector elements form each local state vector,
+        # we also build a single index array that gathers all local state vectors at once. If the domains are
+        # disjoint (which they normally are), the same array is used to scatter the local state vectors back to the
+        # global state. Otherwise the scatter is left to put_local_state().
+
         ssp = loc_strategy.ssp
+        local_sizes = np.empty(self._num_domains, dtype=np.uint32)
+        gather_idx = []
         for di in range(self._num_domains):
             n = ssp.get_local_state_size(di)
             assert n > 0
-            self._loc_statesize_limits[di, 0] = self._loc_statesize_sum
-            self._loc_statesize_limits[di, 1] = n
-            self._loc_statesize_sum+= n
+            local_sizes[di] = n
+
+            if gather_idx is not None:
+                d_idx = ssp.get_local_state_indices(di)
+                if d_idx is not None:
+                    assert len(d_idx) == n
+                    gather_idx.append(d_idx)
+                else:
+                    gather_idx = None
+
+        max_n = int(local_sizes.max())
+        self._loc_statesize_limits = np.empty((self._num_domains, 2), dtype=np.uint32)
+        self._loc_statesize_limits[:, 1] = local_sizes
+
+        if self._num_domains * max_n <= _MAX_PADDING_RATIO * local_sizes.sum():
+            self._loc_stride = max_n
+            self._loc_statesize_limits[:, 0] = np.arange(self._num_domains) * max_n
+            self._loc_statesize_sum = self._num_domains * max_n
+            if np.any(local_sizes != max_n):
+                self._loc_rows = np.concatenate([np.arange(di * max_n, di * max_n + n)
+                                                 for di, n in enumerate(local_sizes)])
+        else:
+            self._loc_statesize_limits[1:, 0] = np.cumsum(local_sizes[:-1])
+            self._loc_statesize_limits[0, 0] = 0
+            self._loc_statesize_sum = int(local_sizes.sum())
+
+        if gather_idx is not None:
+            self._gather_idx = np.concatenate(gather_idx).astype(np.intp)
+            if len(np.unique(self._gather_idx)) == len(self._gather_idx):
+                self._scatter_idx = self._gather_idx
 
 
     def forecast(self, model, A, Q, dt):
+        """
+        Implements the forecast step of the Ensemble Kalman Filter.
+
+        Args:
+            model : Callable object propagating the ensemble forward in time. The model is called once as
+                    ``model(A, dt)`` with the entire n x N ensemble and must update it in-place, therefore models
+                    should propagate all ensemble members in a single (vectorized) operation where possible.
+            A     : Array representing the ensemble
+            Q     : Model error covariance operator or ``None`` for perfect model
+            dt    : Time increment. This is simply passed to the model
+
+        Returns:
+            The forecast ensemble (this is `A` updated in-place)
+        """
         n, N = A.shape
         if Q is not None: assert Q.shape == (n, n)
 
@@ -146,15 +218,23 @@ class EnsembleKalmanFilter:
 
         self._Aa_enkf = None
         self._smoother_data = []
-        self._cache.clear()
 
         n, N = A0.shape  # State and ensemble size
 
+        # Without a cache, the ensembles are stored in a ring buffer. Since the oldest ensemble is released before the
+        # analysis ensemble of the current step is stored, at most lag+1 ensembles are ever needed
+        if self._cache is not None:
+            self._cache.clear()
+            self._A_ring = None
+        elif self._num_domains > 0:
+            self._A_ring = np.zeros((self._lag + 1, self._loc_statesize_sum, N))
+        else:
+            self._A_ring = np.empty((self._lag + 1, n, N), dtype=A0.dtype)
+
         if self._num_domains > 0:
-            A0 = self._partition_state(A0)
+            A0 = self._partition_state(A0, out=self._next_smoother_slot())
 
-        A0_handle = self._cache.put(A0)
-        self._smoother_data.append((A0_handle, t0))
+        self._smoother_data.append((self._smoother_put(A0), t0))
 
 
     def begin_analysis(self, A, t=None):
@@ -182,6 +262,7 @@ class EnsembleKalmanFilter:
         self._n = n
         self._N = N
         self._t = t
+        if self._eyeN is None or self._eyeN.shape[0] != N: self._eyeN = np.eye(N)
         self._X5 = None
         self._haveX5 = None
         self._Af = A
@@ -192,7 +273,8 @@ class EnsembleKalmanFilter:
         if self._num_domains == 0:
             self._Aa_enkf = A
         else:
-            self._Aa_enkf = self._partition_state(A)
+            # The partitioned ensemble is also the analysis stored for smoothing, so write it there directly
+            self._Aa_enkf = self._partition_state(A, out=self._next_smoother_slot())
 
 
     def assimilate(self, z, z_coords, H, R, executor=None):
@@ -204,6 +286,9 @@ class EnsembleKalmanFilter:
             z_coords : Observation coordinates. See below for more information.
             H        : Observation operator, must be an instance of :class:`endas.ObservationOperator`.
             R        : Observation error covariance, must be an instance of :class:`endas.CovarianceOperator`.
+            executor : Executor used to run the local analyses in parallel, or ``None`` to run them sequentially.
+                       Any :class:`concurrent.futures.Executor` can be used, e.g. ``ThreadPoolExecutor`` or
+                       ``ProcessPoolExecutor``. Ignored for global analysis.
 
         Returns:
             Nothing
@@ -213,21 +298,35 @@ class EnsembleKalmanFilter:
         depends on the state space partitioning (:class:`StateSpacePartitioning`) used for the localization, please
         check the documentation of the state space partitioning you are using for information. If the analysis is not
         localized, ``None`` can be passed for ``z_coords``.
+
+        Most of the work in local analyses is done by NumPy/LAPACK, which releases the GIL, so a ``ThreadPoolExecutor``
+        is usually the best choice as it avoids copying any data. Since local analyses are small, limiting the number
+        of BLAS threads to one (e.g. with ``threadpoolctl``) avoids oversubscribing the CPU cores.
+
+        When a process-based executor is used, the arguments of each local analysis (including the EnKF variant
+        instance) are pickled and sent to the worker processes. Please note that for stochastic variants that draw
+        random numbers in the local analyses, the order in which they are drawn is not deterministic for parallel
+        execution. :class:`EnKF` avoids this for diagonal ``R`` by drawing all observation perturbations up front.
         """
 
         n, N = self._n, self._N  # State and ensemble size
         m = len(z) if z is not None else 0  # Number of observations
 
+        # Per-observation data the variant computes once for all observations (and local analyses)
+        zg_data = self.variant.process_global_observations(z, R, N) if m > 0 else None
+
         # Global analysis
         if self._num_domains == 0:
             if m > 0:
                 Ag_data = self.variant.process_global_ensemble(self._Af, H)
 
+                kwargs = {'z_data': zg_data} if zg_data is not None else {}
                 X5, X5s = self.variant.ensemble_transform(
                     self._Af, z, H, R,
                     Ag_data,
                     self.cov_inflation,
-                    self.localization_strategy)
+                    self.localization_strategy,
+                    **kwargs)
                 self._Af = self._Af.dot(X5)
             else:
                 X5s = None
@@ -240,75 +339,52 @@ class EnsembleKalmanFilter:
 
         # Localized analysis
         else:
-            ls = self._loc_strategy
-            ssp = self._loc_strategy.ssp
-
             if self._X5 is None:
                 #Todo: Here we pack all X5 instances in a large array, which is wasteful if only a few domains
                 #      are actually being updated with observations
-                self._X5 = np.empty((self._num_domains, N, N))
-                self._haveX5 = np.zeros(self._num_domains, dtype=np.bool)
-
-
-            if m > 0:
-
-                for di in range(self._num_domains):
-
-                    # Collect observations for this domain...
-                    local_zindexes, local_zdist = ssp.get_local_observations(di, z_coords, self._loc_strategy.taper_fn)
-                    local_m = len(local_zindexes) if local_zindexes is not None else 0
-
-                    # ... and assimilate if we have any
-                    if local_m > 0:
+                # The array is large, so it is allocated once and reused by subsequent analysis steps
+                X5_shape = (self._num_domains, N, N)
+                if self._X5_buf is None or self._X5_buf.shape != X5_shape or \
+                        self._X5_buf.dtype != self._transform_dtype:
+                    self._X5_buf = np.empty(X5_shape, dtype=self._transform_dtype)
+                    self._haveX5_buf = np.empty(self._num_domains, dtype=np.bool_)
 
-                        # Local state vector
-                        local_start, local_n = self._loc_statesize_limits[di]
-                        local_A = self._Aa_enkf[local_start:local_start+local_n, :]
-                        assert local_A.shape == (local_n, N)
+                self._X5 = self._X5_buf
+                self._haveX5 = self._haveX5_buf
+                self._haveX5.fill(False)
 
-                        # Construct localized versions of the observation operator and observation error covariance
-                        local_H = ls.get_local_H(H, local_zindexes)
-                        local_R = ls.get_local_R(R, local_zindexes, local_zdist)
-                        local_z = z[local_zindexes]
 
-                        # Before computing the ensemble transform, let the variant pre-calculate any data from the
-                        # global ensemble it needs.
-                        Ag_data = self.variant.process_global_ensemble(self._Af, local_H)
-
-                        if executor is not None:
-                            raise NotImplementedError()
-                        else:
-                            local_X5, local_X5s = self.variant.ensemble_transform(
-                                local_A, local_z, local_H, local_R,
-                                Ag_data,
-                                self.cov_inflation,
-                                self.localization_strategy)
+            if m > 0:
 
-                            if local_X5s is None: local_X5s = local_X5
-                            assert local_X5.shape == (N, N)
-                            assert local_X5s.shape == (N, N)
+                # The local analyses are independent of each other. If an executor is given, they are computed in
+                # parallel and the results written back to the local ensembles in the order in which they complete
+                local_analyses = self._local_analysis_tasks(z, z_coords, H, R, zg_data)
+                if executor is None:
+                    results = map(_local_analysis, local_analyses)
+                else:
+                    futures = [executor.submit(_local_analysis, task) for task in local_analyses]
+                    results = (f.result() for f in as_completed(futures))
 
-                            # Todo: Do this in-place?
-                            local_Aa = local_A.dot(local_X5)
-                            self._Aa_enkf[local_start:local_start + local_n, :] = local_Aa
+                for di, local_Aa, local_X5s in results:
+                    local_start, local_n = self._loc_statesize_limits[di]
+                    self._Aa_enkf[local_start:local_start + local_n, :] = local_Aa
 
-                            if not self._haveX5[di]:
-                                self._X5[di, :, :] = local_X5s
-                                self._haveX5[di] = True
-                            else:
-                                self._X5[di, :, :] = np.dot(self._X5[di, :, :], local_X5s)
+                    if not bool(self._haveX5[di]):
+                        self._X5[di, :, :] = local_X5s
+                        self._haveX5[di] = True
+                    else:
+                        self._X5[di, :, :] = np.dot(self._X5[di, :, :], local_X5s)
 
 
             # After we're done with the analysis, reconstruct the global ensemble as we are going to
             # need it either at next assimmilate() call or in end_analysis().
-            for di in range(self._num_domains):
-                local_start, local_n = self._loc_statesize_limits[di]
-                ssp.put_local_state(di, self._Aa_enkf[local_start:local_start + local_n, :], self._Af)
+            self._merge_state(self._Aa_enkf, self._Af)
 
 
     def end_analysis(self, on_smoother_result=None, result_args=tuple()):
         n, N = self._n, self._N  # State and ensemble size
         k = len(self._smoother_data)
+        eyeN = self._eyeN
 
         # First the lagged smoother by updating all previous EnKF states with the transformation matrix from the
         # current analysis update. For lag=0 this does nothing
@@ -318,7 +394,7 @@ class EnsembleKalmanFilter:
 
             #print("Smoother up", k - j, Aj_handle, tj)
 
-            Aj = self._cache.get(Aj_handle)
+            Aj = self._smoother_get(Aj_handle)
             assert Aj is not None
 
             Aj_is_result = j == k-self._lag  # Do we have the ready smoothing result?
@@ -326,14 +402,11 @@ class EnsembleKalmanFilter:
             # For global analysis both A_enkf and X5 are the global ensemble and transform
             # arrays, respectively, so we only need to compute Aj*X5
             As = None
-            eyeN = np.eye(N)
 
             if self._num_domains == 0:
                 if self._X5 is not None:
                     if self.forgetting_factor != 1.0:
-                        X4 = self._X5 - eyeN
-                        X4 *= self.forgetting_factor
-                        self._X5 = eyeN + X4
+                        _apply_forgetting(self._X5, self.forgetting_factor)
                     Aj = Aj.dot(self._X5, out=Aj)
                 if Aj_is_result: As = Aj
 
@@ -343,31 +416,32 @@ class EnsembleKalmanFilter:
             else:
                 As = np.empty((n, N)) if Aj_is_result else None
 
-                for di in range(self._num_domains):
-
-                    local_start, local_n = self._loc_statesize_limits[di]
-                    local_Aj = Aj[local_start:local_start + local_n, :]
-                    assert local_Aj.shape == (local_n, N)
+                if self._haveX5 is not None and np.any(self._haveX5):
+                    # Domains without a transform use the identity, which the forgetting factor leaves unchanged
+                    self._X5[~self._haveX5] = eyeN
+                    if self.forgetting_factor != 1.0:
+                        _apply_forgetting(self._X5, self.forgetting_factor)
 
-                    if self._haveX5 is not None and self._haveX5[di]: # and self._last_analysis_j[d_i] <= j:
-                        X5d = self._X5[di, :, :]
-                        if self.forgetting_factor != 1.0:
-                            X4 = X5d - eyeN
-                            X4 *= self.forgetting_factor
-                            X5d = eyeN + X4
-                            self._X5[di, :, :] = X5d
+                    # Transforms stored with reduced precision are converted to the ensemble data type first
+                    X5 = self._X5 if self._X5.dtype == Aj.dtype else self._X5.astype(Aj.dtype)
 
-                        local_Aj[:] = local_Aj.dot(X5d)
+                    # With padded local ensembles all domains are updated in one go, otherwise the local transforms
+                    # are applied domain by domain (in parallel if possible)
+                    if self._loc_stride is not None:
+                        Aj3 = Aj.reshape(self._num_domains, self._loc_stride, N)
+                        Aj[:] = np.matmul(Aj3, X5).reshape(Aj.shape)
+                    else:
+                        _kernels.apply_local_transforms(Aj, self._loc_statesize_limits, X5, self._haveX5)
 
-                    if Aj_is_result:
-                        self._loc_strategy.ssp.put_local_state(di, local_Aj, As)
+                if Aj_is_result:
+                    self._merge_state(Aj, As)
 
 
             if As is not None:
                 if on_smoother_result is not None:
                     on_smoother_result(ensemble.mean(As), As, tj, result_args)
                 #print("Remove Aj")
-                self._cache.remove(Aj_handle)
+                self._smoother_remove(Aj_handle)
 
 
         # Done with smoothing, if there was any. Store analysis result for this update step and return it.
@@ -375,7 +449,7 @@ class EnsembleKalmanFilter:
             if on_smoother_result is not None:
                 on_smoother_result(ensemble.mean(self._Af), self._Af, self._t, result_args)
         else:
-            Aa_handle = self._cache.put(self._Aa_enkf)
+            Aa_handle = self._smoother_put(self._Aa_enkf)
             #print("Add Aj", k)
             self._smoother_data.append((Aa_handle, self._t))
 
@@ -400,7 +474,7 @@ class EnsembleKalmanFilter:
             Aj_handle, tj = self._smoother_data[j]
 
             # print("Smoother up", k - j, Aj_handle, tj)
-            Aj = self._cache.get(Aj_handle)
+            Aj = self._smoother_get(Aj_handle)
             assert Aj is not None
 
             # For global analysis both A_enkf and X5 are the global ensemble and transform
@@ -409,17 +483,84 @@ class EnsembleKalmanFilter:
             if self._num_domains == 0:
                 As = Aj
             else:
-                for di in range(self._num_domains):
-                    local_start, local_n = self._loc_statesize_limits[di]
-                    local_Aj = Aj[local_start:local_start + local_n, :]
-                    assert local_Aj.shape == (local_n, N)
-                    self.localization_strategy.ssp.put_local_state(di, local_Aj, As_buffer)
-                As = As_buffer
+                As = self._merge_state(Aj, As_buffer)
 
             if on_smoother_result is not None:
                 on_smoother_result(ensemble.mean(As), As, tj, result_args)
                 # print("Remove Aj")
-            self._cache.remove(Aj_handle)
+            self._smoother_remove(Aj_handle)
+
+
+    def _next_smoother_slot(self):
+        """
+        Returns the ring buffer slot where the next ensemble stored for smoothing goes or ``None`` if the ring buffer
+        is not used.
+        """
+        if self._A_ring is None: return None
+        return self._A_ring[len(self._smoother_data) % len(self._A_ring)]
+
+
+    def _smoother_put(self, A):
+        """
+        Stores the ensemble `A` for smoothing and returns a handle for retrieving it.
+        """
+        if self._cache is not None: return self._cache.put(A)
+
+        handle = len(self._smoother_data) % len(self._A_ring)
+        slot = self._A_ring[handle]
+        if not np.shares_memory(slot, A): slot[:] = A
+        return handle
+
+
+    def _smoother_get(self, handle):
+        if self._cache is not None: return self._cache.get(handle)
+        return self._A_ring[handle]
+
+
+    def _smoother_remove(self, handle):
+        if self._cache is not None: self._cache.remove(handle)
+
+
+    def _local_analysis_tasks(self, z, z_coords, H, R, zg_data):
+        """
+        Yields the inputs of the local analyses for all domains that have observations, see ``_local_analysis()``.
+        """
+        ls = self._loc_strategy
+        ssp = ls.ssp
+
+        # Observations for all domains are located at once
+        local_obs = ssp.get_local_observations_batch(z_coords, ls.taper_fn)
+        assert len(local_obs) == self._num_domains
+
+        # Localized observation error covariances are also constructed for all domains at once
+        local_Rs = ls.get_local_R_batch(R, local_obs)
+
+        for di in range(self._num_domains):
+
+            # Collect observations for this domain...
+            local_zindexes, _ = local_obs[di]
+            local_m = len(local_zindexes) if local_zindexes is not None else 0
+
+            # ... and assimilate if we have any
+            if local_m > 0:
+
+                # Local state vector
+                local_start, local_n = self._loc_statesize_limits[di]
+                local_A = self._Aa_enkf[local_start:local_start+local_n, :]
+                assert local_A.shape == (local_n, self._N)
+
+                # Construct localized versions of the observation operator and observation error covariance
+                local_H = ls.get_local_H(H, local_zindexes)
+                local_R = local_Rs[di]
+                local_z = z[local_zindexes]
+                local_zdata = zg_data[local_zindexes] if zg_data is not None else None
+
+                # Before computing the ensemble transform, let the variant pre-calculate any data from the
+                # global ensemble it needs.
+                Ag_data = self.variant.process_global_ensemble(self._Af, local_H)
+
+                yield (self.variant, di, local_A, local_z, local_H, local_R, Ag_data, local_zdata,
+                       self.cov_inflation, self.localization_strategy)
 
 
     def _partition_state(self, A, out=None):
@@ -429,10 +570,20 @@ class EnsembleKalmanFilter:
         """
         n, N = A.shape
         if out is None:
-            out = np.empty((self._loc_statesize_sum, N))
+            out = np.empty((self._loc_statesize_sum, N)) if self._loc_rows is None else \
+                  np.zeros((self._loc_statesize_sum, N))
         else:
             assert out.shape == (self._loc_statesize_sum, N)
 
+        if self._gather_idx is not None:
+            if self._loc_rows is not None:
+                out[self._loc_rows, :] = A[self._gather_idx]
+            elif A.dtype == out.dtype:
+                np.take(A, self._gather_idx, axis=0, out=out)
+            else:
+                out[:] = A[self._gather_idx]
+            return out
+
         ssp = self._loc_strategy.ssp
         for di in range(self._num_domains):
             d_start, d_n = self._loc_statesize_limits[di]
@@ -441,6 +592,64 @@ class EnsembleKalmanFilter:
         return out
 
 
+    def _merge_state(self, A, out):
+        """
+        Writes local state vectors (as returned by ``_partition_state()``) back to the global state/ensemble `out`.
+        This is the inverse of ``_partition_state()``.
+        """
+        assert A.shape[0] == self._loc_statesize_sum
+
+        if self._scatter_idx is not None:
+            out[self._scatter_idx, :] = A if self._loc_rows is None else A[self._loc_rows]
+            return out
+
+        ssp = self._loc_strategy.ssp
+        for di in range(self._num_domains):
+            d_start, d_n = self._loc_statesize_limits[di]
+            ssp.put_local_state(di, A[d_start:d_start + d_n, :], out)
+
+        return out
+
+
+
+def _apply_forgetting(X5, ff):
+    """
+    Applies the forgetting factor ``ff`` to the transform(s) ``X5`` in-place, i.e. computes ``I + ff * (X5 - I)``.
+    ``X5`` can be a single NxN transform or a stack of transforms of shape (D, N, N).
+    """
+    np.multiply(X5, ff, out=X5)
+    diag = np.einsum('...ii->...i', X5)
+    diag += 1.0 - ff
+    return X5
+
+
+
+def _local_analysis(task):
+    """
+    Computes the local analysis update for a single domain. The function is stateless so that it can be executed in
+    parallel, possibly in a different process.
+
+    Args:
+        task : Tuple ``(variant, di, A, z, H, R, Ag_data, z_data, inflation, lstrategy)``, see
+               ``_local_analysis_tasks()``.
+
+    Returns:
+        Tuple ``(di, Aa, X5s)`` where ``Aa`` is the local analysis ensemble and ``X5s`` the transform for the smoother.
+    """
+    variant, di, local_A, local_z, local_H, local_R, Ag_data, local_zdata, inflation, lstrategy = task
+    N = local_A.shape[1]
+
+    kwargs = {'z_data': local_zdata} if local_zdata is not None else {}
+    local_X5, local_X5s = variant.ensemble_transform(local_A, local_z, local_H, local_R, Ag_data, inflation, lstrategy,
+                                                     **kwargs)
+
+    if local_X5s is None: local_X5s = local_X5
+    assert local_X5.shape == (N, N)
+    assert local_X5s.shape == (N, N)
+
+    return di, local_A.dot(local_X5), local_X5s
+
+
 
 class EnKFVariant(metaclass=ABCMeta):
     """
@@ -486,6 +695,22 @@ class EnKFVariant(metaclass=ABCMeta):
         return None
 
 
+    def process_global_observations(self, z, R, N):
+        """
+        Called once per ``EnsembleKalmanFilter.assimilate()`` call to compute additional per-observation data.
+
+        Args:
+            z : Array of all observations being assimilated.
+            R : Global observation error covariance operator.
+            N : The ensemble size
+
+        The return value must be ``None`` (the default) or an array whose first axis corresponds to the observations
+        in ``z``. If an array is returned, it is passed to ``ensemble_transform`` as the ``z_data`` keyword argument.
+        For localized analysis, only the rows of observations used by the local analysis are passed.
+        """
+        return None
+
+
     @abstractmethod
     def ensemble_transform(self, A, z, H, R, Ag_data, inflation, lstrategy, out=None):
         """
@@ -496,6 +721,9 @@ class EnKFVariant(metaclass=ABCMeta):
         size. If `out` is not None, the returned transform MUST be stored in the
         `out` instance in addition to being returned!
 
+        Implementations that override ``process_global_observations`` must also accept the ``z_data`` keyword
+        argument.
+
         Returns: NxN array where N is the ensemble size.
         """
         raise NotImplementedError
@@ -515,7 +743,14 @@ class EnKF(EnKFVariant):
         return HAX, HA
 
 
-    def ensemble_transform(self, A, z, H, R, Ag_data, inflation, lstrategy, out=None):
+    def process_global_observations(self, z, R, N):
+        # For diagonal R, the observation perturbations are drawn for all observations at once and local analyses
+        # only scale the rows of their observations by the (tapered) local error standard deviations
+        if not R.is_diagonal: return None
+        return np.random.standard_normal(size=(len(z), N))
+
+
+    def ensemble_transform(self, A, z, H, R, Ag_data, inflation, lstrategy, out=None, z_data=None):
         n, N = A.shape  # State and ensemble size
         m = H.shape[0]  # Number of observations
 
@@ -528,23 +763,39 @@ class EnKF(EnKFVariant):
             K = None
         # R can be included explicitly in the inversion
         else:
-            R_as_matrix = R.to_matrix(force_dense=False)
             HPHtR = HAX.dot(HAX.T)
-            HPHtR+= (N - 1) * R_as_matrix
 
-            K = linalg.solve(HPHtR, HAX, overwrite_a=True, overwrite_b=True).T
+            # For diagonal R (the common case, especially for tapered local R) it is enough to add to the diagonal,
+            # which avoids building R as a (sparse) matrix and the dense temporary from adding it to HPHtR
+            if R.is_diagonal:
+                diag = np.einsum('ii->i', HPHtR)
+                diag += (N - 1) * R.diagonal()
+            else:
+                HPHtR += (N - 1) * R.to_matrix(force_dense=True)
+
+            # HPHtR is symmetric positive definite so Cholesky factorization can be used, unless it is too
+            # ill-conditioned in which case we fall back to the general solver
+            try:
+                HPHtR_factor = linalg.cho_factor(HPHtR, lower=True)
+                K = linalg.cho_solve(HPHtR_factor, HAX, overwrite_b=True).T
+            except linalg.LinAlgError:
+                K = linalg.solve(HPHtR, HAX, overwrite_a=True, overwrite_b=True).T
             #K = linalg.lstsq(HPHtR, HAX, overwrite_a=True, overwrite_b=True, cond=0.01)[0].T
 
 
-        D = R.random_multivariate_normal(N)
-        D = ensemble.center(D, out=D)
+        if z_data is not None and R.is_diagonal:
+            D = z_data * np.sqrt(R.diagonal()).reshape(-1, 1)
+        else:
+            D = R.random_multivariate_normal(N)
 
-        D = np.add(D, z.reshape(-1, 1), out=D)
-        D = np.subtract(D, HA, out=D)
+        # Centered perturbations plus innovations, i.e. D - mean(D) + z - HA
+        D = _kernels.perturbed_innovations(D, z, HA)
         X4 = K.dot(D, out=out)
 
-        X5 = np.eye(N) + X4
-        #np.fill_diagonal(X4, X4.diagonal() + 1.0)  # X4 + I in-place
+        # X5 = X4 + I, computed in-place via a diagonal view
+        X5 = X4
+        diag = np.einsum('ii->i', X5)
+        diag += 1.0
         return X5, None
 
 
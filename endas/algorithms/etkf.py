@@ -8,6 +8,7 @@ Ensemble Transform Kalman Filter (ETKF)
 __all__ = ['ESTKF']
 
 import math
+from functools import lru_cache
 import numpy as np
 from scipy import linalg
 
@@ -41,25 +42,27 @@ class ESTKF(EnKFVariant):
 
         Hx, HA = Ag_data
 
-        a = (1.0 / N) * (1.0 / (1.0 / math.sqrt(N) + 1))
-        T = np.full((N, N - 1), -a)
-        np.fill_diagonal(T, 1.0 - a)
-        T[-1, :] = -1.0 / math.sqrt(N)
+        T = _estkf_T(N)
 
         HL = HA.dot(T)
-        RinvHL = R.solve(HL)
+        dz = z - Hx
+
+        # Solve for both HL and the innovation in a single call so that R is only factorized once
+        RinvHLdz = R.solve(np.column_stack((HL, dz)), overwrite_b=True)
+        HLtRinvHLdz = HL.T.dot(RinvHLdz)
+
+        w = HLtRinvHLdz[:, -1].copy()
 
-        Ainv = HL.T.dot(RinvHL)
+        Ainv = HLtRinvHLdz[:, :-1]
         np.fill_diagonal(Ainv, Ainv.diagonal() + (rho * (N - 1)))
         # np.fill_diagonal(Ainv, Ainv.diagonal() + ((m - 1)))
 
-        dz = z - Hx
-        w = HL.T.dot(R.solve(dz))
-        w = linalg.solve(Ainv, w, overwrite_b=True)
-
-        U, s, _ = linalg.svd(Ainv, overwrite_a=True)
+        # Ainv is symmetric positive definite, a single eigendecomposition gives both the solution for w and the
+        # symmetric inverse square root C
+        s, U = linalg.eigh(Ainv, overwrite_a=True)
+        w = U.dot(U.T.dot(w) / s)
         np.power(s, -0.5, out=s)
-        C = U.dot(np.diag(s).dot(U.T))
+        C = (U * s).dot(U.T)
 
         W = math.sqrt(N-1) * (C.dot(T.T))
 
@@ -67,17 +70,33 @@ class ESTKF(EnKFVariant):
             Y = np.random.standard_normal(size=(N, N))
             Q, RR = linalg.qr(Y, overwrite_a=True)
 
-            RRdiag = np.diagonal(RR, 0)
-            Ediag = RRdiag / np.fabs(RRdiag)
-            E = np.diag(np.reciprocal(Ediag), 0)
-            Q = Q.dot(E)
+            # Fix the signs so that Q is uniformly distributed, i.e. scale the columns of Q by the signs of diag(RR)
+            signs = np.sign(np.diagonal(RR))
+            signs[signs == 0] = 1.0
+            np.multiply(Q, signs, out=Q)
             W = W.dot(Q)
 
         dW = w.reshape(-1, 1) + W
-        G = T.dot(dW)
-        G += (1.0 / N)
+        TdW = T.dot(dW)
+        G = TdW + (1.0 / N)
 
-        Gs = (rho*T).dot(dW)
+        # (rho*T).dot(dW) is just the same product scaled by rho
+        Gs = np.multiply(TdW, rho, out=TdW)
         Gs += (1.0 / N)
 
         return G, Gs
+
+
+
+@lru_cache(maxsize=8)
+def _estkf_T(N):
+    """
+    Returns the N x (N-1) matrix T of the ESTKF, which projects the ensemble onto the error subspace. The matrix is
+    cached per ensemble size and shared by all ESTKF instances, hence it is read-only.
+    """
+    a = (1.0 / N) * (1.0 / (1.0 / math.sqrt(N) + 1))
+    T = np.full((N, N - 1), -a)
+    np.fill_diagonal(T, 1.0 - a)
+    T[-1, :] = -1.0 / math.sqrt(N)
+    T.setflags(write=False)
+    return T
@@ -3,7 +3,7 @@ Extended Kalman Filter.
 """
 
 
-__all__ = ['KalmanFilter']
+__all__ = ['KalmanFilter', 'RandomWalkKalmanFilter']
 
 import numpy as np
 from scipy import linalg
@@ -24,6 +24,43 @@ class KFSmootherData:
         self.t = t
 
 
+def _rts_step(xs, Ps, xf, Pf, xa, Pa, MPa, forgetting_factor, sc1, sc2):
+    """
+    Implements one step of the Rauch-Tung-Striebel smoother backward pass.
+
+    Args:
+        xs, Ps : Smoothed state and covariance at time `k+1`.
+        xf, Pf : Forecast state and covariance at time `k+1`.
+        xa, Pa : Analysis state and covariance at time `k`.
+        MPa : The tangent linear model applied to `Pa`.
+        forgetting_factor : Forgetting factor applied to the smoother gain.
+        sc1, sc2 : Scratch arrays of the same shape as `Pf`.
+
+    Returns:
+        Tuple `(xs, Ps)` of the smoothed state and covariance at time `k`, both are newly allocated.
+
+    The smoother gain `J` is solved from `Pf*J' = MPa` by a single LAPACK call (Cholesky factorization and
+    solve), the remaining updates use BLAS products into the scratch arrays.
+    """
+    # Pf is symmetric positive definite, only its upper triangle is used
+    posv, = linalg.get_lapack_funcs(('posv',), (Pf, MPa))
+    _, Jt, info = posv(Pf, MPa, lower=False, overwrite_a=False, overwrite_b=False)
+    if info > 0: raise linalg.LinAlgError("{}-th leading minor of Pf is not positive definite".format(info))
+    elif info < 0: raise ValueError("Illegal value in {}-th argument of internal posv".format(-info))
+
+    J = Jt.T
+    J*= forgetting_factor
+
+    xs = xa + J.dot(xs - xf)
+
+    # Ps = Pa + J*(J*(Ps - Pf))'
+    dP = np.subtract(Ps, Pf, out=sc1)
+    JdP = np.dot(J, dP, out=sc2)
+    Ps = Pa + np.dot(J, JdP.T, out=dP)
+    return xs, Ps
+
+
+
 class KalmanFilter:
     """
     Kalman Filter and Smoother.
@@ -39,10 +76,13 @@ class KalmanFilter:
                         of the state from time `t` to time `t+dt`. The return value `tladj_data` is
                         passed to the tangent linear and adjoint when called.
             model_tl  : Callable with signature `model(tladj_data, x)` implementing the dot product of the
-                        tangent linear of the model with `x`.
+                        tangent linear of the model with `x`. If the callable has attribute `accepts_sparse`
+                        set to ``True``, sparse background covariance matrices are passed to it as they are
+                        instead of being converted to dense arrays.
             model_adj : Callable with signature `model(tladj_data, x)` implementing the dot product of the
                         adjoint of the model with `x`.
-            cache:
+            cache     : Instance of :class:`endas.arraycache.ArrayCache` used to store the data needed for
+                        smoothing. If ``None``, the data is kept in memory in contiguous arrays.
             lag:
             forgetting_factor:
         """
@@ -54,9 +94,13 @@ class KalmanFilter:
         self._Mtl = model_tl
         self._Madj = model_adj
 
-        self._cache = cache if cache is not None else arraycache.ArrayCache()
+        self._cache = cache
         # Cache must be ArrayCache instance or subclass
-        assert isinstance(self._cache, arraycache.ArrayCache)
+        assert cache is None or isinstance(self._cache, arraycache.ArrayCache)
+
+        # Smoother data stored without cache, maps the data name ('xf', 'Pf', 'xa', 'Pa') to a pair of the array
+        # holding all stored items along the first axis and the number of items stored
+        self._store = {}
 
         self.forgetting_factor = forgetting_factor
         assert forgetting_factor > 0 and forgetting_factor <= 1.0
@@ -65,6 +109,63 @@ class KalmanFilter:
         self._nassim_this_step = 0
         self._xf_handle = None
         self._Pf_handle = None
+        self._scratch = {}
+        self._H_op = None
+        self._H_dense = None
+        self._mirror = None
+
+
+    def _scratch_buffer(self, name, shape, dtype=np.double):
+        """
+        Returns the scratch array of given name, it is only re-allocated if the shape or type has changed since last
+        use.
+        """
+        buf = self._scratch.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._scratch[name] = buf
+        return buf
+
+
+    def _mirror_indices(self, n):
+        """
+        Returns flat indices of the strictly upper triangle of a C-ordered n x n matrix and of the corresponding
+        elements of the lower triangle. The indices are cached since they are needed by every analysis update.
+        """
+        if self._mirror is None or self._mirror[0] != n:
+            iu, ju = np.triu_indices(n, 1)
+            self._mirror = (n, iu * n + ju, ju * n + iu)
+        return self._mirror[1], self._mirror[2]
+
+
+    def _smoother_put(self, name, data, take_ownership=False):
+        """
+        Stores `data` for smoothing and returns a handle for retrieving it. Without a cache, the data is copied to the
+        next row of the contiguous array for given `name` and the handle is the row index.
+        """
+        if self._cache is not None: return self._cache.put(data, take_ownership=take_ownership)
+
+        buf, count = self._store.get(name, (None, 0))
+        if buf is None or buf.shape[1:] != data.shape:
+            capacity = self._lag + 1 if self._lag else 8
+            buf = np.empty((capacity,) + data.shape, dtype=data.dtype)
+            count = 0
+        elif count == len(buf):
+            # Out of space, grow geometrically
+            buf = np.concatenate((buf, np.empty_like(buf)))
+
+        buf[count] = data
+        self._store[name] = (buf, count + 1)
+        return count
+
+
+    def _smoother_get(self, name, handle):
+        if self._cache is not None: return self._cache.get(handle)
+        return self._store[name][0][handle]
+
+
+    def _smoother_remove(self, name, handle):
+        if self._cache is not None: self._cache.remove(handle)
 
 
     def smoother_begin(self, x0, P0, t0):
@@ -72,8 +173,8 @@ class KalmanFilter:
         if self._lag == 0: return
 
         P0 = cov.to_matrix(P0, force_dense=True)  # Avoid sparse matrices here for performance reasons!
-        x0_handle = self._cache.put(x0)
-        P0_handle = self._cache.put(P0)
+        x0_handle = self._smoother_put('xa', x0)
+        P0_handle = self._smoother_put('Pa', P0)
         self._data.append(KFSmootherData(None, None, x0_handle, P0_handle, None, t0))
 
 
@@ -91,9 +192,10 @@ class KalmanFilter:
 
         """
         assert xb.ndim == 1
-        n = xb.shape[0]
 
-        Pb = cov.to_matrix(Pb, force_dense=True) # Avoid sparse matrices here for performance reasons!
+        # Avoid sparse matrices here for performance reasons, unless the tangent linear declares it handles them
+        # efficiently
+        Pb = cov.to_matrix(Pb, force_dense=not getattr(self._Mtl, 'accepts_sparse', False))
         Q = cov.to_matrix(Q, force_dense=True) if Q is not None else None
 
         # Move state estimate and covariance from xb to xk
@@ -121,14 +223,14 @@ class KalmanFilter:
         """
 
         self._xf = x
-        self._Pf = cov.to_matrix(P, force_dense=True)
+        self._Pf = cov.to_matrix(P, force_dense=True)  # Avoid sparse matrices here for performance reasons!
         self._t = t
         self._xa = self._xf
         self._Pa = self._Pf
 
-        P = cov.to_matrix(P, force_dense=True)  # Avoid sparse matrices here for performance reasons!
-        self._xf_handle = self._cache.put(x) if self._lag > 0 else None
-        self._Pf_handle = self._cache.put(P) if self._lag > 0 else None
+        # The cache copies the data so the already densified covariance can be stored directly
+        self._xf_handle = self._smoother_put('xf', x) if self._lag > 0 else None
+        self._Pf_handle = self._smoother_put('Pf', self._Pf) if self._lag > 0 else None
 
 
     def assimilate(self, z, H, R):
@@ -146,24 +248,56 @@ class KalmanFilter:
         """
 
         if z is not None and len(z) > 0:
-            H = H.to_matrix(force_dense=True)
-
-            # Observation noise covariance
-            F = H.dot(self._Pf).dot(H.T)
-
+            n, m = self._Pf.shape[0], H.shape[0]
+            sel = H.selected_states
+
+            if sel is not None:
+                # H selects state variables, all products with H reduce to selecting rows/columns of Pf
+                dtype = self._Pf.dtype
+                PfHt = np.take(self._Pf, sel, axis=1, out=self._scratch_buffer('nm', (n, m), dtype))
+                F = np.take(PfHt, sel, axis=0, out=self._scratch_buffer('mm', (m, m), dtype))
+                Hxf = self._xf[sel]
+            else:
+                # The observation operator is often the same instance in every step, its dense form is kept
+                if self._H_op is not H:
+                    self._H_dense = H.to_matrix(force_dense=True)
+                    self._H_op = H
+                H = self._H_dense
+                dtype = np.result_type(self._Pf, H)
+                PfHt = np.dot(self._Pf, H.T, out=self._scratch_buffer('nm', (n, m), dtype))
+                F = np.dot(H, PfHt, out=self._scratch_buffer('mm', (m, m), dtype))
+                Hxf = H.dot(self._xf)
+
+            # Observation noise covariance is F + R
             if isinstance(R, np.ndarray): np.add(F, R, out=F)
             elif isinstance(R, CovarianceOperator): R.add_to(F)
             else:
                 raise TypeError("R must be a NumPy array or endas.CovarianceOperator")
 
+            # F = L*L' is symmetric positive definite. With W = Pf*H'*L^-T the Kalman gain is K = W*L^-1 and the
+            # covariance update K*H*Pf = W*W' is a symmetric rank-m product
+            L, _ = linalg.cho_factor(F, lower=True, overwrite_a=True)
+            W = linalg.solve_triangular(L, PfHt.T, lower=True, overwrite_b=True).T
 
-            # State update as xk + Cp*H'*F^-1*dz
-            dz = z - H.dot(self._xf)
-            self._xa = self._xf + self._Pf.dot(H.T).dot(linalg.solve(F, dz, sym_pos=True, overwrite_b=True))
+            # State update as xk + K*dz
+            dz = z - Hxf
+            self._xa = self._xf + W.dot(linalg.solve_triangular(L, dz, lower=True))
             self._xa = self._xa.ravel()
 
-            # Covariance estimate update as Cp - Cp*H'*F^-1*H*Cp
-            self._Pa = self._Pf - self._Pf.dot(H.T).dot(linalg.solve(F, H.dot(self._Pf), sym_pos=True, overwrite_a=True, overwrite_b=True))
+            # Covariance estimate update as Cp - W*W'. Only the upper triangle is computed by BLAS syrk and mirrored
+            # to the lower one, so the analysis covariance is exactly symmetric even if Cp has drifted from symmetry
+            # during the forecast. The transpose is a C-ordered view holding the result in its lower triangle, which
+            # is copied to the upper one through the flat array
+            self._Pa = np.array(self._Pf, dtype=W.dtype, order='F')
+            syrk, = linalg.get_blas_funcs(('syrk',), (W,))
+            self._Pa = syrk(-1.0, W, beta=1.0, c=self._Pa, lower=False, overwrite_c=True).T
+            upper, lower = self._mirror_indices(n)
+            Pa_flat = self._Pa.reshape(-1)
+            np.put(Pa_flat, upper, np.take(Pa_flat, lower, out=self._scratch_buffer('tri', upper.shape, W.dtype)))
+
+            # Kalman gain in factored form, K*dz = W*(L^-1*dz). Both are backed by scratch buffers and are therefore
+            # only valid until the next call to assimilate()
+            self._gain = (W, L)
         else:
             self._xa = self._xf
             self._Pa = self._Pf
@@ -185,19 +319,87 @@ class KalmanFilter:
 
         Returns: Tuple `(xa, Pa)` containing the state vector and error covariance matrix after the
         update step.
+
+        Note:
+            If smoothing is enabled, the returned covariance matrix is shared with the smoother and must not be
+            modified in-place.
         """
         self._xa = self._xa.ravel()
 
         if self._lag == 0:
             if on_smoother_result is not None: on_smoother_result(self._xa, self._Pa, self._t, result_args)
         else:
-            xa_handle = self._cache.put(self._xa)
-            Pa_handle = self._cache.put(self._Pa)
+            # The state vector is copied since the model propagates it in-place. Covariance computed by assimilate()
+            # is owned by the filter and can be cached without copying. If there were no observations, it is the
+            # forecast given by the caller and must be copied
+            xa_handle = self._smoother_put('xa', self._xa)
+            Pa_handle = self._smoother_put('Pa', self._Pa, take_ownership=self._Pa is not self._Pf)
             self._data.append(KFSmootherData(self._xf_handle, self._Pf_handle, xa_handle, Pa_handle, None, self._t))
 
         return self._xa, self._Pa
 
 
+    def run_linear_batch(self, x0, P0, Q, dt, zs, H, R, steady_state_tol=None, out=None):
+        """
+        Runs the filter over a sequence of analysis steps with constant observation operator and error covariances.
+
+        This is equivalent to calling `forecast()`, `begin_analysis()`, `assimilate()` and `end_analysis()` for each
+        step. If `steady_state_tol` is given and the model is linear and time-invariant, the covariance sequence
+        converges to a steady state independent of the observations. Once the analysis covariance changes by less
+        than `steady_state_tol` (relative to its largest element) between two steps, the Kalman gain is frozen and
+        the remaining steps only propagate and update the state vector, i.e. no covariance matrices are computed.
+
+        Smoothing is not supported, the filter must be created with ``lag=0``.
+
+        Args:
+            x0 : Initial state vector.
+            P0 : Initial error covariance matrix.
+            Q  : Model error covariance matrix. Can be `None` for perfect model.
+            dt : Time increment between the analysis steps. This is simply passed to the model.
+            zs : Array of shape (T, m) of observations, row `t` is assimilated at step `t`.
+            H  : Observation operator.
+            R  : Observation covariance matrix.
+            steady_state_tol : Tolerance for detecting the steady state or ``None`` to never freeze the gain.
+            out : Array of shape (T, n) where analysis state vectors are stored or ``None`` to allocate new one.
+
+        Returns:
+            Tuple `(xa, Pa)` where `xa` is the (T, n) array of analysis state vectors and `Pa` is the analysis error
+            covariance matrix after the last step.
+        """
+        assert self._lag == 0, "run_linear_batch() does not support smoothing"
+        assert steady_state_tol is None or steady_state_tol >= 0
+
+        x = np.array(x0, dtype=np.double).ravel()
+        T = len(zs)
+        if out is None: out = np.empty((T, x.shape[0]))
+        assert out.shape == (T, x.shape[0])
+
+        P = P0
+        gain = None
+        for t in range(T):
+            if gain is None:
+                x, Pf = self.forecast(x, P, Q, dt)
+                self.begin_analysis(x, Pf, t)
+                self.assimilate(zs[t], H, R)
+                x, Pa = self.end_analysis()
+
+                if steady_state_tol is not None and t > 0 and \
+                        np.max(np.abs(Pa - P)) <= steady_state_tol * np.max(np.abs(Pa)):
+                    W, L = self._gain
+                    gain = (W.copy(), L.copy())
+                P = Pa
+
+            else:
+                # Steady state, the model propagates the state in-place
+                self._M(x, dt)
+                dz = zs[t] - H.dot(x)
+                x += gain[0].dot(linalg.solve_triangular(gain[1], dz, lower=True))
+
+            out[t] = x
+
+        return out, P
+
+
     def smoother_finish(self, on_smoother_result, result_args=tuple()):
         """
         Finalizes any pending smoothing solutions and calls `on_smoother_result`.
@@ -219,10 +421,13 @@ class KalmanFilter:
         #_, _, xa_handle, Pa_handle, trj, t = self._data[-1]
 
         # Todo: implement lock-release into ArrayCache!
-        xs = self._cache.get(smd.xa)
-        Ps = self._cache.get(smd.Pa)
-        self._cache.remove(smd.xa)
-        self._cache.remove(smd.Pa)
+        xs = self._smoother_get('xa', smd.xa)
+        Ps = self._smoother_get('Pa', smd.Pa)
+        self._smoother_remove('xa', smd.xa)
+        self._smoother_remove('Pa', smd.Pa)
+
+        # Without a cache these are views of the smoother storage which is reused by the next smoother run
+        if self._cache is None: xs, Ps = np.copy(xs), np.copy(Ps)
 
         on_smoother_result(xs, Ps, smd.t, result_args)
 
@@ -232,23 +437,118 @@ class KalmanFilter:
             #xf_handle, Pf_handle = self._data[k+1][0:2]
             #xa_handle, Pa_handle, trj, t = self._data[k][2:]
 
-            xf = self._cache.get(smdk1.xf)
-            Pf = self._cache.get(smdk1.Pf)
-            xa = self._cache.get(smdk.xa)
-            Pa = self._cache.get(smdk.Pa)
+            xf = self._smoother_get('xf', smdk1.xf)
+            Pf = self._smoother_get('Pf', smdk1.Pf)
+            xa = self._smoother_get('xa', smdk.xa)
+            Pa = self._smoother_get('Pa', smdk.Pa)
 
-            J = linalg.solve(a=Pf, b=self._Mtl(smdk.trj, Pa), assume_a='sym').T
+            n = Pf.shape[0]
+            dtype = np.result_type(xs, Ps, Pf, Pa)
+            xs, Ps = _rts_step(xs, Ps, xf, Pf, xa, Pa, self._Mtl(smdk.trj, Pa), self.forgetting_factor,
+                               self._scratch_buffer('nn', (n, n), dtype), self._scratch_buffer('nn2', (n, n), dtype))
 
-            J*= self.forgetting_factor
+            self._smoother_remove('xf', smdk1.xf)
+            self._smoother_remove('Pf', smdk1.Pf)
+            self._smoother_remove('xa', smdk.xa)
+            self._smoother_remove('Pa', smdk.Pa)
 
-            xs = xa + J.dot(xs - xf)
-            Ps = Pa + J.dot(J.dot(Ps - Pf).T)
+            on_smoother_result(xs, Ps, smdk.t, result_args)
 
-            self._cache.remove(smdk1.xf)
-            self._cache.remove(smdk1.Pf)
-            self._cache.remove(smdk.xa)
-            self._cache.remove(smdk.Pa)
+        # All data has been consumed. The records are dropped and the contiguous storage is kept so that the next
+        # smoother run does not need to allocate it again
+        self._data = []
+        for name, (buf, count) in self._store.items(): self._store[name] = (buf, 0)
 
-            on_smoother_result(xs, Ps, smdk.t, result_args)
 
 
+class RandomWalkKalmanFilter:
+    r"""
+    Kalman Filter for random walk models with constant observation operator and observation error covariance.
+
+    The state evolves as :math:`x_{k+1} = x_k + w_k`, where :math:`w_k` has covariance :math:`dt\,\mathbf{Q}`, and
+    the initial error covariance is :math:`\alpha_0\mathbf{Q}`. Since the observation operator :math:`\mathbf{H}`
+    and covariance :math:`\mathbf{R}` do not change, the generalized eigendecomposition of
+    :math:`\mathbf{H}^T\mathbf{R}^{-1}\mathbf{H}` relative to :math:`\mathbf{Q}` is computed once:
+
+    .. math::
+        \mathbf{V}\mathbf{V}^T = \mathbf{Q}, \quad \mathbf{V}^T\mathbf{H}^T\mathbf{R}^{-1}\mathbf{H}\mathbf{V} =
+        \mathbf{\Lambda}
+
+    In this basis all error covariances are diagonal, i.e. :math:`\mathbf{P} = \mathbf{V}\mathbf{D}\mathbf{V}^T`,
+    and only the diagonal :math:`\mathbf{D}` is updated. The covariance updates are therefore O(n) and the state
+    update is O(n^2 + nm) instead of the O(n^3) of the general :class:`KalmanFilter`.
+
+    Args:
+        H : Observation operator as :class:`endas.ObservationOperator` or matrix of shape (m, n).
+        R : Observation error covariance as :class:`endas.CovarianceOperator` or NumPy array.
+        Q : Model error (system noise) covariance as :class:`endas.CovarianceOperator` or NumPy array.
+    """
+
+    def __init__(self, H, R, Q):
+        H = H.to_matrix(force_dense=True) if hasattr(H, 'to_matrix') else np.asarray(H)
+        H = np.asarray(H, dtype=np.double)
+        Q = cov.to_matrix(Q, force_dense=True)
+        assert H.shape[1] == Q.shape[0]
+
+        if isinstance(R, np.ndarray): RinvH = linalg.solve(R, H, assume_a='pos')
+        elif isinstance(R, CovarianceOperator): RinvH = R.solve(np.array(H))
+        else:
+            raise TypeError("R must be a NumPy array or endas.CovarianceOperator")
+
+        # With Q = G*G' and G'*H'*R^-1*H*G = U*Lambda*U', V = G*U satisfies both V*V' = Q and V'*H'*R^-1*H*V = Lambda
+        G = linalg.cholesky(Q, lower=True)
+        self._lambda, U = linalg.eigh(G.T.dot(H.T.dot(RinvH)).dot(G))
+        np.maximum(self._lambda, 0.0, out=self._lambda)
+        self._V = G.dot(U)
+
+        # Kalman gain is K = V*D*B with B = V'*H'*R^-1
+        self._B = RinvH.dot(self._V).T
+        self._H = H
+        self._x = None
+        self._d = None
+
+
+    def begin(self, x0, alpha0=1.0):
+        """
+        Sets the initial state vector `x0` and error covariance ``alpha0*Q``.
+        """
+        assert alpha0 > 0
+        self._x = np.array(x0, dtype=np.double).ravel()
+        assert self._x.shape[0] == self._V.shape[0]
+        self._d = np.full(len(self._x), float(alpha0))
+
+
+    @property
+    def x(self):
+        """
+        Current state estimate.
+        """
+        return self._x
+
+
+    @property
+    def P(self):
+        """
+        Current error covariance matrix. The dense matrix is formed on each access.
+        """
+        return (self._V * self._d).dot(self._V.T)
+
+
+    def forecast(self, dt=1.0):
+        """
+        Implements the forecast step. The state estimate does not change, the error covariance grows by ``dt*Q``.
+        """
+        self._d += dt
+        return self._x
+
+
+    def assimilate(self, z):
+        """
+        Assimilates the observations `z` and returns the updated state estimate.
+        """
+        # Analysis covariance in information form, D_a = (D_f^-1 + Lambda)^-1
+        self._d = np.reciprocal(np.reciprocal(self._d) + self._lambda)
+
+        dz = z - self._H.dot(self._x)
+        self._x = self._x + self._V.dot(self._d * self._B.dot(dz))
+        return self._x
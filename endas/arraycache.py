@@ -18,27 +18,70 @@ class ArrayCache(object):
     Large data cache is used in situations where keeping all data in memory is likely not going
     to be feasible. Therefore, some data may be persisted to other storage (e.g. disk) for later retrieval.
 
+    Args:
+      pool_size : Maximum number of removed arrays kept for reuse per shape and type. Copies made by `put()` are
+                  placed into these arrays instead of newly allocated ones. Since removed arrays are recycled,
+                  arrays returned by `get()` must not be used after their handle has been removed if this is
+                  greater than zero. Pooling is disabled by default.
+
     Note:
       This implementation is basic and simply stores all data in memory via a Python dictionary. Also,
       it is not thread safe. Use one of subclasses for more suitable behaviour or implement your own.
     """
 
-    def __init__(self):
+    def __init__(self, pool_size=0):
         self._cache = {}
         self._keycounter = 0
+        self._init_pool(pool_size)
+
 
+    def _init_pool(self, pool_size):
+        assert pool_size >= 0
+        self._pool_size = pool_size
+        self._pool = collections.defaultdict(list)
+        self._pooled = set()
 
-    def put(self, data):
+
+    def _copy_data(self, handle, data, take_ownership):
+        """
+        Returns the instance of `data` to store under `handle`. Arrays are copied into a pooled buffer if one is
+        available.
         """
-        Places an object into the cache and returns handle for retrieval. The data is always copied.
+        if take_ownership: return data
+        if not isinstance(data, np.ndarray): return copy.deepcopy(data)
+        if self._pool_size == 0 or type(data) is not np.ndarray: return data.copy()
+
+        free = self._pool[(data.shape, data.dtype)]
+        buf = free.pop() if len(free) > 0 else np.empty_like(data)
+        np.copyto(buf, data)
+        self._pooled.add(handle)
+        return buf
+
+
+    def _release_data(self, handle, data):
+        """
+        Returns array stored under a removed `handle` to the pool if it has been allocated by the cache.
+        """
+        if handle not in self._pooled: return
+        self._pooled.discard(handle)
+        free = self._pool[(data.shape, data.dtype)]
+        if len(free) < self._pool_size: free.append(data)
+
+
+    def put(self, data, take_ownership=False):
+        """
+        Places an object into the cache and returns handle for retrieval. The data is copied unless
+        `take_ownership` is ``True``.
 
         Args:
           data : Data instance to store.
+          take_ownership : If ``True``, the cache stores `data` by reference instead of copying it. The caller must
+                           not modify the instance afterwards.
 
         Returns : Handle object that represents the stored array.
         """
         self._keycounter+= 1
-        self._cache[self._keycounter] = copy.deepcopy(data)
+        self._cache[self._keycounter] = self._copy_data(self._keycounter, data, take_ownership)
         return self._keycounter
 
 
@@ -53,7 +96,7 @@ class ArrayCache(object):
         """
         x = self._cache[handle]
         if not force_copy: return x
-        else: return copy.deepcopy(x)
+        else: return x.copy() if isinstance(x, np.ndarray) else copy.deepcopy(x)
 
 
     def get_exclusive(self, handle):
@@ -90,7 +133,7 @@ class ArrayCache(object):
 
         Returns: ``None``
         """
-        del self._cache[handle]
+        self._release_data(handle, self._cache.pop(handle))
 
     def clear(self):
         """
@@ -99,6 +142,8 @@ class ArrayCache(object):
         """
         self._cache = {}
         self._keycounter = 0
+        self._pool.clear()
+        self._pooled.clear()
 
 
 
@@ -106,24 +151,31 @@ class LRUArrayCache(ArrayCache):
     """
     Data cache that swaps recently used data objects to disk.
 
-    The cache will keep items in memory as long as their combined size os below maxsizeMB. When the
+    The cache will keep items in memory as long as their combined size is below maxsizeMB. When the
     capacity is reached, least recently accessed items are swapped to storage to make space.
 
     This implementation uses file-based storage in the given `tempdir` or system default temp directory
     if `tempdir` is None. Subclasses can override retire(), restore() and drop() to implement other storage
     mechanisms.
 
+    Like in :class:`ArrayCache`, `get()` returns the stored array without copying unless `force_copy` is given.
+    Changes made to it are preserved, i.e. the item is written to storage again when evicted.
+
+    See :class:`ArrayCache` for the meaning of `pool_size`.
+
     # Todo: Implement thread safety at some point.
     """
 
-    def __init__(self, maxsizeMB=1024, tempdir=None):
+    def __init__(self, maxsizeMB=1024, tempdir=None, pool_size=0):
+        self._init_pool(pool_size)
         self._memoryitems = collections.OrderedDict()
         self._retireditems = {}
+        self._retiredmeta = {}
 
         self._keycounter = 0
-        self._memorySizeMB = 0
-        self._retiredSizeMB = 0
-        self._capacityMB = maxsizeMB
+        self._memoryBytes = 0
+        self._retiredBytes = 0
+        self._capacityBytes = maxsizeMB * 1024 * 1024
         self._tempdir = tempdir if tempdir is not None else os.path.join(tempfile.gettempdir(), "dfscache")
 
 
@@ -141,18 +193,18 @@ class LRUArrayCache(ArrayCache):
     def tempdir(self): return self._tempdir
 
 
-    def put(self, data):
+    def put(self, data, take_ownership=False):
         self._keycounter += 1
         datasize = self.itemsize(data)
 
-        #self._logger.debug("Inserting data of size {}MB, assigned key {}".format(datasize, self._keycounter))
+        #self._logger.debug("Inserting data of size {}B, assigned key {}".format(datasize, self._keycounter))
 
 
         # Need to make space for the new data item -> pop last-recently-used item(s) from the dictionary
         self._reservespace(datasize)
 
-        self._memoryitems[self._keycounter] = (copy.deepcopy(data), datasize)
-        self._memorySizeMB+= datasize
+        self._memoryitems[self._keycounter] = (self._copy_data(self._keycounter, data, take_ownership), datasize)
+        self._memoryBytes+= datasize
 
         return self._keycounter
 
@@ -162,20 +214,26 @@ class LRUArrayCache(ArrayCache):
         if handle in self._memoryitems:
             self._memoryitems.move_to_end(handle)
             data, size = next(reversed(self._memoryitems.values())) # Return last item
-            return copy.deepcopy(data)
 
         # Not in memory? Perhaps it's been retired
-        if handle in self._retireditems:
+        elif handle in self._retireditems:
             retired_uuid, retired_size = self._retireditems[handle] # We'll keep it in storage also
             self._reservespace(retired_size)
 
-            #self._logger.debug("Restoring item of size {}MB, key {}, uid {} from storage".format(retired_size, handle, retired_uuid))
+            #self._logger.debug("Restoring item of size {}B, key {}, uid {} from storage".format(retired_size, handle, retired_uuid))
             data = self.restore(retired_uuid)
             self._memoryitems[handle] = (data, retired_size)
-            self._memorySizeMB+= retired_size
-            return copy.deepcopy(data)
+            self._memoryBytes+= retired_size
+
+        else:
+            raise KeyError("Item with handle {} not found in cache".format(handle))
 
-        raise KeyError("Item with handle {} not found in cache".format(handle))
+        if force_copy: return data.copy() if isinstance(data, np.ndarray) else copy.deepcopy(data)
+
+        # The caller gets the stored instance and may modify it, the copy in storage (if any) is now stale and the
+        # item must be retired again when evicted
+        self._dropretired(handle)
+        return data
 
 
     def get_exclusive(self, handle):
@@ -188,30 +246,37 @@ class LRUArrayCache(ArrayCache):
     def remove(self, handle):
         if handle in self._memoryitems:
             data, size = self._memoryitems.pop(handle)
-            #self._logger.debug("Removing item of size {}MB, key {} from memory".format(size, handle))
+            #self._logger.debug("Removing item of size {}B, key {} from memory".format(size, handle))
+            self._release_data(handle, data)
             del data
-            self._memorySizeMB-= size
+            self._memoryBytes-= size
+
+        self._dropretired(handle)
 
+
+    def _dropretired(self, handle):
         if handle in self._retireditems:
             retired_uuid, retired_size = self._retireditems.pop(handle)
-            #self._logger.debug("Removing item of size {}MB, key {}, uuid {} from storage".format(retired_size, handle, retired_uuid))
+            #self._logger.debug("Removing item of size {}B, key {}, uuid {} from storage".format(retired_size, handle, retired_uuid))
 
             try: self.drop(retired_uuid)
-            except: pass
-            self._retiredSizeMB-= retired_size
-            #self._logger.debug("Total occupied storage {}MB".format(self._retiredSizeMB))
+            except FileNotFoundError: pass
+            self._retiredBytes-= retired_size
+            #self._logger.debug("Total occupied storage {}B".format(self._retiredBytes))
 
 
 
     def clear(self):
         self._memoryitems.clear()
-        self._memorySizeMB = 0
+        self._pool.clear()
+        self._pooled.clear()
+        self._memoryBytes = 0
 
         for  retired_uuid, retired_size in self._retireditems.values():
             try: self.drop(retired_uuid)
-            except: pass
+            except FileNotFoundError: pass
         self._retireditems.clear()
-        self._retiredSizeMB = 0
+        self._retiredBytes = 0
 
 
     def __enter__(self): return self
@@ -224,52 +289,64 @@ class LRUArrayCache(ArrayCache):
 
 
     def itemsize(self, data):
-        if isinstance(data, np.ndarray): return data.nbytes // 1024 // 1024
+        """
+        Returns the size of `data` in bytes.
+        """
+        if isinstance(data, np.ndarray): return data.nbytes
         else: raise TypeError("LRUDataCache only supports numpy.ndarray instances.")
 
     def retire(self, data, uid):
+        # Data is stored as raw binary, shape and type are kept in memory so that no header needs to be parsed on
+        # restore
         assert isinstance(data, np.ndarray)
-        tmpfile = os.path.join(self._tempdir, str(uid)+'.npy')
-        np.save(tmpfile, data, allow_pickle=False, fix_imports=False)
+        tmpfile = os.path.join(self._tempdir, str(uid)+'.bin')
+        np.ascontiguousarray(data).tofile(tmpfile)
+        self._retiredmeta[uid] = (data.shape, data.dtype)
 
 
     def restore(self, uid):
-        tmpfile = os.path.join(self._tempdir, str(uid)+'.npy')
-        data = np.load(tmpfile, allow_pickle=False, fix_imports=False)
-        assert isinstance(data, np.ndarray)
-        return data
+        # The data is read into a new array rather than memory-mapped, so that the file can be removed as soon as the
+        # item is dropped even if the restored array is still in use
+        shape, dtype = self._retiredmeta[uid]
+        tmpfile = os.path.join(self._tempdir, str(uid)+'.bin')
+        return np.fromfile(tmpfile, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
 
 
     def drop(self, uid):
-        tmpfile = os.path.join(self._tempdir, str(uid) + '.npy')
+        self._retiredmeta.pop(uid, None)
+        tmpfile = os.path.join(self._tempdir, str(uid) + '.bin')
         os.remove(tmpfile)
 
 
-    def _reservespace(self, sizeMB):
+    def _reservespace(self, sizeBytes):
+
+        #self._logger.debug("Free memory space {}B, need {}B".format(
+        #  max(self._capacityBytes - self._memoryBytes, 0),
+        #  sizeBytes))
 
-        #self._logger.debug("Free memory space {}MB, need {}MB".format(
-        #  max(self._capacityMB - self._memorySizeMB, 0),
-        #  sizeMB))
+        if self._memoryBytes + sizeBytes <= self._capacityBytes: return
 
-        while self._memorySizeMB + sizeMB > self._capacityMB and len(self._memoryitems) > 0:
+        while self._memoryBytes + sizeBytes > self._capacityBytes and len(self._memoryitems) > 0:
             lruitem_key, lruitem_value = self._memoryitems.popitem(last=False)
             lruitem_data, lruitem_size = lruitem_value
 
             if lruitem_key not in self._retireditems:
                 retired_uuid = uuid.uuid4()
-                #self._logger.debug("Retiring item of size {}MB, key {} to storage with uid {}".format(
+                #self._logger.debug("Retiring item of size {}B, key {} to storage with uid {}".format(
                 #  lruitem_size, lruitem_key, retired_uuid))
 
                 self.retire(lruitem_data, retired_uuid)
                 self._retireditems[lruitem_key] = (retired_uuid, lruitem_size)
-                self._retiredSizeMB+= lruitem_size
-                #self._logger.debug("Total occupied storage {}MB".format(self._retiredSizeMB))
+                self._retiredBytes+= lruitem_size
+                #self._logger.debug("Total occupied storage {}B".format(self._retiredBytes))
 
             #else:
-            #self._logger.debug("Retiring item of size {}MB, key {}, already in storage".format(
+            #self._logger.debug("Retiring item of size {}B, key {}, already in storage".format(
             #  lruitem_size, lruitem_key))
 
+            # The evicted array may still be referenced by the caller of get(), it must not be pooled
+            self._pooled.discard(lruitem_key)
             del lruitem_data
-            self._memorySizeMB -= lruitem_size
+            self._memoryBytes -= lruitem_size
 
 
@@ -175,10 +175,13 @@ class DenseCovariance(CovarianceOperator):
     Args:
         C : Square NumPy matrix or array representing the covariance matrix.
 
+    The Cholesky factor of the matrix is cached, therefore the matrix must not be modified after the instance has been
+    created. The matrix returned by ``to_matrix()`` is a read-only view.
     """
 
     def __init__(self, C):
         self._C = np.asarray(C)
+        self._C_factor = None
 
     @property
     def shape(self): return self._C.shape
@@ -200,11 +203,20 @@ class DenseCovariance(CovarianceOperator):
 
 
     def solve(self, b, overwrite_b=False):
-        return linalg.solve(self._C, b, sym_pos=True, overwrite_b=overwrite_b)
+        # The Cholesky factorization is computed on first use and reused by subsequent calls
+        if self._C_factor is None: self._C_factor = linalg.cho_factor(self._C)
+        return linalg.cho_solve(self._C_factor, b, overwrite_b=overwrite_b)
 
 
-    def to_matrix(self, **_ignored):
-        return self._C
+    def to_matrix(self, force_dense=False, out=None):
+        if out is not None:
+            assert out.shape == self.shape
+            np.copyto(out, self._C)
+            return out
+
+        C = self._C.view()
+        C.flags.writeable = False
+        return C
 
     def add_to(self, x):
         np.add(x, self._C, out=x)
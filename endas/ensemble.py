@@ -4,7 +4,9 @@ Basic utility functions for working with ensembles.
 
 import math
 import numpy as np
-from scipy import linalg, sparse
+from scipy import linalg
+
+from endas import _kernels
 
 
 def mean(A):
@@ -27,9 +29,9 @@ def to_anomaly(E, Eu=None, normalize=False, out=None):
     Returns: NxM array of anomalies
     """
     n, m = E.shape
-    if Eu is None: Eu = np.mean(E, axis=1)
+    if Eu is None: A = _kernels.center_rows(E, out=out)
+    else:          A = np.subtract(E, Eu.reshape(n, 1), out=out)
 
-    A = np.subtract(E, Eu.reshape(n, 1), out=out)
     if normalize: np.divide(A, math.sqrt(m - 1), out=A)
     return A
 
@@ -50,20 +52,14 @@ def center(E, out=None):
     """
     Adjusts the ensemble to zero mean.
     """
-    u = np.mean(E, axis=1).reshape(E.shape[0], 1)
-    return np.subtract(E, u, out=out)
+    return _kernels.center_rows(E, out=out)
 
 
 def standardize(E, out=None):
     """
     Adjusts the ensemble to zero mean and standard deviation of 1.
     """
-    u = np.mean(E, axis=1).reshape(-1, 1)
-    E = np.subtract(E, u, out=out)
-
-    sd = np.std(E, axis=1).reshape(-1, 1)
-    E = np.divide(E, sd, out=out)
-    return E
+    return _kernels.standardize_rows(E, out=out)
 
 
 def inflate(A, inflation,  Au = None, out=None):
@@ -123,19 +119,17 @@ def optimal_resample(E, alpha=1):
         Y = np.random.standard_normal(size=(N, N))
         Q, R = linalg.qr(Y, overwrite_a=True)
 
-        Rdiag = np.diagonal(R, 0)
-        Xdiag = Rdiag / np.fabs(Rdiag)
-        X = np.diag(np.reciprocal(Xdiag), 0)
-        Q = Q.dot(X)
+        # Fix signs so that Q is uniformly distributed, this multiplies columns of Q by the signs of diag(R). Zero
+        # diagonal entries must not zero the corresponding columns
+        signs = np.sign(np.diagonal(R, 0))
+        signs[signs == 0] = 1.0
+        np.multiply(Q, signs, out=Q)
         Q = Q[0:N, :]
 
-        # Note: This implements S Q^T where S is diagonal matrix made from `sdiag`.
-        # Avoiding use of scipy.sparse here as it is slow for this!
-        #sQT = np.multiply(Q.T, sdiag.reshape(-1, 1))
-
-        s = sparse.diags(sdiag)
-        #E2 = U.dot(sQT)
-        E2 = U.dot(s.dot(Q.T))
+        # Note: This implements U S Q^T where S is diagonal matrix made from `sdiag`, scaling columns of U is
+        # much faster than scipy.sparse
+        np.multiply(U, sdiag, out=U)
+        E2 = U.dot(Q.T)
         return E2
 
     # Todo: Should do something about this case also!
@@ -4,6 +4,7 @@ Localization of the analysis update.
 """
 
 from abc import ABCMeta, abstractmethod
+import numpy as np
 
 from . import domain
 from .domain import *
@@ -99,6 +100,31 @@ class CoordinateSystem(metaclass=ABCMeta):
         pass
 
 
+    def distance_pairwise(self, A, B, out=None):
+        """
+        Computes distances between all pairs of points from sets A and B.
+
+        Args:
+            A   : n x ndim array of coordinates of ``n`` points
+            B   : m x ndim array of coordinates of ``m`` points
+            out : Existing array of shape (n, m) where the result should be stored, if possible. If ``None`` is given,
+                  new array is allocated.
+
+        Returns:
+            Array of shape (n, m), where element (i, j) is the distance between ``A[i]`` and ``B[j]``.
+
+        The default implementation calls ``distance()`` for each point in ``A``. Implementations may override this
+        with a more efficient algorithm. The result may then differ from ``distance()`` by rounding errors.
+        """
+        n, m = A.shape[0], B.shape[0]
+        if out is None: out = np.empty((n, m), dtype=np.double)
+        else: assert out.shape == (n, m)
+
+        for i in range(n):
+            out[i, :] = self.distance(A[i:i+1], B)
+        return out
+
+
 
 class SpatialQuery(metaclass=ABCMeta):
     """
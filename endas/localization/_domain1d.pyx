@@ -0,0 +1,56 @@
+"""
+Observation selection kernels for :class:`endas.localization.GenericStateSpace1d`.
+"""
+
+import numpy as np
+import cython
+
+
+ctypedef fused zcoord_t:
+    long long
+    double
+
+
+# Returns index of the first element in `z[lo:hi]` that is greater than `v` (if `inclusive` is False) or greater or
+# equal to `v` (if `inclusive` is True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t _bisect(zcoord_t[::1] z, double v, Py_ssize_t lo, Py_ssize_t hi, bint inclusive) nogil:
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if z[mid] < v or (not inclusive and z[mid] == v): lo = mid + 1
+        else: hi = mid
+    return lo
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def local_obs_1d(zcoord_t[::1] z_sorted not None, Py_ssize_t[::1] order not None, Py_ssize_t domain_id, double r):
+    """
+    Selects observations strictly within distance `r` from `domain_id`.
+
+    Args:
+        z_sorted  : Sorted observation coordinates
+        order     : Indexes of the sorted coordinates in the observation vector
+        domain_id : Index (coordinate) of the domain
+        r         : Search radius
+
+    Returns:
+        Tuple ``(selected, dist)`` of the indexes of the selected observations and their distances from the domain.
+    """
+    cdef Py_ssize_t n = z_sorted.shape[0]
+    cdef Py_ssize_t lo = _bisect(z_sorted, domain_id - r, 0, n, False)
+    cdef Py_ssize_t hi = _bisect(z_sorted, domain_id + r, lo, n, True)
+    cdef Py_ssize_t k
+
+    selected = np.empty(hi - lo, dtype=np.intp)
+    dist = np.empty(hi - lo, dtype=np.double)
+    cdef Py_ssize_t[::1] sel_view = selected
+    cdef double[::1] dist_view = dist
+
+    for k in range(hi - lo):
+        sel_view[k] = order[lo + k]
+        dist_view[k] = abs(<double>z_sorted[lo + k] - domain_id)
+
+    return selected, dist
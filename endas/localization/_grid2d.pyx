@@ -0,0 +1,52 @@
+"""
+Observation selection kernels for :class:`endas.localization.grid.Grid2d`.
+"""
+
+import numpy as np
+import cython
+from libc.math cimport sqrt
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def select_within_2d(double[:,:] z_coords not None, Py_ssize_t[::1] candidates not None, double cx, double cy,
+                     double r):
+    """
+    Selects candidate observations strictly within Euclidean distance `r` from point (`cx`, `cy`).
+
+    Args:
+        z_coords   : Coordinates of all observations as (m, 2) array
+        candidates : Indexes of candidate observations
+        cx, cy     : Coordinates of the point
+        r          : Search radius
+
+    Returns:
+        Tuple ``(selected, dist)`` of the indexes of the selected observations and their distances from the point.
+
+    Candidates are compared by squared distance and square roots are only taken for the selected ones.
+    """
+    cdef Py_ssize_t n = candidates.shape[0]
+    cdef Py_ssize_t i, j, k = 0
+    cdef double dx, dy, d2, d
+    cdef double r2 = r*r
+
+    selected = np.empty(n, dtype=np.intp)
+    dist = np.empty(n, dtype=np.double)
+    cdef Py_ssize_t[::1] sel_view = selected
+    cdef double[::1] dist_view = dist
+
+    with nogil:
+        for i in range(n):
+            j = candidates[i]
+            dx = cx - z_coords[j, 0]
+            dy = cy - z_coords[j, 1]
+            d2 = dx*dx + dy*dy
+            if d2 < r2:
+                # Rounding in the square root may still give exactly r
+                d = sqrt(d2)
+                if d < r:
+                    sel_view[k] = j
+                    dist_view[k] = d
+                    k += 1
+
+    return selected[:k], dist[:k]
@@ -49,12 +49,7 @@ cdef class BBox2d:
         """
         Deep copy of the bounding box.
         """
-        cdef BBox2d bb = BBox2d.__new__(BBox2d)
-        bb.x = self.x
-        bb.y = self.y
-        bb.xend = self.xend
-        bb.yend = self.yend
-        return bb
+        return BBox2d.__new__(BBox2d, self.x, self.y, self.xend, self.yend)
 
     cpdef void inflate(self, double dx, double dy):
         self.x -= dx
@@ -117,12 +112,7 @@ cdef class BBox2i:
         """
         Deep copy of the bounding box.
         """
-        cdef BBox2i bb = BBox2i.__new__(BBox2i)
-        bb.x = self.x
-        bb.y = self.y
-        bb.xend = self.xend
-        bb.yend = self.yend
-        return bb
+        return BBox2i.__new__(BBox2i, self.x, self.y, self.xend, self.yend)
 
     cpdef void inflate(self, int dx, int dy):
         self.x -= dx
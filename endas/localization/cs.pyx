@@ -6,7 +6,7 @@ __all__ = ['EuclideanCS', 'LatLonCS']
 
 import numpy as np
 import cython
-from libc.math cimport sqrt, sin, cos, asin
+from libc.math cimport sqrt, sin, cos, asin, fabs
 
 from . import CoordinateSystem
 
@@ -31,11 +31,11 @@ class EuclideanCS(CoordinateSystem):
         assert ndim >= 1
         self._ndim = ndim
 
-
-        #if self.ndim == 1: self._fn = self._distance_1d
-        #elif self.ndim == 2: self._fn = self._distance_2d
-        #elif self.ndim == 3: self._fn = self._distance_3d
-        #elif self.ndim == 4: self._fn = self._distance_Nd
+        # Select the distance kernel for our dimensionality once instead of on every distance() call
+        if ndim == 1: self._fn = self._distance_1d
+        elif ndim == 2: self._fn = self._distance_2d
+        elif ndim == 3: self._fn = self._distance_3d
+        else: self._fn = self._distance_Nd
 
     @property
     def ndim(self): return self._ndim
@@ -59,27 +59,69 @@ class EuclideanCS(CoordinateSystem):
             assert out.ndim == 1
             assert out.size == n
 
-        if self.ndim == 1: self._distance_1d(A.ravel(), B.ravel(), out)
-        elif self.ndim == 2: self._distance_2d(A, B, out)
-        elif self.ndim == 3: self._distance_3d(A, B, out)
-        else: self._distance_Nd(A, B, out)
-
+        self._fn(A, B, out)
         return out
 
 
+    def distance_pairwise(self, A, B, out=None):
+        assert A.shape[1] == self.ndim
+        assert B.shape[1] == self.ndim
+        A = np.asarray(A, dtype=np.double)
+        B = np.asarray(B, dtype=np.double)
+
+        if out is None:
+            out = np.empty((A.shape[0], B.shape[0]), dtype=np.double)
+        else:
+            assert out.shape == (A.shape[0], B.shape[0])
+
+        # Squared distances are expanded as |a|^2 + |b|^2 - 2ab so that the bulk of the work is a single matrix product.
+        # Both point sets are first shifted to a common origin near the points to limit the cancellation for points
+        # far from the origin. The absolute error of the squared distances is still proportional to the squared extent
+        # of the shifted points, i.e. of the order of eps * max(|a|^2, |b|^2)
+        As, Bs = A, B
+        if A.shape[0] > 0:
+            origin = A.mean(axis=0)
+            As = A - origin
+            Bs = B - origin
+
+        Asq = np.einsum('ij,ij->i', As, As)
+        Bsq = np.einsum('ij,ij->i', Bs, Bs)
+        np.dot(As, Bs.T, out=out)
+        out *= -2.0
+        out += Asq[:, None]
+        out += Bsq[None, :]
+
+        # Squared distances that are small relative to the norms are dominated by the cancellation, these are
+        # recomputed directly from the original coordinates. This only concerns (nearly) coinciding points
+        if out.size > 0:
+            i, j = np.nonzero(out < 1e-12 * (Asq.max() + Bsq.max()))
+            if len(i) > 0:
+                D = A[i] - B[j]
+                out[i, j] = np.einsum('ij,ij->i', D, D)
+
+        return np.sqrt(out, out=out)
+
+
+    # The kernels below compute the distance in a single pass without temporary arrays. Coordinates of a single point
+    # in `A` are loaded once outside the loop. The GIL is released so that distances can be computed from several
+    # threads concurrently
+
     # One-dimensional case
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.cdivision(True)
-    def _distance_1d(self, coord_t[::1] A, coord_t[::1] B, double[::1] out):
+    def _distance_1d(self, coord_t[:,::1] A not None, coord_t[:,::1] B not None, double[::1] out not None):
         cdef int n = B.shape[0]
         cdef int i
-        if A.shape[0] == 1:
-            for i in range(n):
-                out[i] = abs(A[0] - B[i])
-        else:
-            for i in range(n):
-                out[i] = abs(A[i] - B[i])
+        cdef double ax
+        with nogil:
+            if A.shape[0] == 1:
+                ax = A[0,0]
+                for i in range(n):
+                    out[i] = fabs(ax - B[i,0])
+            else:
+                for i in range(n):
+                    out[i] = fabs(<double>A[i,0] - B[i,0])
 
 
     # Two-dimensional case
@@ -89,12 +131,20 @@ class EuclideanCS(CoordinateSystem):
     def _distance_2d(self, coord_t[:,::1] A not None, coord_t[:,::1] B not None, double[::1] out not None):
         cdef int n = B.shape[0]
         cdef int i
-        if A.shape[0] == 1:
-            for i in range(n):
-                out[i] = sqrt( (A[0,0] - B[i,0])**2 + (A[0,1] - B[i,1])**2 )
-        else:
-            for i in range(n):
-                out[i] = sqrt( (A[i,0] - B[i,0])**2 + (A[i,1] - B[i,1])**2 )
+        cdef double ax, ay, dx, dy
+        with nogil:
+            if A.shape[0] == 1:
+                ax = A[0,0]
+                ay = A[0,1]
+                for i in range(n):
+                    dx = ax - B[i,0]
+                    dy = ay - B[i,1]
+                    out[i] = sqrt(dx*dx + dy*dy)
+            else:
+                for i in range(n):
+                    dx = <double>A[i,0] - B[i,0]
+                    dy = <double>A[i,1] - B[i,1]
+                    out[i] = sqrt(dx*dx + dy*dy)
 
     # Three-dimensional case
     @cython.boundscheck(False)
@@ -103,12 +153,23 @@ class EuclideanCS(CoordinateSystem):
     def _distance_3d(self, coord_t[:,::1] A not None, coord_t[:,::1] B not None, double[::1] out not None):
         cdef int n = B.shape[0]
         cdef int i
-        if A.shape[0] == 1:
-            for i in range(n):
-                out[i] = sqrt( (A[0,0] - B[i,0])**2 + (A[0,1] - B[i,1])**2 + (A[0,2] - B[i,2])**2 )
-        else:
-            for i in range(n):
-                out[i] = sqrt( (A[i,0] - B[i,0])**2 + (A[i,1] - B[i,1])**2 + (A[i,2] - B[i,2])**2)
+        cdef double ax, ay, az, dx, dy, dz
+        with nogil:
+            if A.shape[0] == 1:
+                ax = A[0,0]
+                ay = A[0,1]
+                az = A[0,2]
+                for i in range(n):
+                    dx = ax - B[i,0]
+                    dy = ay - B[i,1]
+                    dz = az - B[i,2]
+                    out[i] = sqrt(dx*dx + dy*dy + dz*dz)
+            else:
+                for i in range(n):
+                    dx = <double>A[i,0] - B[i,0]
+                    dy = <double>A[i,1] - B[i,1]
+                    dz = <double>A[i,2] - B[i,2]
+                    out[i] = sqrt(dx*dx + dy*dy + dz*dz)
 
 
     # Generic N-dimensional case
@@ -118,34 +179,29 @@ class EuclideanCS(CoordinateSystem):
     def _distance_Nd(self, coord_t[:,::1] A not None, coord_t[:,::1] B not None, double[::1] out not None):
         cdef int n = B.shape[0]
         cdef int N = B.shape[1]
-        cdef int i
-        cdef double sum_sq
-        if A.shape[0] == 1:
+        cdef int i, j, ai
+        cdef double sum_sq, d
+        with nogil:
             for i in range(n):
+                ai = 0 if A.shape[0] == 1 else i
                 sum_sq = 0.0
-                for j in range(N): sum_sq += (A[0,j] - B[i,j])**2
-                out[i] = sqrt(sum_sq)
-        else:
-            for i in range(n):
-                sum_sq = 0.0
-                for j in range(N): sum_sq += (A[i,j] - B[i,j])**2
+                for j in range(N):
+                    d = <double>A[ai,j] - B[i,j]
+                    sum_sq += d*d
                 out[i] = sqrt(sum_sq)
 
 
 
 
-# Haversine formula for great circle distance on sphere
+# Haversine formula for great circle distance on sphere. Latitudes are given in radians together with their cosines,
+# the longitude difference is given in radians too
 @cython.cdivision(True)
-cdef inline double haversine(double Alat, double Alon, double Blat, double Blon, double R) nogil:
-    Alat*= 0.0174532925 # Conversion to radians
-    Blat*= 0.0174532925
-    Alon*= 0.0174532925
-    Blon*= 0.0174532925
-
-    cdef double a = sin((Alat - Blat) / 2.0)**2 + cos(Alat) * cos(Blat) * sin((Alon - Blon) / 2.0)**2
+cdef inline double haversine(double Alat, double cosAlat, double Blat, double cosBlat, double dlon, double R) nogil:
+    cdef double s1 = sin((Alat - Blat) / 2.0)
+    cdef double s2 = sin(dlon / 2.0)
+    cdef double a = s1*s1 + cosAlat * cosBlat * s2*s2
     if a > 1.0: a = 1.0
-    a = 2.0 * asin(sqrt(a))
-    return a * R
+    return 2.0 * asin(sqrt(a)) * R
 
 
 class LatLonCS(CoordinateSystem):
@@ -189,24 +245,30 @@ class LatLonCS(CoordinateSystem):
             assert out.ndim == 1
             assert out.size == n
 
-        cdef int i
-        cdef double Alat, Blat, Alon, Blon
-        cdef double dfif_lat, diff_lon
-        cdef double a
-
-        cdef double[:,::1] A_view = A
-        cdef double[:,::1] B_view = B
-        cdef double[::1] out_view = out
-        cdef double R = self.R
-
-        if A_view.shape[0] == 1:
-            for i in range(n):
-                out_view[i] = haversine(A_view[0, 0], A_view[0, 1], B_view[i, 0], B_view[i, 1], R)
-        else:
-            for i in range(n):
-                out_view[i] = haversine(A_view[i, 0], A_view[i, 1], B_view[i, 0], B_view[i, 1], R)
-
+        self._distance(A, B, out, self.R)
         return out
 
 
-
+    # The distance is computed in a single pass, for a single point in `A` the trigonometric functions of its latitude
+    # are evaluated only once
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def _distance(self, double[:,::1] A not None, double[:,::1] B not None, double[::1] out not None, double R):
+        cdef int n = B.shape[0]
+        cdef int i
+        cdef double Alat, cosAlat, Blat
+        cdef double deg2rad = 0.0174532925
+
+        with nogil:
+            if A.shape[0] == 1:
+                Alat = A[0, 0] * deg2rad
+                cosAlat = cos(Alat)
+                for i in range(n):
+                    Blat = B[i, 0] * deg2rad
+                    out[i] = haversine(Alat, cosAlat, Blat, cos(Blat), (A[0, 1] - B[i, 1]) * deg2rad, R)
+            else:
+                for i in range(n):
+                    Alat = A[i, 0] * deg2rad
+                    Blat = B[i, 0] * deg2rad
+                    out[i] = haversine(Alat, cos(Alat), Blat, cos(Blat), (A[i, 1] - B[i, 1]) * deg2rad, R)
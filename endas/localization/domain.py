@@ -8,8 +8,11 @@ __all__ = [
 
 from abc import ABCMeta, abstractmethod
 import math
+import multiprocessing
+import threading
 import numpy as np
 import endas.localization
+from ._domain1d import local_obs_1d
 
 
 
@@ -50,6 +53,22 @@ class StateSpacePartitioning(metaclass=ABCMeta):
         pass
 
 
+    def get_local_observations_batch(self, z_coords, taper_fn):
+        """
+        Locates observations to be used for local analysis of all domains.
+
+        Args:
+            z_coords     : Abstract description of the locations of observations in the observation vector.
+            taper_fn     : Tapering function that defines the localization radius.
+        Returns:
+            List of ``(z_local, d)`` tuples, one for each domain, see ``get_local_observations()``.
+
+        The default implementation calls ``get_local_observations()`` for each domain. Implementations can override
+        this to locate the observations for all domains at once, for example with a single spatial index query.
+        """
+        return [self.get_local_observations(di, z_coords, taper_fn) for di in range(self.num_domains)]
+
+
     @abstractmethod
     def get_local_state_size(self, domain_id):
         """
@@ -82,6 +101,21 @@ class StateSpacePartitioning(metaclass=ABCMeta):
         """
         pass
 
+    def get_local_state_indices(self, domain_id):
+        """
+        Returns the indexes of global state vector elements that form the local state vector of the given domain.
+
+        Args:
+            domain_id : Index of the domain whose state vector indexes should be returned. Domain indexes start at 0.
+        Returns:
+            Flat integer array ``i`` such that ``xg[i]`` equals ``get_local_state(domain_id, xg)``, or ``None``.
+
+        Implementing this method is optional, the default implementation returns ``None``. If the indexes are available
+        for all domains, the local states can be gathered from (and scattered back to) the global state with a single
+        indexing operation instead of calling ``get_local_state()`` and ``put_local_state()`` for each domain.
+        """
+        return None
+
 
 class GenericStateSpace1d(StateSpacePartitioning):
     """
@@ -109,6 +143,7 @@ class GenericStateSpace1d(StateSpacePartitioning):
     def __init__(self, n):
         assert n > 0
         self._n = n
+        self._sorted_obs = (None, None, None)
 
 
     @property
@@ -116,33 +151,63 @@ class GenericStateSpace1d(StateSpacePartitioning):
         # Under this scheme each state variable has its own local domain
         return self._n
 
+    def _sort_observations(self, z_coords, rebuild=False):
+        """
+        Returns ``(order, sorted_z)`` where ``sorted_z = z_coords[order]`` is sorted. The result is kept for as long as
+        coordinates equal to `z_coords` are passed, unless `rebuild` is ``True``. A copy of the coordinates is kept
+        for the comparison so that arrays modified in place are detected.
+        """
+        cached = self._sorted_obs[0]
+        if rebuild or cached is None or not np.array_equal(cached, z_coords):
+            order = np.argsort(z_coords, kind='stable').astype(np.intp, copy=False)
+            # Coordinates are stored in one of the types supported by the selection kernel
+            dtype = np.longlong if np.issubdtype(z_coords.dtype, np.integer) else np.double
+            self._sorted_obs = (z_coords.copy(), order, np.ascontiguousarray(z_coords[order], dtype=dtype))
+        return self._sorted_obs[1:]
+
+
     def get_local_observations(self, domain_id, z_coords, taper_fn):
         assert isinstance(z_coords, np.ndarray)
-        assert domain_id >= 0 and domain_id <= self.num_domains
+        assert 0 <= domain_id < self._n
+
+        r = int(math.ceil(taper_fn.support_range))
+        order, sorted_z = self._sort_observations(z_coords)
+
+        # Observations strictly within the support range are selected, those at distance r would get zero weight
+        return local_obs_1d(sorted_z, order, domain_id, r)
+
+
+    def get_local_observations_batch(self, z_coords, taper_fn):
+        assert isinstance(z_coords, np.ndarray)
 
         r = int(math.ceil(taper_fn.support_range))
+        order, sorted_z = self._sort_observations(z_coords, rebuild=True)
 
-        d_min = max(0, domain_id - r)
-        d_max = min(self._n, domain_id + r)
-        selected = np.where((z_coords > d_min) & (z_coords < d_max))[0]
+        # Observation ranges of all domains are located at once
+        domains = np.arange(self._n)
+        lo = np.searchsorted(sorted_z, domains - r, 'right')
+        hi = np.searchsorted(sorted_z, domains + r, 'left')
 
-        selcoords = z_coords[selected]
-        dist = np.abs(np.subtract(selcoords, domain_id), dtype=np.double)
-        return selected, dist
+        return [(order[lo[di]:hi[di]], np.abs(np.subtract(sorted_z[lo[di]:hi[di]], di), dtype=np.double))
+                for di in range(self._n)]
 
 
     def get_local_state_size(self, domain_id):
-        assert domain_id >= 0 and domain_id <= self.num_domains
+        assert 0 <= domain_id < self._n
         return 1
 
     def get_local_state(self, domain_id, xg):
-        assert domain_id >= 0 and domain_id <= self.num_domains
+        assert 0 <= domain_id < self._n
         return xg[domain_id]
 
     def put_local_state(self, domain_id, xl, xg):
-        assert domain_id >= 0 and domain_id <= self.num_domains
+        assert 0 <= domain_id < self._n
         xg[domain_id] = xl
 
+    def get_local_state_indices(self, domain_id):
+        assert 0 <= domain_id < self._n
+        return np.array([domain_id])
+
 
 
 
@@ -178,6 +243,11 @@ class DomainLocalization:
         assert isinstance(ssp, StateSpacePartitioning)
         self._ssp = ssp
         self._taper_fn = None
+
+        # Vector of ones and output array for the tapering weights of a domain. The buffers are only grown when a
+        # larger domain is seen and are kept per thread, since get_local_R() may be called from for_each_domain()
+        # callbacks running concurrently
+        self._taper_bufs = threading.local()
         if taper_fn is not None: self.set_taper_fn(taper_fn)
 
 
@@ -233,11 +303,171 @@ class DomainLocalization:
         assert len(obs_used) == len(obs_dist)
 
         # We need to select a subset of the observation error covariance for the selected observations and apply the
-        # tapering function to it.
-
-        taper = np.ones(len(obs_dist), dtype=np.double)
-        self._taper_fn.taper(taper, obs_dist, out=taper)
+        # tapering function to it. The tapering weights are obtained by tapering a vector of ones
+        ones, out = self._taper_buffers(len(obs_dist))
+        taper = self._taper_fn.taper(ones, obs_dist, out=out)
 
         return Rg.localize(obs_used, taper)
 
 
+    def _taper_buffers(self, n):
+        """
+        Returns vector of ones and output array of length `n` for computing tapering weights, backed by the buffers
+        of the calling thread.
+        """
+        bufs = self._taper_bufs
+        ones = getattr(bufs, 'ones', None)
+        if ones is None or len(ones) < n:
+            size = n if ones is None else max(n, 2 * len(ones))
+            bufs.ones = ones = np.ones(size, dtype=np.double)
+            bufs.out = np.empty(size, dtype=np.double)
+        return ones[:n], bufs.out[:n]
+
+
+    def get_local_R_batch(self, Rg, local_obs):
+        """
+        Returns localized observation error covariance operators for all domains.
+
+        Args:
+            Rg        : Global observation error covariance operator
+            local_obs : List of ``(obs_used, obs_dist)`` tuples, one for each domain, as returned by
+                        ``StateSpacePartitioning.get_local_observations_batch()``
+
+        Returns:
+            List of localized observation error covariance operators, ``None`` for domains without observations.
+
+        The tapering weights for all domains are computed with a single call of the tapering function.
+        """
+        sizes = np.array([len(obs_used) if obs_used is not None else 0 for obs_used, _ in local_obs], dtype=np.intp)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.intp)
+        np.cumsum(sizes, out=offsets[1:])
+
+        m = offsets[-1]
+        result = [None] * len(local_obs)
+        if m == 0: return result
+
+        all_dist = np.concatenate([obs_dist for (obs_used, obs_dist), size in zip(local_obs, sizes) if size > 0])
+        all_dist = np.asarray(all_dist, dtype=np.double)
+        ones, out = self._taper_buffers(m)
+        taper = self._taper_fn.taper(ones, all_dist, out=out)
+
+        for di, (obs_used, obs_dist) in enumerate(local_obs):
+            if sizes[di] == 0: continue
+            assert len(obs_used) == len(obs_dist)
+            result[di] = Rg.localize(obs_used, taper[offsets[di]:offsets[di+1]])
+
+        return result
+
+
+    def for_each_domain(self, callback, z_coords, executor=None):
+        """
+        Calls `callback` for each local domain.
+
+        Args:
+            callback : Callable invoked as ``callback(domain_id, obs_used, obs_dist)``, where ``obs_used`` and
+                       ``obs_dist`` are the observations located for the domain by the state space partitioning
+            z_coords : Observation coordinates, see ``StateSpacePartitioning.get_local_observations()``
+            executor : Executor used to run the callbacks in parallel, or ``None`` to run them sequentially. Any
+                       :class:`concurrent.futures.Executor` can be used.
+
+        Returns:
+            List of values returned by `callback`, one for each domain in the order of domain indexes.
+
+        Observations for all domains are located at once before any callback is invoked. Since the domains are
+        independent, the callbacks may be executed concurrently if an executor is given. With a
+        ``ThreadPoolExecutor`` this scales well as long as the callback spends most of its time in NumPy/LAPACK code
+        that releases the GIL.
+        """
+        assert self._taper_fn is not None
+        local_obs = self._ssp.get_local_observations_batch(z_coords, self._taper_fn)
+        assert len(local_obs) == self._ssp.num_domains
+
+        if executor is None:
+            return [callback(di, obs_used, obs_dist) for di, (obs_used, obs_dist) in enumerate(local_obs)]
+
+        obs_used, obs_dist = zip(*local_obs) if len(local_obs) > 0 else ((), ())
+        return list(executor.map(callback, range(len(local_obs)), obs_used, obs_dist))
+
+
+    def run_parallel(self, xg, z_coords, analysis_fn, n_proc=None):
+        """
+        Runs local analyses of all domains in worker processes.
+
+        Args:
+            xg          : Global state vector or ensemble (ensemble members stored in columns)
+            z_coords    : Observation coordinates, see ``StateSpacePartitioning.get_local_observations()``
+            analysis_fn : Callable invoked as ``analysis_fn(domain_id, xl, obs_used, obs_dist)`` that returns the
+                          updated local state ``xl``. Must be picklable, e.g. a module-level function.
+            n_proc      : Number of worker processes, defaults to the number of CPUs
+
+        Returns:
+            New global state vector or ensemble with the local analyses written back.
+
+        The global state is copied to shared memory once, so workers read their local states without the state being
+        pickled for each domain. Updated local states are written to a second shared array. Domains are split into
+        ``n_proc`` contiguous chunks, one task per chunk. If local domains overlap (e.g. due to padding), the value
+        written by the domain processed last is kept and this order is not deterministic.
+
+        Worker processes are started with the "spawn" method, so the state space partitioning is pickled and must not
+        hold any unpicklable resources. This is only worthwhile if the local analyses do a lot of work in Python code
+        that holds the GIL, otherwise ``for_each_domain()`` with a ``ThreadPoolExecutor`` avoids the overhead.
+
+        Requires Python 3.8 or newer, where ``multiprocessing.shared_memory`` is available.
+        """
+        # Imported here so that the module can still be imported on Python versions before 3.8
+        from multiprocessing import shared_memory
+
+        assert self._taper_fn is not None
+        local_obs = self._ssp.get_local_observations_batch(z_coords, self._taper_fn)
+        num_domains = len(local_obs)
+        xg = np.asarray(xg)
+
+        if n_proc is None: n_proc = multiprocessing.cpu_count()
+        n_proc = max(1, min(n_proc, num_domains))
+
+        shm_in = shared_memory.SharedMemory(create=True, size=max(xg.nbytes, 1))
+        shm_out = shared_memory.SharedMemory(create=True, size=max(xg.nbytes, 1))
+        try:
+            np.ndarray(xg.shape, dtype=xg.dtype, buffer=shm_in.buf)[...] = xg
+            xa = np.ndarray(xg.shape, dtype=xg.dtype, buffer=shm_out.buf)
+            xa[...] = xg
+
+            bounds = np.linspace(0, num_domains, n_proc + 1).astype(int)
+            tasks = [(shm_in.name, shm_out.name, xg.shape, xg.dtype, self._ssp, analysis_fn,
+                      range(bounds[i], bounds[i+1]), local_obs[bounds[i]:bounds[i+1]]) for i in range(n_proc)]
+
+            with multiprocessing.get_context('spawn').Pool(n_proc) as pool:
+                pool.map(_run_domains, tasks)
+
+            result = xa.copy()
+            del xa
+            return result
+
+        finally:
+            for shm in (shm_in, shm_out):
+                shm.close()
+                shm.unlink()
+
+
+
+def _run_domains(task):
+    """
+    Worker of ``DomainLocalization.run_parallel()``, runs local analyses for a chunk of domains.
+    """
+    from multiprocessing import shared_memory
+
+    shm_in_name, shm_out_name, shape, dtype, ssp, analysis_fn, domains, local_obs = task
+    shm_in = shared_memory.SharedMemory(name=shm_in_name)
+    shm_out = shared_memory.SharedMemory(name=shm_out_name)
+    try:
+        xg = np.ndarray(shape, dtype=dtype, buffer=shm_in.buf)
+        xa = np.ndarray(shape, dtype=dtype, buffer=shm_out.buf)
+
+        for di, (obs_used, obs_dist) in zip(domains, local_obs):
+            xl = np.array(ssp.get_local_state(di, xg))
+            ssp.put_local_state(di, analysis_fn(di, xl, obs_used, obs_dist), xa)
+
+        del xg, xa
+    finally:
+        shm_in.close()
+        shm_out.close()
@@ -7,12 +7,20 @@ __all__ = ['Grid2d']
 import numpy as np
 import math
 import array
+from scipy.spatial import cKDTree
 
 from . import SpatialQuery, TaperFn
-from .bbox import BBox2i
+from .bbox import BBox2d
+from .cs import EuclideanCS
+from ._grid2d import select_within_2d
 from . import StateSpacePartitioning
 
 
+# Largest number of domain-observation pairs for which Grid2d computes all pairwise distances instead of querying
+# the k-d tree
+_MAX_PAIRWISE_SIZE = 2**20
+
+
 class Grid2d(StateSpacePartitioning):
     """
     Organizes state vector elements on a two-dimensional grid.
@@ -55,77 +63,210 @@ class Grid2d(StateSpacePartitioning):
     def __init__(self, nx, ny, extent, cs, mask=None, block_size=1, padding=0):
         self._nx = nx
         self._ny = ny
-        self._mask = mask
-        self._extent = extent
-        self._cellsize = extent.size / (nx, ny)
+        self._mask = None
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.ndim != 1:
+                raise ValueError("mask must be a flat array")
+            if len(mask) > 0 and (mask.min() < 0 or mask.max() >= nx * ny):
+                raise ValueError("mask contains indexes of cells outside the grid")
+            self._mask = mask
+
+        # State vector elements sorted by the index of their grid cell. The order is computed once here so that each
+        # row of a block can be looked up as a contiguous range of it. State vector indexes are stored as 32-bit
+        # integers unless the state is too large for it
+        n = nx * ny if mask is None else len(mask)
+        index_type = np.int32 if n <= np.iinfo(np.int32).max else np.int64
+        if mask is None:
+            self._cell_order = np.arange(n, dtype=index_type)
+            self._sorted_cells = self._cell_order
+        else:
+            self._cell_order = np.argsort(mask, kind='stable').astype(index_type)
+            self._sorted_cells = mask[self._cell_order]
+
+        self._extent = extent if extent is not None else BBox2d(0, 0, nx, ny)
+        self._cellsize = np.array((self._extent.sizex() / nx, self._extent.sizey() / ny))
         self._cs = cs
+        self._euclid2d = isinstance(cs, EuclideanCS) and cs.ndim == 2
 
         self._bs = block_size
         self._pad = padding
-        self._domains = None
+        self._boxes = None
+        self._num_domains = 0
+        self._svec_offsets = None
+        self._svec_flat = None
+        self._centres = None
+        self._xl_scratch = None
+        self._r_cache = (None, None)
+        self._obs_index = (None, None)
         self._generate_domains()
 
 
     def _generate_domains(self):
-        if self._domains is None:
-            self._domains = []
-
-            allcells = np.arange(self._ny*self._nx).reshape(self._ny, self._nx)
-            full_bbox = BBox2i(0, 0, self._nx+1, self._ny+1)
-
-            for y in range(0, self._ny, self._bs):
-                for x in range(0, self._nx, self._bs):
-
-                    d_box = BBox2i(x, y, x + self._bs, y + self._bs).intersect(full_bbox)
-                    d_box_padded = d_box.copy()
-                    d_box_padded.inflate(self._pad, self._pad)
-                    d_box_padded.intersect(full_bbox)
-
-                    # Select cells and corresponding variables from the state vector that are inside this block
-                    d_cells = allcells[d_box_padded.y:d_box_padded.yend, d_box_padded.x:d_box_padded.xend]
-                    d_svec = d_cells.ravel()[self._mask] if self._mask is not None else d_cells.ravel()
-
-                    #Todo: Precompute blending mask for the padded region
-
-                    if len(d_svec) > 0:
-                        self._domains.append((d_box, d_svec))
-
-        return self._domains
-
-
-    def num_domains(self): return len(self._domains)
+        # Domains are stored as arrays: the (D,4) array of domain extents (x, y, xend, yend) in grid cells, the
+        # state vector indexes of all domains concatenated into a flat array with offsets of each domain in it and
+        # the (D,2) array of domain centres
+        if self._boxes is None:
+            nx, ny, bs, pad = self._nx, self._ny, self._bs, self._pad
+
+            # Extents of all blocks, clipped to the grid. Blocks are ordered row by row
+            y0, x0 = np.meshgrid(np.arange(0, ny, bs), np.arange(0, nx, bs), indexing='ij')
+            x0 = x0.ravel()
+            y0 = y0.ravel()
+            x1 = np.minimum(x0 + bs, nx)
+            y1 = np.minimum(y0 + bs, ny)
+
+            # Padded blocks define which cells are included in each local domain
+            px0 = np.maximum(x0 - pad, 0)
+            py0 = np.maximum(y0 - pad, 0)
+            px1 = np.minimum(x1 + pad, nx)
+            py1 = np.minimum(y1 + pad, ny)
+
+            # Each row of a padded block is a contiguous range of the state vector elements sorted by cell
+            order = self._cell_order
+            cells = self._sorted_cells
+
+            rows_per_block = py1 - py0
+            block_of_row = np.repeat(np.arange(len(x0)), rows_per_block)
+            row_y = np.arange(len(block_of_row)) - np.repeat(np.cumsum(rows_per_block) - rows_per_block, rows_per_block)
+            row_y += py0[block_of_row]
+            lo = np.searchsorted(cells, row_y * nx + px0[block_of_row], 'left')
+            hi = np.searchsorted(cells, row_y * nx + px1[block_of_row], 'left')
+
+            # Concatenation of all ranges gives the state vector elements of all blocks
+            row_counts = hi - lo
+            svec_flat = order[np.arange(row_counts.sum()) -
+                              np.repeat(np.cumsum(row_counts) - row_counts - lo, row_counts)]
+            block_sizes = np.bincount(block_of_row, weights=row_counts, minlength=len(x0)).astype(np.intp)
+
+            #Todo: Precompute blending mask for the padded region
+
+            # Blocks without any state vector elements are not local domains
+            keep = block_sizes > 0
+            self._boxes = np.column_stack((x0, y0, x1, y1))[keep].astype(np.int32)
+            self._num_domains = len(self._boxes)
+            self._svec_offsets = np.zeros(np.count_nonzero(keep) + 1, dtype=np.intp)
+            np.cumsum(block_sizes[keep], out=self._svec_offsets[1:])
+            self._svec_flat = svec_flat
+            self._max_svec_len = int(block_sizes.max()) if len(block_sizes) > 0 else 0
+
+            # Centres of all domains in "real-world" coordinates
+            self._centres = np.empty((len(self._boxes), 2), dtype=np.float64)
+            self._centres[:, 0] = (self._boxes[:, 0] + self._boxes[:, 2]) / 2.0 * self._cellsize[0] + self._extent.x
+            self._centres[:, 1] = (self._boxes[:, 1] + self._boxes[:, 3]) / 2.0 * self._cellsize[1] + self._extent.y
+
+
+    @property
+    def num_domains(self): return self._num_domains
+
+
+    def _support_range(self, taper_fn):
+        # Search radius is cached for the last seen taper function. The exact support range is used, observations at
+        # larger distances would be given zero weight
+        if self._r_cache[0] is not taper_fn:
+            self._r_cache = (taper_fn, float(taper_fn.support_range))
+        return self._r_cache[1]
+
+
+    def _to_index_coords(self, coords):
+        """
+        Returns `coords` in the space in which the observation index is built. For non-cartesian (i.e. lat/lon)
+        coordinate systems, points are mapped onto the unit sphere so that the chord distance can be used.
+        """
+        if self._cs.is_cartesian: return coords
+        lat = np.radians(coords[:, 0])
+        lon = np.radians(coords[:, 1])
+        coslat = np.cos(lat)
+        return np.column_stack((coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)))
+
+
+    def _index_range(self, r, slack=False):
+        """
+        Returns the search radius in the observation index space that includes all points within distance `r`. If
+        `slack` is ``True``, the radius is slightly inflated to guard against rounding errors.
+        """
+        # Great circle distance is converted to chord length on the unit sphere, this is always done with slack. Exact
+        # distances are computed for the candidates anyway
+        if not self._cs.is_cartesian:
+            r = 2.0 * math.sin(min(r / self._cs.R, math.pi) / 2.0)
+            slack = True
+        return r * (1.0 + 1e-9) + 1e-12 if slack else r
+
+
+    def _pairwise_error(self, z_coords, r):
+        """
+        Returns upper bound of the error of distances around `r` computed by ``distance_pairwise()`` between the domain
+        centres and `z_coords`.
+        """
+        # The distances are computed by expanding |a|^2 + |b|^2 - 2ab with the points shifted to the mean of the domain
+        # centres. The absolute error of the squared distances is bounded by a small multiple of eps * max(|a|^2, |b|^2)
+        # (a generous factor is used here), which perturbs a distance d by at most min(sqrt(e), e / 2d)
+        if len(z_coords) == 0: return 0.0
+        origin = self._centres.mean(axis=0)
+        max_sq = max(np.max(np.sum((self._centres - origin)**2, axis=1)),
+                     np.max(np.sum((z_coords - origin)**2, axis=1)))
+        e = 64.0 * np.finfo(np.double).eps * max_sq
+        return min(math.sqrt(e), e / r) if r > 0 else math.sqrt(e)
+
+
+    def _ensure_obs_index(self, z_coords, rebuild=False):
+        """
+        Returns k-d tree built from the observation coordinates `z_coords`. The tree is kept for as long as coordinates
+        equal to `z_coords` are passed so that queries for consecutive domains share it, unless `rebuild` is ``True``.
+        A copy of the coordinates is kept for the comparison so that arrays modified in place are detected.
+        """
+        cached = self._obs_index[0]
+        if rebuild or cached is None or not np.array_equal(cached, z_coords):
+            self._obs_index = (z_coords.copy(), cKDTree(self._to_index_coords(z_coords)))
+        return self._obs_index[1]
+
+
+    def _select_candidates(self, d_centre_coord, z_coords, candidates, r):
+        # Exact distances are only computed for observations returned by the spatial index
+        candidates = np.asarray(candidates, dtype=np.intp)
+        candidates.sort()
+
+        # The common 2-D Euclidean case is handled by a dedicated kernel that reads the candidates directly from
+        # `z_coords` and only takes square roots for the selected ones
+        if self._euclid2d and z_coords.dtype == np.double:
+            return select_within_2d(z_coords, candidates, d_centre_coord[0, 0], d_centre_coord[0, 1], r)
+
+        dist = self._cs.distance(d_centre_coord, np.ascontiguousarray(z_coords[candidates]))
+        inside = dist < r
+        return candidates[inside], dist[inside]
+
+
+    @staticmethod
+    def _check_z_coords(z_coords):
+        if z_coords.ndim != 2:
+            raise ValueError("z_coords must be two-dimensional array")
+        if z_coords.shape[1] != 2:
+            raise ValueError("z_coords array must be of shape (n,2)")
 
 
     def get_local_observations(self, domain_id, z_coords, taper_fn):
 
-        assert domain_id >= 0 and domain_id <= self.num_domains
-        d_box, _ = self._domains[domain_id]
+        assert 0 <= domain_id < self._num_domains
 
         # Centre of the domain in "real-world" coordinates
-        d_centre_coord = np.array((d_box.centerx() * self._cellsize + self._extent.x,
-                                   d_box.centery() * self._cellsize + self._extent.y)).reshape(1,-1)
+        d_centre_coord = self._centres[domain_id:domain_id+1]
 
-        r = int(math.ceil(taper_fn.support_range))
+        r = self._support_range(taper_fn)
 
         # Grid2d allows the use of SpatialQuery or plain observation coordinates in `z_coords`. In the former
-        # case the spatial index is used to find observations near the local domain. In the latter case a
-        # brute-force search is done
+        # case the spatial index is used to find observations near the local domain. In the latter case a k-d tree
+        # is built from the observation coordinates and shared by queries for all domains
         if isinstance(z_coords, np.ndarray):
-            if z_coords.ndim != 2:
-                raise ValueError("z_coords must be two-dimensional array")
-            if z_coords.shape[1] != 2:
-                raise ValueError("z_coords array must be of shape (n,2)")
-            m = z_coords[0]
-
-            dist = self._cs.distance(d_centre_coord, z_coords)
-            selected = np.where(dist < r)[0]
-            dist = dist[selected]
-            return selected, dist
+            self._check_z_coords(z_coords)
+            tree = self._ensure_obs_index(z_coords)
+            candidates = tree.query_ball_point(self._to_index_coords(d_centre_coord)[0], self._index_range(r))
+            return self._select_candidates(d_centre_coord, z_coords, candidates, r)
 
         # Assume z_coords is a SpatialQuery instance
         elif isinstance(z_coords, SpatialQuery):
             selected, dist = z_coords.range_query(d_centre_coord, r, distances=True)
-            return selected, dist
+            inside = dist < r
+            return selected[inside], dist[inside]
 
         elif z_coords is None:
             raise ValueError("z_coords cannot be None")
@@ -133,19 +274,58 @@ class Grid2d(StateSpacePartitioning):
             raise TypeError("z_coords is of unsupported type")
 
 
+    def get_local_observations_batch(self, z_coords, taper_fn):
+        if not isinstance(z_coords, np.ndarray):
+            return super().get_local_observations_batch(z_coords, taper_fn)
+
+        self._check_z_coords(z_coords)
+        r = self._support_range(taper_fn)
+
+        # For a small number of domains and observations, the distances between all domain centres and observations
+        # are computed at once. Otherwise a single k-d tree query gives candidate observations for all domains
+        if self._cs.is_cartesian and self.num_domains * len(z_coords) <= _MAX_PAIRWISE_SIZE:
+            D = self._cs.distance_pairwise(self._centres, z_coords)
+            r_cand = self._index_range(r + self._pairwise_error(z_coords, r), slack=True)
+            all_candidates = [np.flatnonzero(D[di] < r_cand) for di in range(len(D))]
+        else:
+            tree = self._ensure_obs_index(z_coords, rebuild=True)
+            all_candidates = tree.query_ball_point(self._to_index_coords(self._centres), self._index_range(r))
+
+        return [self._select_candidates(self._centres[di:di+1], z_coords, candidates, r)
+                for di, candidates in enumerate(all_candidates)]
+
+
     def get_local_state_size(self, domain_id):
-        assert domain_id >= 0 and domain_id <= self.num_domains
-        return len(self._domains[domain_id][1])
+        assert 0 <= domain_id < self._num_domains
+        return int(self._svec_offsets[domain_id+1] - self._svec_offsets[domain_id])
 
 
     def get_local_state(self, domain_id, xg):
-        assert domain_id >= 0 and domain_id <= self.num_domains
-        raise NotImplementedError()
+        """
+        Returns local state vector (or ensemble) for the given domain.
+
+        The returned array is an internal buffer that is reused by subsequent calls, it is only valid until the next
+        call to ``get_local_state()`` and must be copied if it needs to be kept.
+        """
+        assert 0 <= domain_id < self._num_domains
+        d_svec = self._svec_flat[self._svec_offsets[domain_id]:self._svec_offsets[domain_id+1]]
+
+        # The buffer is sized for the largest domain so that it is allocated only once for each ensemble shape
+        shape = (self._max_svec_len,) + xg.shape[1:]
+        if self._xl_scratch is None or self._xl_scratch.shape != shape or self._xl_scratch.dtype != xg.dtype:
+            self._xl_scratch = np.empty(shape, dtype=xg.dtype)
+
+        return np.take(xg, d_svec, axis=0, out=self._xl_scratch[:len(d_svec)])
 
 
     def put_local_state(self, domain_id, xl, xg):
-        assert domain_id >= 0 and domain_id <= self.num_domains
-        raise NotImplementedError()
+        assert 0 <= domain_id < self._num_domains
+        xg[self._svec_flat[self._svec_offsets[domain_id]:self._svec_offsets[domain_id+1]]] = xl
+
+
+    def get_local_state_indices(self, domain_id):
+        assert 0 <= domain_id < self._num_domains
+        return self._svec_flat[self._svec_offsets[domain_id]:self._svec_offsets[domain_id+1]]
 
 
 
@@ -9,7 +9,20 @@ import numpy as np
 import cython
 
 
-__all__ = ['GaspariCohn', 'Linear', 'Spherical']
+__all__ = ['GaspariCohn', 'Linear', 'Spherical', 'Tabulated']
+
+
+# Polynomial coefficients of the two Gaspari-Cohn branches in increasing order of degree. The second branch also has
+# the -2/(3r) term, which is added separately.
+cdef double _GC_P1[6]
+cdef double _GC_P2[6]
+_GC_P1[:] = [1.0,  0.0, -5/3.0, 5/8.0,  1/2.0, -1/4.0]
+_GC_P2[:] = [4.0, -5.0,  5/3.0, 5/8.0, -1/2.0, 1/12.0]
+
+
+# Evaluates polynomial of degree 5 given by coefficients `c` at `r` using the Horner's scheme
+cdef inline double _poly5(const double* c, double r) nogil:
+    return c[0] + r*(c[1] + r*(c[2] + r*(c[3] + r*(c[4] + r*c[5]))))
 
 
 class GaspariCohn(TaperFn):
@@ -64,12 +77,15 @@ class GaspariCohn(TaperFn):
         cdef double L = self._L
         cdef int n = x_view.shape[0]
         cdef int i
-        cdef double r
-        for i in range(n):
-            r = d_view[i] / L
-            if r < 1: out_view[i] = x_view[i] * (1.0 - (5/3.0)*r**2 + (5/8.0)*r**3 + (1/2.0)*r**4 - (1/4.0)*r**5)
-            elif r < 2: out_view[i] = x_view[i] * (4.0 - 5.0*r + (5/3.0)*r**2 + (5/8.0)*r**3 - (1/2.0)*r**4 + (1/12.0)*r**5 - 2.0/(3.0*r))
-            else: out_view[i] = 0
+        cdef double r, w1, w2
+        with nogil:
+            for i in range(n):
+                # Both branches are evaluated and the result selected without branching, distances are clamped at the
+                # support range so that the second branch is always finite
+                r = min(d_view[i] / L, 2.0)
+                w1 = _poly5(_GC_P1, r)
+                w2 = _poly5(_GC_P2, r) - 2.0/(3.0*max(r, 1.0))
+                out_view[i] = x_view[i] * (w1 if r < 1.0 else w2) * (r < 2.0)
 
         return out
 
@@ -85,7 +101,7 @@ class Linear(TaperFn):
         self._L = L
 
     @property
-    def supportrange(self): return self._L
+    def support_range(self): return self._L
 
 
     @cython.boundscheck(False)
@@ -107,10 +123,10 @@ class Linear(TaperFn):
         cdef int n = x_view.shape[0]
         cdef int i
         cdef double r
-        for i in range(n):
-            r = d_view[i] / L
-            if r < 1.0: out_view[i] = x_view[i] * 1.0 - r
-            else: out_view[i] = 0
+        with nogil:
+            for i in range(n):
+                r = min(d_view[i] / L, 1.0)
+                out_view[i] = x_view[i] * (1.0 - r)
 
         return out
 
@@ -126,7 +142,7 @@ class Spherical(TaperFn):
 
       G(r) =
       \\begin{cases}
-        \\left( 1 - \\left( \\frac{2}{3}\\frac{r}{L} - \\frac{1}{2}\\frac{r}{L}^3 \\right) \\right) & \\mbox{if } r < L \\\\
+        1 - \\frac{3}{2}\\frac{r}{L} + \\frac{1}{2}\\left(\\frac{r}{L}\\right)^3 & \\mbox{if } r < L \\\\
         0  & \\mbox{otherwise}
       \end{cases}
 
@@ -139,7 +155,7 @@ class Spherical(TaperFn):
         self._L = L
 
     @property
-    def supportrange(self): return self._L
+    def support_range(self): return self._L
 
 
     @cython.boundscheck(False)
@@ -161,11 +177,76 @@ class Spherical(TaperFn):
         cdef int n = x_view.shape[0]
         cdef int i
         cdef double r
-        for i in range(n):
-            r = d_view[i] / L
-            if r < 1.0: out_view[i] = x_view[i] * 1.0 - (1.5*r - 0.5*r**3)
-            else: out_view[i] = 0
+        with nogil:
+            for i in range(n):
+                r = min(d_view[i] / L, 1.0)
+                out_view[i] = x_view[i] * (1.0 - r*(1.5 - 0.5*r*r))
 
         return out
 
 
+
+
+
+class Tabulated(TaperFn):
+    """
+    Tapering function evaluated from a lookup table.
+
+    The wrapped tapering function is sampled at ``size`` regularly spaced distances between zero and its support
+    range once at construction. Tapering weights are then linearly interpolated from the table, which replaces
+    evaluation of the tapering function by two table lookups per element. This is useful for tapering functions that
+    are expensive to evaluate, e.g. those implemented in Python.
+
+    Args:
+        taper_fn : Tapering function to tabulate, must be an instance of :class:`endas.localization.TaperFn`
+        size     : Number of samples in the lookup table, must be at least 2
+
+    The weights are stored in double precision. Quantizing them further would turn small but non-zero weights into
+    zeros, which changes which observations effectively take part in the analysis.
+    """
+
+    def __init__(self, taper_fn, size=1024):
+        assert isinstance(taper_fn, TaperFn)
+        assert size >= 2
+        self._range = float(taper_fn.support_range)
+        assert self._range > 0
+
+        self._lut = np.empty(size + 1, dtype=np.double)
+        taper_fn.taper(np.ones(size), np.linspace(0.0, self._range, size), out=self._lut[:size])
+
+        # The table is padded so that interpolation at the support range does not read past its end. The weight is
+        # zero at the support range and beyond
+        self._lut[size-1:] = 0.0
+
+    @property
+    def support_range(self): return self._range
+
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def taper(self, x, d, out=None):
+        assert isinstance(x, np.ndarray)
+        assert isinstance(d, np.ndarray)
+        assert x.ndim == 1
+        assert d.ndim == 1
+        assert len(x) == len(d)
+
+        if out is None: out = np.empty(len(x), dtype=np.double)
+
+        cdef double[:] x_view = x
+        cdef double[:] d_view = d
+        cdef double[:] out_view = out
+        cdef double[::1] lut = self._lut
+        cdef int size = lut.shape[0] - 1
+        cdef double scale = (size - 1) / self._range
+        cdef int n = x_view.shape[0]
+        cdef int i, k
+        cdef double t
+        with nogil:
+            for i in range(n):
+                t = min(d_view[i] * scale, size - 1.0)
+                k = <int>t
+                out_view[i] = x_view[i] * (lut[k] + (t - k) * (lut[k+1] - lut[k]))
+
+        return out
@@ -6,10 +6,32 @@ Currently only the matrix wrapper operator is implemented.
 
 
 import numpy as np
+from scipy import sparse
 
 from . import ObservationOperator
 
 
+def _find_selected_states(H):
+    """
+    Returns the array of state vector indexes selected by the observation operator matrix `H` if it is a row-selection
+    matrix (i.e. each row contains exactly one non-zero element equal to one), ``None`` otherwise.
+    """
+    if sparse.issparse(H):
+        Hc = sparse.csr_matrix(H, copy=True)
+        Hc.eliminate_zeros()
+        if np.all(np.diff(Hc.indptr) == 1) and np.all(Hc.data == 1):
+            return Hc.indices.astype(np.intp)
+        return None
+
+    H = np.asarray(H)
+    if H.ndim != 2: return None
+    nz = H != 0
+    if not np.all(np.count_nonzero(nz, axis=1) == 1): return None
+    sel = np.argmax(nz, axis=1)
+    return sel if np.all(H[np.arange(H.shape[0]), sel] == 1) else None
+
+
+
 class MatrixObservationOp(ObservationOperator):
     """
     Wraps (sparse) matrices as observation operators.
@@ -20,10 +42,14 @@ class MatrixObservationOp(ObservationOperator):
     Args:
         H : Observation operator given as matrix.
 
+    If ``H`` is a row-selection matrix, i.e. each observation is a direct observation of a single state variable, this
+    is detected and ``dot()`` is implemented by selecting the observed elements of the state vector instead of the
+    matrix product.
     """
 
     def __init__(self, H):
         self._h = H
+        self._sel = _find_selected_states(H)
 
 
     @property
@@ -35,16 +61,28 @@ class MatrixObservationOp(ObservationOperator):
 
 
     def localize(self, selected):
-        return MatrixObservationOp(self._h[selected,:])
+        if self._sel is None: return MatrixObservationOp(self._h[selected,:])
+
+        # Subset of a row-selection matrix is a row-selection matrix again, no need to detect it
+        Hl = MatrixObservationOp.__new__(MatrixObservationOp)
+        Hl._h = self._h[selected,:]
+        Hl._sel = self._sel[selected]
+        return Hl
+
+
+    @property
+    def selected_states(self): return self._sel
 
 
     def dot(self, x, out=None):
-        if isinstance(self._h, np.ndarray): return self._h.dot(x, out=out)
+        if self._sel is not None: return np.take(x, self._sel, axis=0, out=out)
+        elif isinstance(self._h, np.ndarray): return self._h.dot(x, out=out)
         else:                               return self._h.dot(x)
 
 
     def to_matrix(self, force_dense=False, out=None):
-        return self._h if not force_dense else np.asarray(self._h)
+        if not force_dense: return self._h
+        return self._h.toarray() if sparse.issparse(self._h) else np.asarray(self._h)
 
 
 
@@ -53,8 +53,9 @@ obs_skip = 6
 # Smoother lag as the number of time steps. Lag 0 disables smoothing (i.e. only the filtering solution is obtained)
 lag = 50
 
-# Model is the Lorenz-95 dynamic system
-model = lorenz.Lorenz95(n)
+# Model is the Lorenz-95 dynamic system. Single precision is plenty for the model integration here, the errors are
+# well below the model and observation noise. Use np.double when comparing against reference results
+model = lorenz.Lorenz95(n, dtype=np.float32)
 
 # Set up localization implementation. For this synthetic case we will use the generic 1d partitioning of the state
 # space and the Gaspari-Cohn function with correlation length 2 for distance-based observation covariance tapering.
@@ -111,6 +112,9 @@ x0[20] = 8.004        # Perturb 20-th coordinate
 
 xt, yobs = make_data(model_fn=model.__call__, x0=x0, dt=dt, H=H, Q=Q, R=R, nsteps=n_steps, nspin=0)
 
+# Time steps at which observations are assimilated
+obs_mask = np.arange(n_steps) % obs_skip == 0
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Ready to run...
@@ -130,16 +134,28 @@ def on_result(x, A, t, args):
 # purposefully not very good
 x0 = np.ones(n)
 A0 = ensemble.generate(N, x0, P0)
+P0_mat = P0.to_matrix(force_dense=True)
+
+# Working buffers for the initial ensemble and covariance, reused by all runs below
+A_buf = np.empty_like(A0)
+P_buf = np.empty((n, n))
 
 # Run all Ensemble Kalman Filters/Smoothers
 
+# The ensemble forecast does not need the model trajectory, so the arrays of the previous one are reused in each step
+ensemble_trj = None
+def ensemble_model(A, dt):
+    global ensemble_trj
+    ensemble_trj = model(A, dt, trajectoryout=ensemble_trj)
+
 for kfi, (name, enkf) in enumerate(enkfs):
     print("Running {}...".format(name))
 
     # Avoid non-deterministic output for testing
     np.random.seed(1234)
 
-    A = np.copy(A0)
+    A = A_buf
+    np.copyto(A, A0)
     # Before the time stepping loop starts, let the smother know the initial system state. This way we will get
     # a smoother solution for it as well.
     enkf.smoother_begin(A, 0)
@@ -149,13 +165,13 @@ for kfi, (name, enkf) in enumerate(enkfs):
 
         # Integrate the system state forward using the model. In this synthetic example we will use the forecast()
         # method to simplify the code
-        A = enkf.forecast(model.__call__, A, Q, dt)
+        A = enkf.forecast(ensemble_model, A, Q, dt)
 
         # Assimilate observations. Please note that we need to call begin_analysis() and end_analysis() even if
         # we do not have any observations. If we didn't, we would not get the smoother solution for these time steps.
         enkf.begin_analysis(A, t)
 
-        if t % obs_skip == 0: enkf.assimilate(z=yobs[:, t], H=H, R=R, z_coords=observedStates)
+        if obs_mask[t]: enkf.assimilate(z=yobs[:, t], H=H, R=R, z_coords=observedStates)
 
         A = enkf.end_analysis(on_smoother_result=on_result, result_args=(kfi, True))
 
@@ -171,7 +187,8 @@ print("Running KF...")
 np.random.seed(1234)
 
 x = np.copy(x0)
-P = P0.to_matrix(force_dense=True)
+P = P_buf
+np.copyto(P, P0_mat)
 
 kf.smoother_begin(x, P, 0)
 
@@ -180,7 +197,7 @@ for t in range(1, n_steps):
     x, P = kf.forecast(x, P, Q, dt)
 
     kf.begin_analysis(x, P, t)
-    if t % obs_skip == 0: kf.assimilate(z=yobs[:, t], H=H, R=R)
+    if obs_mask[t]: kf.assimilate(z=yobs[:, t], H=H, R=R)
     x, P = kf.end_analysis(on_smoother_result=on_result, result_args=(-1, False))
 
 kf.smoother_finish(on_smoother_result=on_result, result_args=(-1, False))
@@ -196,7 +213,8 @@ xall2 = np.zeros((n_steps, n))
 rmse2 = np.zeros((n_steps, n))
 
 x = np.copy(x0)
-P = P0.to_matrix(force_dense=True)
+P = P_buf
+np.copyto(P, P0_mat)
 QQ = Q.to_matrix(force_dense=True)
 
 HH = H.to_matrix(force_dense=True)
@@ -211,7 +229,7 @@ for t in range(1, n_steps):
 
 
     # Update
-    if t % obs_skip == 0:
+    if obs_mask[t]:
         F = HH.dot(P).dot(HH.T)
 
         if isinstance(R, np.ndarray):
@@ -221,13 +239,15 @@ for t in range(1, n_steps):
 
         z = yobs[:, t]
 
+        F_factor = linalg.cho_factor(F, lower=True, overwrite_a=True)
+
         # State update as xk + Cp*H'*F^-1*dz
         dz = z - HH.dot(x)
-        x += P.dot(HH.T).dot(linalg.solve(F, dz, sym_pos=True, overwrite_b=True))
+        x += P.dot(HH.T).dot(linalg.cho_solve(F_factor, dz, overwrite_b=True))
         #self._xa = self._xa.ravel()
 
         # Covariance estimate update as Cp - Cp*H'*F^-1*H*Cp
-        P -= P.dot(HH.T).dot(linalg.solve(F, HH.dot(P), sym_pos=True, overwrite_a=True, overwrite_b=True))
+        P -= P.dot(HH.T).dot(linalg.cho_solve(F_factor, HH.dot(P), overwrite_b=True))
 
     xall2[t, :] = x
     rmse2[t, :] = np.diagonal(P).ravel()
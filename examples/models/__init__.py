@@ -11,13 +11,72 @@ import numpy as np
 
 
 
-class CompositeTrajectory(list):
+class EnsembleTrajectory:
   """
-  Class used by the EvolutionOperator implementation to store multiple individual
-  model trajectories. Derives from list and is meant to just be a collection of
-  trajectory instances.
+  Class used by the EvolutionOperator implementation to store the trajectories of
+  multiple ensemble members. The trajectories are stored as a struct of arrays: each
+  array attribute of the member trajectories is stacked into a single array whose first
+  axis is the member index. Attributes that are identical for all members (such as the
+  time step) are stored once and shared, any other attributes (including arrays whose
+  shapes differ between members) are kept as a list with one value per member.
+
+  Indexing the instance returns the trajectory of a single member, with stacked array
+  attributes being views into the stacked arrays.
   """
-  pass
+
+  def __init__(self, trajectories):
+    trajectories = list(trajectories)
+    assert len(trajectories) > 0
+
+    self.trajectory_type = type(trajectories[0])
+    self.arrays = {}
+    self.shared = {}
+    self.per_member = {}
+    for name, _ in _trajectory_fields(trajectories[0]):
+      values = [getattr(trj, name) for trj in trajectories]
+
+      if all(_identical(values[0], v) for v in values[1:]):
+        self.shared[name] = values[0]
+      elif all(isinstance(v, np.ndarray) and v.shape == values[0].shape for v in values):
+        self.arrays[name] = np.stack(values)
+      else:
+        self.per_member[name] = values
+
+    self._size = len(trajectories)
+
+
+  def __len__(self):
+    return self._size
+
+
+  def __getitem__(self, m):
+    trj = object.__new__(self.trajectory_type)
+    for name, value in self.shared.items(): setattr(trj, name, value)
+    for name, value in self.arrays.items(): setattr(trj, name, value[m])
+    for name, values in self.per_member.items(): setattr(trj, name, values[m])
+    return trj
+
+
+
+# Returns True if `a` and `b` are the same object or equal non-array values
+def _identical(a, b):
+  if a is b: return True
+  if isinstance(a, np.ndarray) or isinstance(b, np.ndarray): return False
+  try:
+    return type(a) is type(b) and bool(a == b)
+  except Exception:
+    return False
+
+
+
+# Returns (name, value) pairs of all attributes of the trajectory instance `trj`
+def _trajectory_fields(trj):
+  if hasattr(trj, '__dict__'):
+    yield from vars(trj).items()
+
+  for cls in type(trj).__mro__:
+    for name in getattr(cls, '__slots__', ()):
+      if hasattr(trj, name): yield name, getattr(trj, name)
 
 
 
@@ -65,8 +124,9 @@ class EvolutionOperator(ABC):
     Subclasses must implement this method at least for M = 1.
     The default implementation handles the case of M > 1 by calling this method for each
     column of `x` individually and can therefore be used form the subclass as a convenience.
-    The individual (sub)model trajectories are then joined together and returned as a
-    CompositeTrajectory instance.
+    The individual (sub)model trajectories are then joined together and returned as an
+    EnsembleTrajectory instance. Ensembles are expected to be Fortran-ordered so that each
+    member is contiguous in memory; other arrays are converted and the result copied back.
     """
 
     N, M = x.shape
@@ -75,12 +135,16 @@ class EvolutionOperator(ABC):
     # Subclasses may (should) do better than this
     if M > 1:
 
-      T = CompositeTrajectory() if isinstance(self, LinearizedEvolutionOperator) else None
-      for m in range(M):
-        trj = self(x[:,m], dt)
-        if T: T.append(trj)
+      xf = x if x.flags.f_contiguous else np.asfortranarray(x)
+
+      T = [] if isinstance(self, LinearizedEvolutionOperator) else None
+      call = self.__call__
+      for col in xf.T:
+        trj = call(col, dt)
+        if T is not None: T.append(trj)
 
-      return T
+      if xf is not x: x[:] = xf
+      return EnsembleTrajectory(T) if T else None
     else:
       raise Exception("EvolutionOperator.__call__() not implemented for M=1")
 
@@ -116,11 +180,12 @@ class LinearizedEvolutionOperator(EvolutionOperator):
     N, M = x.shape
 
     if M > 1:
-      haveCompositeTrj = isinstance(trajectory, CompositeTrajectory)
-      if haveCompositeTrj: assert M == len(trajectory)
+      haveEnsembleTrj = isinstance(trajectory, EnsembleTrajectory)
+      if haveEnsembleTrj: assert M == len(trajectory)
 
-      for m in range(M):
-        x[:,m] = self.dot(trajectory[m] if haveCompositeTrj else trajectory, x[:,m])
+      dot = self.dot
+      for m, col in enumerate(x.T):
+        col[:] = dot(trajectory[m] if haveEnsembleTrj else trajectory, col)
 
       return x
     else:
@@ -149,11 +214,12 @@ class LinearizedEvolutionOperator(EvolutionOperator):
     N, M = x.shape
 
     if M > 1:
-      haveCompositeTrj = isinstance(trajectory, CompositeTrajectory)
-      if haveCompositeTrj: assert M == len(trajectory)
+      haveEnsembleTrj = isinstance(trajectory, EnsembleTrajectory)
+      if haveEnsembleTrj: assert M == len(trajectory)
 
-      for m in range(M):
-        x[:,m] = self.adjdot(trajectory[m] if haveCompositeTrj else trajectory, x[:,m])
+      adjdot = self.adjdot
+      for m, col in enumerate(x.T):
+        col[:] = adjdot(trajectory[m] if haveEnsembleTrj else trajectory, col)
 
       return x
     else:
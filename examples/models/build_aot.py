@@ -0,0 +1,45 @@
+"""
+Builds the optional ahead-of-time compiled Lorenz 95 kernels for the common model size n = 40. Run from this directory as
+
+    python build_aot.py
+
+Numba is required to build the module but not to use it. If the module is built, :class:`models.lorenz.Lorenz95` uses
+it for double precision models with n = 40, which avoids the just-in-time compilation delay when the model is first
+used. Other model sizes use the just-in-time compiled kernels.
+"""
+
+import os
+
+from numba.pycc import CC
+
+from lorenz import _l95_rk4, _l95_tl_rk4, _l95_ad_rk4
+
+cc = CC('lorenz95_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# Propagates all columns of the Fortran-ordered n x N array `x`, see _make_step() in lorenz.py
+@cc.export('rk4_step_n40', 'void(f8[::1, :], f8, f8, f8[:, :, :], f8[:, :, :])')
+def rk4_step_n40(x, dt, F, K, X):
+    for m in range(x.shape[1]):
+        _l95_rk4(x[:,m], dt, F, K[:,:,m], X[:,:,m], 40)
+
+
+# Tangent linear applied to all columns of `dx`. The i-th column uses the (i mod Nt)-th trajectory in `X`
+@cc.export('tl_n40', 'void(f8[:, :, :], f8, f8[::1, :], f8[::1, :], f8[:, ::1])')
+def tl_n40(X, dt, dx, out, dK):
+    Nt = X.shape[2]
+    for i in range(dx.shape[1]):
+        _l95_tl_rk4(X[:,:,i % Nt], dt, dx[:,i], out[:,i], dK)
+
+
+# Adjoint applied to all columns of `dx`. The i-th column uses the (i mod Nt)-th trajectory in `X`
+@cc.export('ad_n40', 'void(f8[:, :, :], f8, f8[::1, :], f8[::1, :], f8[:, ::1])')
+def ad_n40(X, dt, dx, out, aux):
+    Nt = X.shape[2]
+    for i in range(dx.shape[1]):
+        _l95_ad_rk4(X[:,:,i % Nt], dt, dx[:,i], out[:,i], aux[0], aux[1])
+
+
+if __name__ == '__main__':
+    cc.compile()
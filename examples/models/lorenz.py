@@ -2,14 +2,190 @@
 Toy models used for testing the data assimilation algorithms.
 """
 
+from functools import lru_cache
+
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Optional compiled model integration, see lorenz95_cy.pyx
+try:
+    from . import lorenz95_cy
+except ImportError:
+    lorenz95_cy = None
+
+# Optional ahead-of-time compiled kernels for n = 40, see build_aot.py
+try:
+    from . import lorenz95_aot
+except ImportError:
+    lorenz95_aot = None
+
 __all__ = [ 'Lorenz95' ]
 
 
-# Used by the Lorenz95 evolution operator to represent model trajectory.
+# Compiled Lorenz 95 kernels. Each kernel propagates a single state vector and evaluates the ODE for all elements in a
+# single loop with cyclic indexing so that no temporary arrays are needed. Used if Numba is available.
+
+# The ODE evaluated at the point p, for the i-th element
+def _l95_i(p, F, i, n):
+    return (p[(i+1) % n] - p[(i-2) % n])*p[(i-1) % n] - p[i] + F
+
+
+# Propagates x by one RK4 step, storing the stages in K[0]..K[3] and the points at which they were evaluated (i.e. x
+# and the three intermediate states) in X[0]..X[3]
+def _l95_rk4(x, dt, F, K, X, n):
+    for i in range(n): X[0,i] = x[i]
+    for i in range(n): K[0,i] = dt * _l95_i(X[0], F, i, n)
+    for i in range(n): X[1,i] = x[i] + 0.5*K[0,i]
+    for i in range(n): K[1,i] = dt * _l95_i(X[1], F, i, n)
+    for i in range(n): X[2,i] = x[i] + 0.5*K[1,i]
+    for i in range(n): K[2,i] = dt * _l95_i(X[2], F, i, n)
+    for i in range(n): X[3,i] = x[i] + K[2,i]
+    for i in range(n): K[3,i] = dt * _l95_i(X[3], F, i, n)
+    for i in range(n):
+        x[i] += (K[0,i] + 2.0*K[1,i] + 2.0*K[2,i] + K[3,i]) / 6.0
+
+
+# Tangent linear of the ODE at the point p applied to dx + cd*kd, for the i-th element
+def _l95_tl_i(p, dx, kd, cd, i, n):
+    im2, im1, ip1 = (i-2) % n, (i-1) % n, (i+1) % n
+    dm2, dm1, di, dp1 = dx[im2] + cd*kd[im2], dx[im1] + cd*kd[im1], dx[i] + cd*kd[i], dx[ip1] + cd*kd[ip1]
+    return -p[im1]*dm2 + (p[ip1] - p[im2])*dm1 - di + p[im1]*dp1
+
+
+# Adjoint of the ODE at the point p applied to dx, for the i-th element
+def _l95_ad_i(p, dx, i, n):
+    im2, im1, ip1, ip2 = (i-2) % n, (i-1) % n, (i+1) % n, (i+2) % n
+    return p[im2]*dx[im1] + (p[ip2] - p[im1])*dx[ip1] - dx[i] - p[ip1]*dx[ip2]
+
+
+def _l95_tl_rk4(X, dt, dx, out, dK):
+    n = dx.shape[0]
+    for i in range(n): dK[0,i] = dt * _l95_tl_i(X[0], dx, dx, 0.0, i, n)
+    for i in range(n): dK[1,i] = dt * _l95_tl_i(X[1], dx, dK[0], 0.5, i, n)
+    for i in range(n): dK[2,i] = dt * _l95_tl_i(X[2], dx, dK[1], 0.5, i, n)
+    for i in range(n): dK[3,i] = dt * _l95_tl_i(X[3], dx, dK[2], 1.0, i, n)
+    for i in range(n):
+        out[i] = dx[i] + (dK[0,i] + 2.0*dK[1,i] + 2.0*dK[2,i] + dK[3,i]) / 6.0
+
+
+# The adjoint is evaluated in reverse order of the RK4 stages, therefore each stage is visited once
+def _l95_ad_rk4(X, dt, dx, out, a, g):
+    n = dx.shape[0]
+    for i in range(n): out[i] = dx[i]
+
+    for i in range(n): a[i] = dx[i] / 6.0
+    for i in range(n): g[i] = dt * _l95_ad_i(X[3], a, i, n)
+    for i in range(n):
+        out[i] += g[i]
+        a[i] = dx[i] / 3.0 + g[i]
+    for i in range(n): g[i] = dt * _l95_ad_i(X[2], a, i, n)
+    for i in range(n):
+        out[i] += g[i]
+        a[i] = dx[i] / 3.0 + 0.5*g[i]
+    for i in range(n): g[i] = dt * _l95_ad_i(X[1], a, i, n)
+    for i in range(n):
+        out[i] += g[i]
+        a[i] = dx[i] / 6.0 + 0.5*g[i]
+    for i in range(n): g[i] = dt * _l95_ad_i(X[0], a, i, n)
+    for i in range(n): out[i] += g[i]
+
+
+if njit is not None:
+    _l95_i = njit(cache=True, fastmath=True, inline='always')(_l95_i)
+    _l95_tl_i = njit(cache=True, fastmath=True)(_l95_tl_i)
+    _l95_ad_i = njit(cache=True, fastmath=True)(_l95_ad_i)
+    _l95_rk4 = njit(cache=True, fastmath=True, inline='always')(_l95_rk4)
+    _l95_tl_rk4 = njit(cache=True, fastmath=True)(_l95_tl_rk4)
+    _l95_ad_rk4 = njit(cache=True, fastmath=True)(_l95_ad_rk4)
+
+
+# Returns compiled RK4 step for the Lorenz 95 model of fixed size `n` and forcing `F`, propagating all columns of an
+# n x N array in one call. Both `n` and `F` are compile-time constants of the returned kernel, which lets the compiler
+# specialize (and unroll) the loops over state elements. Kernels are cached per (n, F, dtype).
+@lru_cache(maxsize=None)
+def _make_step(n, F, dtype):
+    F = dtype.type(F)
+
+    def step(x, dt, K, X):
+        for m in range(x.shape[1]):
+            _l95_rk4(x[:,m], dt, F, K[:,:,m], X[:,:,m], n)
+
+    return njit(fastmath=True)(step)
+
+
+# Used by the Lorenz95 evolution operator to represent model trajectory. The RK4 stages are stacked in the 4 x n x N
+# array `K` and the points at which they were evaluated in the 4 x n x N array `X`, with one column for each propagated
+# state vector. The arrays are stored member-major, i.e. the 4 x n block K[:,:,m] (X[:,:,m]) of each state vector is
+# contiguous in memory. The stages are available individually as `k1`..`k4`, the points
+# as `x` (the state at the beginning of the step) and `xmid1`..`xmid3` (x + k1/2, x + k2/2 and x + k3). The tangent
+# linear and adjoint are linearized at these points.
 class L95Trajectory:
-    __slots__ = ['dt', 'k', 'x']
+    __slots__ = ['dt', 'K', 'X']
+
+    @property
+    def x(self): return self.X[0]
+
+    @property
+    def xmid1(self): return self.X[1]
+
+    @property
+    def xmid2(self): return self.X[2]
+
+    @property
+    def xmid3(self): return self.X[3]
+
+    @property
+    def k1(self): return self.K[0]
+
+    @property
+    def k2(self): return self.K[1]
+
+    @property
+    def k3(self): return self.K[2]
+
+    @property
+    def k4(self): return self.K[3]
+
+
+# Weights of the RK4 stages in the final update x += (k1 + 2*k2 + 2*k3 + k4) / 6
+_RK4_WEIGHTS = np.array([1.0, 2.0, 2.0, 1.0]) / 6.0
+
+# Coefficients of the RK4 stages in the intermediate states, i.e. X[s+1] = x + _RK4_C[s] * K[s]
+_RK4_C = (0.5, 0.5, 1.0)
+
+
+# Returns uninitialized 4 x n x N array for the RK4 stages (or points), laid out such that the four stages of each
+# state vector form a contiguous 4 x n block. The compiled kernels, which process one state vector at a time, then
+# read and write all stages from a single block.
+def _empty_stages(n, N, dtype=np.double):
+    return np.empty((N, 4, n), dtype=dtype).transpose(1, 2, 0)
+
+
+# Returns copy of `x` with two elements of cyclic padding on both ends along the first axis, so that the neighbours
+# x_i-2, x_i-1, x_i+1 and x_i+2 of all elements are available as contiguous slices [0:n], [1:n+1], [3:n+3] and
+# [4:n+4], respectively.
+def _cyclic_pad(x, out=None):
+    n = x.shape[0]
+    if out is None: out = np.empty((n + 4,) + x.shape[1:], dtype=x.dtype)
+    out[2:n+2] = x
+    out[0:2] = x[n-2:n]
+    out[n+2:n+4] = x[0:2]
+    return out
+
+
+# Returns the points at which the tangent linear and adjoint are linearized as 4 x n x N array, such that each point can
+# be broadcast against an n x N array. The i-th column uses the trajectory of the (i mod Nt)-th state vector, where Nt is
+# the number of state vectors in the trajectory.
+def _trajectory_points(trajectory, N):
+    Nt = trajectory.X.shape[2]
+    if Nt == 1 or Nt == N:
+        return trajectory.X
+
+    return trajectory.X[:,:,np.arange(N) % Nt]
 
 
 class Lorenz95:
@@ -27,44 +203,141 @@ class Lorenz95:
     is the state of the system and :math:`F` is a forcing constant. :math:`F=8` is a common value known to cause
     chaotic behavior. The model is mostly useful for testing the performance of various assimilation techniques.
 
+    If `Numba <https://numba.pydata.org/>`_ is installed, the model integration, tangent linear and adjoint are
+    computed by compiled kernels. Otherwise a pure NumPy implementation is used. If the optional ``lorenz95_cy``
+    extension module is built, it is used for the model integration, processing ensemble members in parallel
+    (double precision only). If the optional ``lorenz95_aot`` module is built, its precompiled kernels are used for
+    double precision models with n = 40 instead of the just-in-time compiled ones, avoiding the compilation delay.
+    The compiled kernels operate on one ensemble member at a time and therefore prefer Fortran-ordered (column-major)
+    ensembles; other arrays are converted on entry and the trajectory data is stored per ensemble member.
+
+    The model computations are carried out in the precision given by `dtype`, regardless of the precision of the
+    arrays passed in. Single precision roughly halves the memory traffic and doubles the SIMD width of the compiled
+    kernels. For data assimilation experiments the rounding error is far below the sampling error of the ensemble and
+    the model noise, but double precision (the default) should be used when comparing against reference results.
+
+    Args:
+        n (int)   : The number of state variables
+        F (float) : The forcing constant
+        dtype     : Floating point type used for the model computations and trajectory data
+
     References:
         [1] Lorenz, Edward (1996). "Predictability – A problem partly solved"
     """
 
-    def __init__(self, n=40, F=8):
+    def __init__(self, n=40, F=8, dtype=np.double):
         self._n = n
-        self._F = F
+        self._dtype = np.dtype(dtype)
+        self._F = self._dtype.type(F)
+        self._use_jit = njit is not None
+        self._step = _make_step(n, float(F), self._dtype) if self._use_jit else None
+        self._use_cy = lorenz95_cy is not None and self._dtype == np.double
+        self._use_aot = lorenz95_aot is not None and n == 40 and self._dtype == np.double
+
+        # Scratch arrays used by the forward model, keyed by shape
+        self._scratch = {}
+
+        # Weights of the RK4 stages in the model precision
+        self._rk4w = _RK4_WEIGHTS.astype(self._dtype)
+
+
+    def _scratch_buffers(self, shape):
+        buffers = self._scratch.get(shape)
+        if buffers is None:
+            dtype = self._dtype
+            buffers = (np.empty(shape, dtype), np.empty((shape[0] + 4,) + shape[1:], dtype))
+            self._scratch[shape] = buffers
+        return buffers
+
+
+    # Returns trajectory with uninitialized arrays for n x N states. The arrays of `trajectoryout` are reused if it is
+    # given and has matching shape, the caller then gives up the trajectory and its previous contents are overwritten.
+    def _new_trajectory(self, n, N, trajectoryout=None):
+        trj = trajectoryout
+        if not isinstance(trj, L95Trajectory) or trj.K.shape != (4, n, N) or trj.K.dtype != self._dtype:
+            trj = L95Trajectory()
+            trj.K = _empty_stages(n, N, self._dtype)
+            trj.X = _empty_stages(n, N, self._dtype)
+        return trj
+
 
-        # Precomputed array indices for the ODE expressions to avoid explicit loops later on
-        self._i_m1 = np.array([i % n for i in range(-1, n-1)])  # x_i-1
-        self._i_m2 = np.array([i % n for i in range(-2, n-2)])  # x_i-2
-        self._i_p1 = np.array([i % n for i in range( 1, n+1)])  # x_i+1
-        self._i_p2 = np.array([i % n for i in range( 2, n+2)])  # x_i+2
+    def _l95_into(self, x, out, xpad):
+        # Evaluates the ODE for x and stores the result in `out`, i.e. out = (x_i+1 - x_i-2) * x_i-1 - x_i + F.
+        # The expression indexes the first axis only and therefore works on all ensemble members at once.
+        n = self._n
+        xp = _cyclic_pad(x, out=xpad)
+        np.subtract(xp[3:n+3], xp[0:n], out=out)
+        np.multiply(out, xp[1:n+1], out=out)
+        np.subtract(out, x, out=out)
+        np.add(out, self._F, out=out)
+        return out
+
+
+    # Returns `out` if the compiled kernels can write to it directly, otherwise a temporary array to be copied to `out`
+    def _compiled_out(self, out):
+        if out.flags.f_contiguous and out.dtype == self._dtype: return out
+        return np.empty(out.shape, self._dtype, order='F')
 
 
-    def __call__(self, x, dt):
+    def __call__(self, x, dt, trajectoryout=None):
+        """
+        Propagates the state (or ensemble) `x` in-place from time `t` to `t+dt` and returns the model trajectory.
+
+        If `trajectoryout` is a trajectory previously returned by this model, its arrays are reused for the new
+        trajectory instead of allocating new ones. The previous trajectory must not be used afterwards.
+        """
         if len(x.shape) == 1: x = x.reshape(-1, 1)
         n, N = x.shape
         assert n == self._n
 
-        def l95(x):
-            return -x[self._i_m2]*x[self._i_m1] + x[self._i_m1]*x[self._i_p1] - x + self._F
-
         # State propagation using the 4th-order Runge-Kutta method. Store what we need for the tl() and ad()
         # computations
 
-        trj = L95Trajectory()
+        trj = self._new_trajectory(n, N, trajectoryout)
         trj.dt = dt
-        trj.k = np.zeros((N, 4, n))
-        trj.x = np.zeros((N, n))
 
-        for i in range(N):
-            trj.k[i,0,:] = dt * l95(x[:,i])
-            trj.k[i,1,:] = dt * l95(x[:,i] + trj.k[i,0,:] / 2)
-            trj.k[i,2,:] = dt * l95(x[:,i] + trj.k[i,1,:] / 2)
-            trj.k[i,3,:] = dt * l95(x[:,i] + trj.k[i,2,:])
-            x[:,i] += (trj.k[i,0,:] + 2*trj.k[i,1,:] + 2*trj.k[i,2,:] + trj.k[i,3,:]) / 6.0
-            trj.x[i,:] = x[:,i]
+        if self._use_cy or self._use_aot or self._use_jit:
+            # The compiled kernels process one ensemble member (column) at a time, so they work on a Fortran-ordered
+            # ensemble where each member is contiguous in memory. The result is copied back if `x` had to be converted
+            xf = x if x.flags.f_contiguous and x.dtype == self._dtype else np.asfortranarray(x, dtype=self._dtype)
+
+            if self._use_cy:
+                np.copyto(trj.X[0], xf)
+                lorenz95_cy.rk4_step(xf, dt, float(self._F), *trj.K, *trj.X[1:])
+            elif self._use_aot:
+                lorenz95_aot.rk4_step_n40(xf, dt, float(self._F), trj.K, trj.X)
+            else:
+                self._step(xf, self._dtype.type(dt), trj.K, trj.X)
+
+            if xf is not x: x[:] = xf
+            return trj
+
+        # All intermediate results are written to scratch buffers to avoid allocating temporaries
+        # The intermediate states are kept in the trajectory for the tangent linear and adjoint
+        K, X = trj.K, trj.X
+        a, xpad = self._scratch_buffers((n, N))
+
+        np.copyto(X[0], x)
+        self._l95_into(X[0], a, xpad)
+        np.multiply(a, dt, out=K[0])
+
+        np.multiply(K[0], 0.5, out=a)
+        np.add(x, a, out=X[1])
+        self._l95_into(X[1], a, xpad)
+        np.multiply(a, dt, out=K[1])
+
+        np.multiply(K[1], 0.5, out=a)
+        np.add(x, a, out=X[2])
+        self._l95_into(X[2], a, xpad)
+        np.multiply(a, dt, out=K[2])
+
+        np.add(x, K[2], out=X[3])
+        self._l95_into(X[3], a, xpad)
+        np.multiply(a, dt, out=K[3])
+
+        # x += (k1 + 2*k2 + 2*k3 + k4) / 6 as a single weighted contraction over the stacked stages
+        np.einsum('s,snm->nm', self._rk4w, K, out=a)
+        np.add(x, a, out=x)
 
         return trj
 
@@ -77,22 +350,38 @@ class Lorenz95:
         assert isinstance(trajectory, L95Trajectory)
 
         def l95_tl(x, dx):
-            return -x[self._i_m1]*dx[self._i_m2] + (x[self._i_p1]-x[self._i_m2])*dx[self._i_m1] - dx + \
-                   x[self._i_m1]*dx[self._i_p1]
+            xp, dp = _cyclic_pad(x), _cyclic_pad(dx)
+            return -xp[1:n+1]*dp[0:n] + (xp[3:n+3]-xp[0:n])*dp[1:n+1] - dx + xp[1:n+1]*dp[3:n+3]
 
         if out is None:
-            out = np.zeros((n, N))
+            out = np.zeros((n, N), x.dtype, order='F')
         else:
             if N == 1: out = out.reshape(-1, 1)
             assert out.shape == x.shape
 
-        for i in range(N):
-            ti = i % trajectory.x.shape[0]
-            dK1 = trajectory.dt * l95_tl(trajectory.x[ti,:], x[:,i])
-            dK2 = trajectory.dt * l95_tl(trajectory.x[ti,:] + trajectory.k[ti,0,:] / 2, x[:,i] + dK1 / 2)
-            dK3 = trajectory.dt * l95_tl(trajectory.x[ti,:] + trajectory.k[ti,1,:] / 2, x[:,i] + dK2 / 2)
-            dK4 = trajectory.dt * l95_tl(trajectory.x[ti,:] + trajectory.k[ti,2,:], x[:,i] + dK3)
-            out[:,i] = x[:,i] + (dK1 + 2 * dK2 + 2 * dK3 + dK4) / 6.0
+        if self._use_aot or self._use_jit:
+            dK = np.empty((4, n), self._dtype)
+            Nt = trajectory.X.shape[2]
+            xf, outf = np.asfortranarray(x, self._dtype), self._compiled_out(out)
+            dt = self._dtype.type(trajectory.dt)
+            if self._use_aot:
+                lorenz95_aot.tl_n40(trajectory.X, dt, xf, outf, dK)
+            else:
+                for i in range(N):
+                    _l95_tl_rk4(trajectory.X[:,:,i % Nt], dt, xf[:,i], outf[:,i], dK)
+            if outf is not out: out[:] = outf
+            return out
+
+        X = _trajectory_points(trajectory, N)
+        dK = np.empty((4, n, N), np.result_type(x, X))
+        dK[0] = trajectory.dt * l95_tl(X[0], x)
+        dK[1] = trajectory.dt * l95_tl(X[1], x + dK[0] / 2)
+        dK[2] = trajectory.dt * l95_tl(X[2], x + dK[1] / 2)
+        dK[3] = trajectory.dt * l95_tl(X[3], x + dK[2])
+
+        # out = x + (dK1 + 2*dK2 + 2*dK3 + dK4) / 6
+        np.einsum('s,snm->nm', self._rk4w, dK, out=out)
+        np.add(out, x, out=out)
 
         return out
 
@@ -105,32 +394,37 @@ class Lorenz95:
         assert isinstance(trajectory, L95Trajectory)
 
         def l95_ad(x, dx):
-            return x[self._i_m2]*dx[self._i_m1] + (x[self._i_p2]-x[self._i_m1])*dx[self._i_p1] - dx - \
-                   x[self._i_p1]*dx[self._i_p2]
-
-        def adK1(dx, i): return trajectory.dt * l95_ad(trajectory.x[i,:], dx);
-
-        def adK2(dx, i):
-            aux = l95_ad(trajectory.x[i,:] + trajectory.k[i,0,:]/2, dx)
-            return trajectory.dt * (aux + adK1(aux, i) / 2)
-
-        def adK3(dx, i):
-            aux = l95_ad(trajectory.x[i,:] + trajectory.k[i,1,:]/2, dx)
-            return trajectory.dt * (aux + adK2(aux, i) / 2)
-
-        def adK4(dx, i):
-            aux = l95_ad(trajectory.x[i,:] + trajectory.k[i,2,:], dx)
-            return trajectory.dt * (aux + adK3(aux, i))
+            xp, dp = _cyclic_pad(x), _cyclic_pad(dx)
+            return xp[0:n]*dp[1:n+1] + (xp[4:n+4]-xp[1:n+1])*dp[3:n+3] - dx - xp[3:n+3]*dp[4:n+4]
 
         if out is None:
-            out = np.zeros((n, N))
+            out = np.zeros((n, N), x.dtype, order='F')
         else:
             if N == 1: out = out.reshape(-1, 1)
             assert out.shape == x.shape
 
-        for i in range(N):
-            ti = i % trajectory.x.shape[0]
-            dx = x[:,i]
-            out[:,i] = dx + (adK1(dx, ti) + 2 * adK2(dx, ti) + 2 * adK3(dx, ti) + adK4(dx, ti)) / 6.0
+        if self._use_aot or self._use_jit:
+            aux = np.empty((2, n), self._dtype)
+            Nt = trajectory.X.shape[2]
+            xf, outf = np.asfortranarray(x, self._dtype), self._compiled_out(out)
+            dt = self._dtype.type(trajectory.dt)
+            if self._use_aot:
+                lorenz95_aot.ad_n40(trajectory.X, dt, xf, outf, aux)
+            else:
+                for i in range(N):
+                    _l95_ad_rk4(trajectory.X[:,:,i % Nt], dt, xf[:,i], outf[:,i], aux[0], aux[1])
+            if outf is not out: out[:] = outf
+            return out
+
+        # The stages are visited in reverse order. The adjoint of each stage is applied to its weight in the final
+        # update plus its contribution to the next stage, so each stage is evaluated exactly once
+        X = _trajectory_points(trajectory, N)
+        out[:] = x
+        g = None
+        for s in (3, 2, 1, 0):
+            a = self._rk4w[s] * x
+            if g is not None: a += _RK4_C[s] * g
+            g = trajectory.dt * l95_ad(X[s], a)
+            out += g
 
         return out
@@ -0,0 +1,59 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled Lorenz 95 model integration.
+
+This is an optional extension module used by :class:`models.lorenz.Lorenz95` if available. To build it, run
+
+    python setup.py build_ext --inplace
+
+from the ``examples/models`` directory.
+"""
+
+from cython.parallel cimport prange
+
+
+def rk4_step(double[::1, :] x, double dt, double F,
+             double[:, :] k1, double[:, :] k2, double[:, :] k3, double[:, :] k4,
+             double[:, :] x1, double[:, :] x2, double[:, :] x3):
+    """
+    Propagates the n x M array of states `x` by one 4th-order Runge-Kutta step of length `dt` in-place and stores the
+    RK4 stages in the n x M arrays `k1` to `k4` and the intermediate states x + k1/2, x + k2/2 and x + k3 in `x1` to
+    `x3`. The ensemble members (columns) are processed in parallel. `x` must be Fortran-ordered so that each member
+    is contiguous in memory, the other arrays may be strided (e.g. views into the trajectory arrays).
+    """
+    cdef Py_ssize_t n = x.shape[0], M = x.shape[1]
+    cdef Py_ssize_t m
+
+    assert k1.shape[0] == n and k1.shape[1] == M
+    assert k2.shape[0] == n and k2.shape[1] == M
+    assert k3.shape[0] == n and k3.shape[1] == M
+    assert k4.shape[0] == n and k4.shape[1] == M
+    assert x1.shape[0] == n and x1.shape[1] == M
+    assert x2.shape[0] == n and x2.shape[1] == M
+    assert x3.shape[0] == n and x3.shape[1] == M
+
+    for m in prange(M, nogil=True):
+        _rk4_member(x, dt, F, k1, k2, k3, k4, x1, x2, x3, m)
+
+
+cdef inline double _l95(double[:, :] p, double F, Py_ssize_t i, Py_ssize_t n, Py_ssize_t m) noexcept nogil:
+    return (p[(i + 1) % n, m] - p[(i + n - 2) % n, m]) * p[(i + n - 1) % n, m] - p[i, m] + F
+
+
+cdef void _rk4_member(double[:, :] x, double dt, double F,
+                      double[:, :] k1, double[:, :] k2, double[:, :] k3, double[:, :] k4,
+                      double[:, :] x1, double[:, :] x2, double[:, :] x3,
+                      Py_ssize_t m) noexcept nogil:
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t i
+
+    for i in range(n): k1[i, m] = dt * _l95(x, F, i, n, m)
+    for i in range(n): x1[i, m] = x[i, m] + 0.5 * k1[i, m]
+    for i in range(n): k2[i, m] = dt * _l95(x1, F, i, n, m)
+    for i in range(n): x2[i, m] = x[i, m] + 0.5 * k2[i, m]
+    for i in range(n): k3[i, m] = dt * _l95(x2, F, i, n, m)
+    for i in range(n): x3[i, m] = x[i, m] + k3[i, m]
+    for i in range(n): k4[i, m] = dt * _l95(x3, F, i, n, m)
+
+    for i in range(n):
+        x[i, m] += (k1[i, m] + 2.0 * k2[i, m] + 2.0 * k3[i, m] + k4[i, m]) / 6.0
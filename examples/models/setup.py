@@ -0,0 +1,29 @@
+"""
+Builds the optional compiled Lorenz 95 model integration (see lorenz95_cy.pyx). Run from this directory as
+
+    python setup.py build_ext --inplace
+
+Cython and a C compiler with OpenMP support are required. The Lorenz 95 model falls back to other implementations if
+the extension module is not built.
+"""
+
+import sys
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+if sys.platform == 'win32':
+    compile_args = ['/openmp', '/O2', '/fp:fast']
+    link_args = []
+else:
+    compile_args = ['-fopenmp', '-O3', '-ffast-math']
+    link_args = ['-fopenmp']
+
+extensions = [
+    Extension('lorenz95_cy', sources=['lorenz95_cy.pyx'],
+              extra_compile_args=compile_args, extra_link_args=link_args)
+]
+
+setup(
+    name="lorenz95_cy",
+    ext_modules=cythonize(extensions, language_level=3)
+)
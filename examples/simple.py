@@ -8,7 +8,7 @@ import matplotlib
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 
-from endas import ensemble
+from endas import ensemble, ObservationOperator
 from endas import algorithms as algs
 from endas.obs import MatrixObservationOp
 from endas.cov import DiagonalCovariance
@@ -39,7 +39,30 @@ P0 = DiagonalCovariance(diag=np.array([1., 1., 1.])**2)
 
 # Observation operator. This is a 1x3 matrix representing a single observation
 # of both the first and second state variable. The third state variable is unobserved.
-H = MatrixObservationOp(np.array([[1., 1., 0.]]))
+# The operator is applied many times during the run, so instead of the generic
+# MatrixObservationOp(np.array([[1., 1., 0.]])) we use an operator specialized for it.
+class FixedSumObservationOp(ObservationOperator):
+    @property
+    def is_linear(self): return True
+
+    @property
+    def shape(self): return (1, 3)
+
+    def localize(self, selected):
+        return MatrixObservationOp(self.to_matrix()[selected, :])
+
+    # Implements Hx, i.e. the sum of the first two state variables
+    def dot(self, x, out=None):
+        return np.add(x[0:1], x[1:2], out=out)
+
+    # Implements H'y
+    def adjdot(self, y):
+        return np.concatenate((y, y, np.zeros_like(y)))
+
+    def to_matrix(self, force_dense=False, out=None):
+        return np.array([[1., 1., 0.]])
+
+H = FixedSumObservationOp()
 
 # Observation error covariance matrix
 R = DiagonalCovariance(np.array([obs_sigma ** 2]))
@@ -57,38 +80,64 @@ class SimpleModel:
                            [0.0, np.cos(np.pi / 6.0), np.sin(np.pi / 6.0)],
                            [0.0, -np.sin(np.pi / 6.0), np.cos(np.pi / 6.0)]])
 
+        # The model is small enough to be written out in scalar form, which is faster than
+        # calling into BLAS and avoids allocating temporaries for a single state vector
+        self._c = float(np.cos(np.pi / 6.0))
+        self._s = float(np.sin(np.pi / 6.0))
+
     # Call needs to update `x` in-place and can return any data needed for the tangent
-    # linear and adjoint. With simple linear model neither the tangent linear nor adjoint
-    # depends on `x`
+    # linear and adjoint. `x` is either a single state vector or the entire ensemble.
+    # With simple linear model neither the tangent linear nor adjoint depends on `x`
     def __call__(self, x, dt):
-        x[:] = self.M.dot(x)
+        # The whole ensemble is propagated with a single matrix product
+        if x.ndim == 2:
+            np.matmul(self.M, x, out=x)
+            return None
+
+        c, s = self._c, self._s
+        x1, x2 = x[1], x[2]
+        x[1], x[2] = c*x1 + s*x2, c*x2 - s*x1
         return None
 
     # Implements Mx
     def dot(self, _, x):
-        return self.M.dot(x)
+        c, s = self._c, self._s
+        out = np.empty_like(x)
+        out[0] = x[0]
+        out[1] = c*x[1] + s*x[2]
+        out[2] = c*x[2] - s*x[1]
+        return out
 
     # Implements xM'
     def adjdot(self, _, x):
-        return x.dot(self.M.T)
+        c, s = self._c, self._s
+        out = np.empty_like(x)
+        out[..., 0] = x[..., 0]
+        out[..., 1] = c*x[..., 1] + s*x[..., 2]
+        out[..., 2] = c*x[..., 2] - s*x[..., 1]
+        return out
 
 model = SimpleModel()
 
 
 # Before we start we generate some synthetic data that will serve as the "true" state
 # and draw observations by applying the observation operator H and adding noise with
-# covariance R.
+# covariance R. The model and observation noise for all steps is drawn up front.
+
+q_noise = Q.random_multivariate_normal(nsteps).T
+r_noise = R.random_multivariate_normal(nsteps).T
 
 x = x0
-xtrue = np.zeros((nsteps, 3))
+xtrue = np.empty((nsteps, 3))
 xtrue[0,:] = x
-y = np.zeros((nsteps, 1))  # Array of observations
+y = np.empty((nsteps, 1))  # Array of observations
+y[0,:] = np.nan            # There is no observation at the initial time
 
 for i in range(1, nsteps):
     model(x, 1)
-    x+= Q.random_multivariate_normal()
+    x+= q_noise[i]
     xtrue[i,:] = x
-    y[i,:] = H.dot(x) + R.random_multivariate_normal()
+    y[i,:] = H.dot(x) + r_noise[i]
 
 
 
@@ -99,11 +148,11 @@ def onresult(x, A, t, result_args):
     err[t, :] = np.std(A, axis=1) if is_enkf else np.diagonal(A)**0.5
 
 
-# Collect results here
-kf_est = np.zeros((nsteps, 3))
-kf_std = np.zeros((nsteps, 3))
-enkf_est = np.zeros((nsteps, 3))
-enkf_std = np.zeros((nsteps, 3))
+# Collect results here. Every time step is written by the smoother callback
+kf_est = np.empty((nsteps, 3))
+kf_std = np.empty((nsteps, 3))
+enkf_est = np.empty((nsteps, 3))
+enkf_std = np.empty((nsteps, 3))
 
 enkf = algs.EnsembleKalmanFilter(variant=algs.ESTKF(), ensemble_size=N, lag=smoother_lag)
 
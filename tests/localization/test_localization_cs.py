@@ -7,10 +7,8 @@ from endas.localization.cs import EuclideanCS, LatLonCS
 
 def np_euclid_distance(a, b):
     diff = a - b
-    diffSq = np.square(diff, out=diff)
-    sqSum = np.sum(diffSq, axis=1)
-    dist = np.sqrt(sqSum, out=sqSum)
-    return dist
+    dist = np.einsum('ij,ij->i', diff, diff)
+    return np.sqrt(dist, out=dist)
 
 
 def np_latlon_distance(a, b, R):
@@ -104,3 +102,29 @@ def test_latlon_cs():
 
 
 
+
+
+@pytest.mark.parametrize("cs", [EuclideanCS(1), EuclideanCS(2), EuclideanCS(3), LatLonCS()])
+def test_distance_pairwise(cs):
+    np.random.seed(1234)
+    a = np.random.uniform(-50.0, 50.0, (7, cs.ndim))
+    b = np.random.uniform(-50.0, 50.0, (30, cs.ndim))
+
+    D = cs.distance_pairwise(a, b)
+    assert D.shape == (7, 30)
+    for i in range(len(a)):
+        assert np.allclose(D[i], cs.distance(a[i:i+1], b))
+
+    # Distance of a point from itself
+    assert np.allclose(np.diag(cs.distance_pairwise(a, a)), 0.0)
+
+
+def test_distance_pairwise_far_from_origin():
+    np.random.seed(1234)
+    cs = EuclideanCS(2)
+    a = np.random.uniform(-1.0, 1.0, (7, 2)) + 1e7
+    b = np.random.uniform(-1.0, 1.0, (30, 2)) + 1e7
+
+    D = cs.distance_pairwise(a, b)
+    for i in range(len(a)):
+        assert np.allclose(D[i], cs.distance(a[i:i+1], b), rtol=1e-9, atol=0)
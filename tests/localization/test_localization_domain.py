@@ -0,0 +1,107 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from endas.localization import GenericStateSpace1d, DomainLocalization
+from endas.cov import DiagonalCovariance
+from endas.localization.taper import GaspariCohn
+
+
+@pytest.mark.parametrize("L", [1, 1.75, 4])
+def test_generic1d_local_observations_batch(L):
+    np.random.seed(1234)
+    n = 40
+    ssp = GenericStateSpace1d(n)
+    fn = GaspariCohn(L)
+
+    # Regularly spaced observations as well as unordered ones with duplicate coordinates
+    for z_coords in (np.arange(n), np.arange(0, n, 3), np.random.randint(0, n, 25)):
+        batch = ssp.get_local_observations_batch(z_coords, fn)
+        assert len(batch) == ssp.num_domains
+
+        # The batch query must select the same observations as the per-domain one
+        for di in range(ssp.num_domains):
+            selected, dist = ssp.get_local_observations(di, z_coords, fn)
+
+            # All observations strictly within the support range are selected, including those at coordinate 0
+            r = int(np.ceil(fn.support_range))
+            assert np.array_equal(np.sort(selected), np.where(np.abs(z_coords - di) < r)[0])
+            assert np.allclose(dist, np.abs(z_coords[selected] - di))
+
+            assert np.array_equal(batch[di][0], selected)
+            assert np.allclose(batch[di][1], dist)
+
+
+def test_domain_localization_local_R_batch():
+    np.random.seed(1234)
+    n = 30
+    ls = DomainLocalization(GenericStateSpace1d(n), GaspariCohn(2))
+    z_coords = np.random.randint(0, n, 12)
+    R = DiagonalCovariance(np.random.uniform(0.5, 2.0, len(z_coords)))
+
+    local_obs = ls.ssp.get_local_observations_batch(z_coords, ls.taper_fn)
+    batch = ls.get_local_R_batch(R, local_obs)
+    assert len(batch) == len(local_obs)
+
+    single = []
+    for (selected, dist), Rl in zip(local_obs, batch):
+        if len(selected) == 0:
+            assert Rl is None
+            continue
+        expected = ls.get_local_R(R, selected, dist)
+        assert np.allclose(Rl.to_matrix(force_dense=True), expected.to_matrix(force_dense=True))
+        single.append((Rl, expected))
+
+    # Buffers reused by get_local_R() do not change the previously returned operators
+    for Rl, expected in single:
+        assert np.allclose(Rl.to_matrix(force_dense=True), expected.to_matrix(force_dense=True))
+
+
+def test_domain_localization_for_each_domain():
+    n = 25
+    ls = DomainLocalization(GenericStateSpace1d(n), GaspariCohn(1.5))
+    z_coords = np.arange(0, n, 2)
+
+    def callback(di, obs_used, obs_dist):
+        return di, len(obs_used), obs_dist.sum()
+
+    expected = [callback(di, *ls.ssp.get_local_observations(di, z_coords, ls.taper_fn)) for di in range(n)]
+    assert ls.for_each_domain(callback, z_coords) == expected
+
+    with ThreadPoolExecutor(4) as executor:
+        assert ls.for_each_domain(callback, z_coords, executor=executor) == expected
+
+
+def _shift_by_observations(di, xl, obs_used, obs_dist):
+    return xl + len(obs_used) + obs_dist.sum()
+
+
+def test_domain_localization_run_parallel():
+    np.random.seed(1234)
+    n = 30
+    ls = DomainLocalization(GenericStateSpace1d(n), GaspariCohn(1.5))
+    z_coords = np.arange(0, n, 3)
+    X = np.random.rand(n, 5)
+
+    expected = X.copy()
+    for di in range(n):
+        selected, dist = ls.ssp.get_local_observations(di, z_coords, ls.taper_fn)
+        expected[di] = _shift_by_observations(di, X[di], selected, dist)
+
+    Xa = ls.run_parallel(X, z_coords, _shift_by_observations, n_proc=2)
+    assert np.allclose(Xa, expected)
+
+
+def test_generic1d_observations_modified_in_place():
+    n = 20
+    ssp = GenericStateSpace1d(n)
+    fn = GaspariCohn(1)
+    z_coords = np.array([0, 5, 10])
+
+    assert np.array_equal(ssp.get_local_observations(0, z_coords, fn)[0], [0])
+
+    # The same array refilled with new coordinates must not return selections for the old ones
+    z_coords[0] = 18
+    assert len(ssp.get_local_observations(0, z_coords, fn)[0]) == 0
+    assert np.array_equal(ssp.get_local_observations(18, z_coords, fn)[0], [0])
+    assert np.array_equal(ssp.get_local_observations_batch(z_coords, fn)[18][0], [0])
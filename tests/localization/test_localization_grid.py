@@ -0,0 +1,106 @@
+import pytest
+import numpy as np
+
+from endas.localization.grid import Grid2d
+from endas.localization.bbox import BBox2d
+from endas.localization.cs import EuclideanCS, LatLonCS
+from endas.localization.taper import GaspariCohn
+
+
+def _brute_force(grid, di, z_coords, taper_fn):
+    r = taper_fn.support_range
+    dist = grid._cs.distance(grid._centres[di:di+1], z_coords)
+    selected = np.where(dist < r)[0]
+    return selected, dist[selected]
+
+
+@pytest.mark.parametrize("cs, extent, L", [
+    (EuclideanCS(2), None, 0.6),
+    (EuclideanCS(2), None, 1.5),
+    (EuclideanCS(2), None, 4),
+    (LatLonCS(), BBox2d(-60, -20, 60, 40), 5e5),
+    (LatLonCS(), BBox2d(-60, -20, 60, 40), 3e6),
+])
+def test_grid2d_local_observations(cs, extent, L):
+    np.random.seed(1234)
+    nx, ny = 12, 8
+    grid = Grid2d(nx, ny, extent, cs, block_size=3)
+    fn = GaspariCohn(L)
+
+    ext = grid._extent
+    z_coords = np.random.rand(60, 2) * (ext.sizex(), ext.sizey()) + (ext.x, ext.y)
+
+    batch = grid.get_local_observations_batch(z_coords, fn)
+    assert len(batch) == grid.num_domains
+
+    for di in range(grid.num_domains):
+        expected, expected_dist = _brute_force(grid, di, z_coords, fn)
+        selected, dist = grid.get_local_observations(di, z_coords, fn)
+        assert np.array_equal(selected, expected)
+        assert np.allclose(dist, expected_dist)
+        assert np.array_equal(batch[di][0], expected)
+        assert np.allclose(batch[di][1], expected_dist)
+
+        # All selected observations have non-zero weight so that the local R is finite
+        assert np.all(fn.taper(np.ones(len(dist)), dist) > 0)
+
+
+@pytest.mark.parametrize("mask", [None, np.array([3, 0, 7, 7, 12, 19, 20, 34, 28, 16])])
+def test_grid2d_local_state(mask):
+    np.random.seed(1234)
+    grid = Grid2d(7, 5, None, EuclideanCS(2), mask=mask, block_size=2, padding=1)
+    n = 35 if mask is None else len(mask)
+
+    X = np.random.rand(n, 4)
+    Xr = np.zeros_like(X)
+    for di in range(grid.num_domains):
+        idx = grid.get_local_state_indices(di)
+        Xl = grid.get_local_state(di, X)
+        assert Xl.shape == (grid.get_local_state_size(di), 4)
+        assert np.array_equal(Xl, X[idx])
+        grid.put_local_state(di, Xl, Xr)
+
+    # Every state variable belongs to at least one domain
+    assert np.array_equal(X, Xr)
+
+
+@pytest.mark.parametrize("cs, extent", [(EuclideanCS(2), None), (LatLonCS(), BBox2d(-60, -20, 60, 40))])
+def test_grid2d_observations_modified_in_place(cs, extent):
+    np.random.seed(1234)
+    grid = Grid2d(12, 8, extent, cs, block_size=3)
+    fn = GaspariCohn(1.5 if extent is None else 1e6)
+    ext = grid._extent
+
+    z_coords = np.random.rand(60, 2) * (ext.sizex(), ext.sizey()) + (ext.x, ext.y)
+    grid.get_local_observations(0, z_coords, fn)
+
+    # Refilling the same array with new coordinates must not reuse the spatial index built for the old ones
+    z_coords[:] = np.random.rand(60, 2) * (ext.sizex(), ext.sizey()) + (ext.x, ext.y)
+    z_fresh = z_coords.copy()
+    for di in range(grid.num_domains):
+        selected, dist = grid.get_local_observations(di, z_coords, fn)
+        expected, expected_dist = _brute_force(grid, di, z_fresh, fn)
+        assert np.array_equal(selected, expected)
+        assert np.allclose(dist, expected_dist)
+
+
+@pytest.mark.parametrize("L, jitter", [(5e-4, 2e-10), (5, 1e-5)])
+def test_grid2d_local_observations_large_extent(L, jitter):
+    # Coordinates spread over a large extent with observations placed very close to the edge of the support range
+    np.random.seed(1234)
+    grid = Grid2d(4, 4, BBox2d(0, 0, 1e6, 1e6), EuclideanCS(2), block_size=1)
+    fn = GaspariCohn(L)
+    r = fn.support_range
+
+    angles = np.random.uniform(0, 2 * np.pi, (grid.num_domains, 50))
+    radii = r + np.random.uniform(-jitter, jitter, angles.shape)
+    z_coords = np.concatenate([grid._centres[di] + np.column_stack((radii[di] * np.cos(angles[di]),
+                                                                    radii[di] * np.sin(angles[di])))
+                               for di in range(grid.num_domains)])
+
+    batch = grid.get_local_observations_batch(z_coords, fn)
+    for di in range(grid.num_domains):
+        expected, expected_dist = _brute_force(grid, di, z_coords, fn)
+        assert len(expected) > 0
+        assert np.array_equal(batch[di][0], expected)
+        assert np.allclose(batch[di][1], expected_dist)
@@ -0,0 +1,70 @@
+import pytest
+import numpy as np
+
+from endas.localization.taper import GaspariCohn, Linear, Spherical, Tabulated
+
+
+def np_gaspari_cohn(x, d, L):
+    r = d / L
+    out = np.zeros(len(x))
+    m1 = r < 1
+    m2 = (r >= 1) & (r < 2)
+    r1 = r[m1]
+    r2 = r[m2]
+    out[m1] = x[m1] * (1.0 - (5/3.0)*r1**2 + (5/8.0)*r1**3 + (1/2.0)*r1**4 - (1/4.0)*r1**5)
+    out[m2] = x[m2] * (4.0 - 5.0*r2 + (5/3.0)*r2**2 + (5/8.0)*r2**3 - (1/2.0)*r2**4 + (1/12.0)*r2**5 - 2.0/(3.0*r2))
+    return out
+
+
+@pytest.mark.parametrize("L", [0.5, 2, 10])
+def test_gaspari_cohn(L):
+    np.random.seed(1234)
+    fn = GaspariCohn(L)
+    assert fn.support_range == 2 * L
+
+    # Distances spanning both polynomial branches and the zero region beyond the support range
+    n = 1000
+    x = np.random.randn(n)
+    d = np.random.uniform(0.0, 2.5 * L, n)
+
+    tapered = fn.taper(x, d)
+    assert tapered.shape == (n,)
+    assert np.allclose(tapered, np_gaspari_cohn(x, d, L))
+
+    # The tapering function is one at zero distance and zero at the support range and beyond
+    ones = np.ones(3)
+    assert np.allclose(fn.taper(ones, np.array([0.0, 2.0 * L, 3.0 * L])), [1.0, 0.0, 0.0])
+
+
+@pytest.mark.parametrize("fn_type, np_fn", [
+    (Linear, lambda r: 1.0 - r),
+    (Spherical, lambda r: 1.0 - 1.5*r + 0.5*r**3),
+])
+def test_linear_spherical(fn_type, np_fn):
+    np.random.seed(1234)
+    L = 3.0
+    fn = fn_type(L)
+    assert fn.support_range == L
+
+    n = 1000
+    x = np.random.randn(n)
+    d = np.random.uniform(0.0, 1.5 * L, n)
+    r = d / L
+    expected = np.where(r < 1.0, x * np_fn(np.minimum(r, 1.0)), 0.0)
+    assert np.allclose(fn.taper(x, d), expected)
+
+
+def test_tabulated():
+    np.random.seed(1234)
+    L = 2.0
+    exact = GaspariCohn(L)
+    fn = Tabulated(exact, size=2048)
+    assert fn.support_range == exact.support_range
+
+    n = 1000
+    x = np.random.randn(n)
+    d = np.random.uniform(0.0, 2.5 * L, n)
+    assert np.allclose(fn.taper(x, d), exact.taper(x, d), atol=1e-5)
+
+    ones = np.ones(3)
+    assert np.allclose(fn.taper(ones, np.array([0.0, 2.0 * L, 3.0 * L])), [1.0, 0.0, 0.0])
@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+
+from endas.cov import DenseCovariance
+
+
+def test_dense_covariance():
+    np.random.seed(1234)
+    n = 6
+    G = np.random.randn(n, n)
+    C = G.dot(G.T) + np.eye(n)
+    Cop = DenseCovariance(C)
+
+    b = np.random.randn(n, 3)
+    assert np.allclose(Cop.solve(b), np.linalg.solve(C, b))
+
+    # The matrix cannot be modified through to_matrix() since the factorization used by solve() is cached
+    M = Cop.to_matrix()
+    assert np.array_equal(M, C)
+    with pytest.raises(ValueError):
+        M[0, 0] = 1.0
+
+    out = np.empty((n, n))
+    assert Cop.to_matrix(out=out) is out
+    assert np.array_equal(out, C)
+    assert np.allclose(Cop.solve(b), np.linalg.solve(C, b))
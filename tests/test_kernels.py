@@ -0,0 +1,49 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+import numpy as np
+
+from endas import _kernels
+
+
+def _row_sum(i):
+    return float(np.arange(i + 1).sum())
+
+
+def test_row_kernels():
+    np.random.seed(1234)
+    E = np.random.randn(50, 20)
+
+    C = _kernels.center_rows(E)
+    assert np.allclose(C, E - E.mean(axis=1, keepdims=True))
+
+    S = _kernels.standardize_rows(E)
+    assert np.allclose(S, (E - E.mean(axis=1, keepdims=True)) / E.std(axis=1, keepdims=True))
+
+
+def test_apply_local_transforms():
+    np.random.seed(1234)
+    A = np.random.randn(50, 20)
+    limits = np.array([[0, 10], [10, 25], [35, 15]])
+    X5 = np.random.randn(3, 20, 20)
+    haveX5 = np.array([True, False, True])
+
+    expected = A.copy()
+    expected[0:10] = A[0:10] @ X5[0]
+    expected[35:50] = A[35:50] @ X5[2]
+    assert np.allclose(_kernels.apply_local_transforms(A, limits, X5, haveX5), expected)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="fork start method not available")
+def test_kernels_before_fork():
+    # Process pools using the fork start method must keep working after the kernels have been used
+    np.random.seed(1234)
+    E = np.random.randn(50, 20)
+    _kernels.center_rows(E)
+    _kernels.standardize_rows(E)
+    _kernels.apply_local_transforms(E, np.array([[0, 20], [20, 30]]), np.random.randn(2, 20, 20),
+                                    np.array([True, True]))
+
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('fork')) as executor:
+        assert list(executor.map(_row_sum, range(4))) == [0.0, 1.0, 3.0, 6.0]
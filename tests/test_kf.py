@@ -0,0 +1,101 @@
+import pytest
+import numpy as np
+
+from endas.algorithms import KalmanFilter, RandomWalkKalmanFilter
+from endas.obs import MatrixObservationOp
+
+
+class _LinearModel:
+    # Linear time-invariant model x_k+1 = M*x_k, the state is propagated in-place
+
+    def __init__(self, M):
+        self.M = M
+        self.num_tl_calls = 0
+
+    def __call__(self, x, dt):
+        x[:] = self.M.dot(x)
+        return None
+
+    def tl(self, trj, X):
+        self.num_tl_calls += 1
+        return self.M.dot(X)
+
+    def adj(self, trj, X):
+        return X.dot(self.M.T)
+
+
+def _linear_problem(n=8, m=5, T=60):
+    np.random.seed(1234)
+    Q_, _ = np.linalg.qr(np.random.randn(n, n))
+    M = 0.95 * Q_
+    x0 = np.random.randn(n)
+    P0 = np.eye(n)
+    Q = 0.1 * np.eye(n)
+    Hmat = np.random.randn(m, n)
+    R = 0.5 * np.eye(m)
+    zs = np.random.randn(T, m)
+    return M, x0, P0, Q, MatrixObservationOp(Hmat), R, zs
+
+
+@pytest.mark.parametrize("steady_state_tol", [None, 1e-12])
+def test_kf_run_linear_batch(steady_state_tol):
+    M, x0, P0, Q, H, R, zs = _linear_problem()
+
+    # Reference solution by repeated filter steps
+    model = _LinearModel(M)
+    kf = KalmanFilter(model, model.tl, model.adj)
+    x, P = x0.copy(), P0
+    expected = []
+    for t, z in enumerate(zs):
+        x, Pf = kf.forecast(x, P, Q, 1.0)
+        kf.begin_analysis(x, Pf, t)
+        kf.assimilate(z, H, R)
+        x, P = kf.end_analysis()
+        expected.append(x.copy())
+
+        # The analysis covariance is exactly symmetric
+        assert np.array_equal(P, P.T)
+
+    model = _LinearModel(M)
+    kf = KalmanFilter(model, model.tl, model.adj)
+    xa, Pa = kf.run_linear_batch(x0, P0, Q, 1.0, zs, H, R, steady_state_tol=steady_state_tol)
+
+    assert xa.shape == (len(zs), len(x0))
+    assert np.allclose(xa, expected, rtol=0, atol=1e-8)
+    assert np.allclose(Pa, P, rtol=0, atol=1e-8)
+
+    # The covariance is only propagated until the steady state is detected
+    if steady_state_tol is None: assert model.num_tl_calls == len(zs)
+    else: assert model.num_tl_calls < len(zs)
+
+
+@pytest.mark.parametrize("dt, alpha0", [(1.0, 1.0), (0.5, 3.0)])
+def test_random_walk_kf(dt, alpha0):
+    np.random.seed(1234)
+    n, m, T = 8, 5, 20
+    G = np.random.randn(n, n)
+    Q = G.dot(G.T) + np.eye(n)
+    Hmat = np.random.randn(m, n)
+    R = np.diag(np.random.rand(m) + 0.5)
+    H = MatrixObservationOp(Hmat)
+    x0 = np.random.randn(n)
+    zs = np.random.randn(T, m)
+
+    # Reference solution by the general filter with identity model
+    model = _LinearModel(np.eye(n))
+    kf = KalmanFilter(model, model.tl, model.adj)
+    rwkf = RandomWalkKalmanFilter(H, R, Q)
+    rwkf.begin(x0, alpha0)
+    assert np.allclose(rwkf.P, alpha0 * Q)
+
+    x, P = x0.copy(), alpha0 * Q
+    for t, z in enumerate(zs):
+        x, Pf = kf.forecast(x, P, dt * Q, dt)
+        kf.begin_analysis(x, Pf, t)
+        kf.assimilate(z, H, R)
+        x, P = kf.end_analysis()
+
+        rwkf.forecast(dt)
+        xa = rwkf.assimilate(z)
+        assert np.allclose(xa, x, rtol=0, atol=1e-9)
+        assert np.allclose(rwkf.P, P, rtol=0, atol=1e-9)
@@ -0,0 +1,45 @@
+import pytest
+import numpy as np
+from scipy import sparse
+
+from endas.obs import MatrixObservationOp
+
+
+@pytest.mark.parametrize("as_sparse", [False, True])
+def test_matrix_obs_op_selection(as_sparse):
+    np.random.seed(1234)
+    n, N = 40, 5
+
+    # Observe every other state variable
+    Hmat = np.zeros((n // 2, n))
+    Hmat[np.arange(n // 2), np.arange(0, n, 2)] = 1
+    H = MatrixObservationOp(sparse.csr_matrix(Hmat) if as_sparse else Hmat)
+
+    x = np.random.randn(n)
+    A = np.random.randn(n, N)
+    assert np.allclose(H.dot(x), Hmat.dot(x))
+    assert np.allclose(H.dot(A), Hmat.dot(A))
+
+    out = np.empty((n // 2, N))
+    assert H.dot(A, out=out) is out
+    assert np.allclose(out, Hmat.dot(A))
+
+    selected = np.array([1, 4, 7])
+    Hl = H.localize(selected)
+    assert Hl.shape == (3, n)
+    assert np.allclose(Hl.dot(A), Hmat[selected, :].dot(A))
+
+
+def test_matrix_obs_op_general():
+    np.random.seed(1234)
+    n, N = 10, 5
+
+    # Not a row-selection matrix, must fall back to the matrix product
+    Hmat = np.zeros((2, n))
+    Hmat[0, 0:2] = 1
+    Hmat[1, 5] = 2
+    H = MatrixObservationOp(Hmat)
+
+    A = np.random.randn(n, N)
+    assert np.allclose(H.dot(A), Hmat.dot(A))
+    assert np.allclose(H.localize([1]).dot(A), Hmat[[1], :].dot(A))